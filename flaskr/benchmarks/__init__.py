@@ -0,0 +1,4 @@
+"""Benchmarks for the dating app.
+
+Run them from the ``flaskr`` directory, e.g. ``python -m benchmarks.ranking_bench``.
+"""
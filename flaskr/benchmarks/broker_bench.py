@@ -0,0 +1,100 @@
+"""Load test chat fan-out through the broker hub with 1..N worker processes.
+
+Each worker process subscribes to the chat channel the way a server worker does
+and publishes messages as fast as it can. The benchmark reports how many
+messages per second the workers publish in total and how many deliveries the
+hub fans out to the subscribed workers.
+
+Usage:
+    python -m benchmarks.broker_bench --workers 1 2 4 8 --messages 20000
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import broker
+
+PAYLOAD = {'room': '1-2', 'content': {'name': 'bench', 'message': 'x' * 64, 'sender_id': 1}}
+
+
+def worker(path, messages, expected, ready, start, results):
+    hub = broker.HubBroker(path)
+    received = [0]
+
+    def count(message, origin):
+        received[0] += 1
+
+    hub.subscribe('chat', count)
+    ready.wait()
+    start.wait()
+    started = time.perf_counter()
+    for _ in range(messages):
+        hub.publish('chat', PAYLOAD)
+    published = time.perf_counter() - started
+
+    deadline = time.monotonic() + 60
+    while received[0] < expected and time.monotonic() < deadline:
+        time.sleep(0.005)
+    results.put((published, time.perf_counter() - started, received[0]))
+
+
+def run(path, workers, messages):
+    ready = multiprocessing.Barrier(workers + 1)
+    start = multiprocessing.Barrier(workers + 1)
+    results = multiprocessing.Queue()
+    expected = workers * messages
+    processes = [multiprocessing.Process(target=worker, args=(path, messages, expected, ready, start, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    ready.wait()
+    time.sleep(0.2)  # let every subscription reach the hub
+    start.wait()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    publish_seconds = max(outcome[0] for outcome in outcomes)
+    delivery_seconds = max(outcome[1] for outcome in outcomes)
+    delivered = sum(outcome[2] for outcome in outcomes)
+    return {
+        'workers': workers,
+        'messages_per_worker': messages,
+        'publish_msgs_per_s': round(workers * messages / publish_seconds),
+        'delivered': delivered,
+        'expected_deliveries': workers * expected,
+        'delivery_msgs_per_s': round(delivered / delivery_seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'hub.sock')
+    hub = subprocess.Popen([sys.executable, '-m', 'broker', '--socket', path], stdout=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.05)
+        for workers in args.workers:
+            result = run(path, workers, args.messages)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(', '.join(f'{key}={value}' for key, value in result.items()))
+    finally:
+        hub.terminate()
+        hub.wait()
+
+
+if __name__ == '__main__':
+    main()
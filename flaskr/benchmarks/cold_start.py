@@ -0,0 +1,109 @@
+"""Measure how long a fresh server process takes to become ready.
+
+Each run starts a new interpreter that imports the server, connects to the
+database in one schema mode (see `model.connect_to_db`) and serves its
+first request through the test client. Runs are repeated per mode and the
+median of each phase is reported, together with the modules that cost the
+most to import. The database is migrated once beforehand, so every mode
+starts on an up-to-date schema.
+
+``--max-ms`` fails the command when a mode's median time to first response
+exceeds it, so a startup regression can break a CI job.
+
+Usage:
+    python -m benchmarks.cold_start --runs 10
+    python -m benchmarks.cold_start --modes skip --max-ms 1500 --json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FLASKR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = '''
+import contextlib, io, json, sys, time
+started = time.perf_counter()
+import server
+import model
+imported = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    model.connect_to_db(server.app, sys.argv[1], schema=sys.argv[2])
+connected = time.perf_counter()
+server.app.test_client().get('/login')
+responded = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'connect_ms': (connected - imported) * 1000,
+                  'first_request_ms': (responded - connected) * 1000}))
+'''
+
+
+def run_once(database_url, mode, importtime=False):
+    """Start one server process; returns its phase timings and, with `importtime`, its import log."""
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', _CHILD, database_url, mode]
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=FLASKR, capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process_ms'] = (time.perf_counter() - started) * 1000
+    return timings, result.stderr
+
+
+def slowest_imports(log, count):
+    """The `count` modules with the largest self import time in a ``-X importtime`` log."""
+    modules = []
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), name.strip()))
+    return [{'module': name, 'self_ms': round(self_us / 1000, 1)}
+            for self_us, name in sorted(modules, reverse=True)[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['migrate', 'check', 'skip'],
+                        choices=['migrate', 'check', 'skip'])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes per mode')
+    parser.add_argument('--top-imports', type=int, default=10, help='Slowest imports to list')
+    parser.add_argument('--database-url', help='Database to connect to; defaults to a temporary SQLite file')
+    parser.add_argument('--max-ms', type=float, help='Fail if a median time to first response exceeds this')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or f'sqlite:///{os.path.join(directory, "cold_start.db")}'
+        subprocess.run([sys.executable, 'migrations.py', 'upgrade', '--create-database',
+                        '--database-url', database_url], cwd=FLASKR, capture_output=True, check=True)
+        results = []
+        for mode in args.modes:
+            runs = [run_once(database_url, mode)[0] for _ in range(args.runs)]
+            result = {'mode': mode, 'runs': args.runs}
+            for phase in ('import_ms', 'connect_ms', 'first_request_ms', 'process_ms'):
+                result[phase] = round(statistics.median(run[phase] for run in runs), 1)
+            result['ready_ms'] = round(statistics.median(
+                run['import_ms'] + run['connect_ms'] + run['first_request_ms'] for run in runs), 1)
+            results.append(result)
+        imports = slowest_imports(run_once(database_url, args.modes[-1], importtime=True)[1], args.top_imports)
+
+    failed = [result['mode'] for result in results if args.max_ms is not None and result['ready_ms'] > args.max_ms]
+    if args.json:
+        print(json.dumps({'modes': results, 'slowest_imports': imports, 'failed': failed}, indent=2))
+    else:
+        for result in results:
+            print(f"{result['mode']:>8}: ready in {result['ready_ms']:7.1f} ms (import {result['import_ms']:.1f}, "
+                  f"connect {result['connect_ms']:.1f}, first request {result['first_request_ms']:.1f}); "
+                  f"process {result['process_ms']:.1f} ms")
+        print('slowest imports: ' + ', '.join(f"{entry['module']} {entry['self_ms']} ms" for entry in imports))
+        for mode in failed:
+            print(f'{mode}: over the {args.max_ms} ms budget')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""End-to-end benchmark of the swipe, match and chat hot paths.
+
+Seeds a local database with a synthetic population, then drives the real
+Flask routes and the Socket.IO ``message`` handler through the test clients
+and reports latency percentiles, throughput and queries per request. Each
+``--seen`` value benchmarks a fresh user who has already swiped on that many
+profiles, to show how swipe latency grows with the swipe history.
+
+Usage:
+    python -m benchmarks.e2e --users 20000 --seen 0 1000 10000 --json
+    python -m benchmarks.e2e --database-url postgresql:///matchmeet_bench
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from PIL import Image
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import bulk_load
+import model
+
+_queries = 0
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    global _queries
+    _queries += 1
+
+
+def _percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+class Recorder:
+    """Collects the latency and query count of every call, grouped by operation."""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        queries = _queries
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        self.samples.setdefault(name, []).append((elapsed, _queries - queries))
+
+    def report(self):
+        results = {}
+        for name, samples in self.samples.items():
+            timings = sorted(elapsed for elapsed, _ in samples)
+            total = sum(timings)
+            results[name] = {
+                'requests': len(samples),
+                'p50_ms': round(_percentile(timings, 0.5) * 1000, 2),
+                'p99_ms': round(_percentile(timings, 0.99) * 1000, 2),
+                'throughput_rps': round(len(samples) / total, 1) if total else None,
+                'queries_per_request': round(sum(queries for _, queries in samples) / len(samples), 2),
+            }
+        return results
+
+
+def _jpeg(size=800):
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (200, 120, 80)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def seed(app, users, likes_per_user, seed_value):
+    """Load the synthetic population and warm the in-memory indexes."""
+    import server
+
+    with app.app_context():
+        started = time.perf_counter()
+        user_ids = bulk_load.load_users(bulk_load.synthetic_records(users, seed_value))
+        counts = bulk_load.load_activity(user_ids, likes_per_user, seed=seed_value)
+        server.index_new_users(user_ids)
+        return user_ids, dict(counts, seed_s=round(time.perf_counter() - started, 2))
+
+
+def add_seen_history(user_id, seen, user_ids, rng):
+    """Mark `seen` random profiles as already swiped by `user_id`."""
+    now = datetime.utcnow()
+    targets = rng.sample([other for other in user_ids if other != user_id], min(seen, len(user_ids) - 1))
+    for start in range(0, len(targets), bulk_load.BATCH_SIZE):
+        model.db.session.execute(model.insert_ignore(model.Seen.__table__), [
+            {'user_id': user_id, 'seen_user_id': target, 'seen_time': now}
+            for target in targets[start:start + bulk_load.BATCH_SIZE]])
+    model.db.session.commit()
+
+
+def bench_user(app, socketio, user_id, swipes, messages, photo, rng):
+    """Drive one logged-in user through browsing, swiping, chatting and profile routes."""
+    import server
+
+    recorder = Recorder()
+    client = app.test_client()
+    with app.app_context():
+        user = model.User.get_by_id(user_id)
+        client.post('/login', data={'username': user.username, 'password': user.password})
+        server.candidate_deck.invalidate(user_id)
+
+    for _ in range(swipes):
+        with recorder.measure('index'):
+            client.get('/')
+        with app.app_context():
+            target = server.candidate_deck.peek(user_id)
+        if target is None:
+            break
+        action = 'like' if rng.random() < 0.5 else 'dislike'
+        with recorder.measure(f'{action}_user'):
+            client.post(f'/user/{action}/{target}')
+
+    for _ in range(max(1, swipes // 10)):
+        with app.app_context():
+            batch = server.candidate_deck.upcoming(user_id, 10)
+        if not batch:
+            break
+        with recorder.measure('swipe_batch_10'):
+            client.post('/api/swipes', json={'swipes': [{'target': candidate, 'like': rng.random() < 0.5}
+                                                        for candidate in batch]})
+
+    for _ in range(max(1, swipes // 10)):
+        with recorder.measure('chat'):
+            client.get('/chat')
+        with recorder.measure('profile'):
+            client.get(f'/profile/{rng.choice([user_id, target or user_id])}')
+    with recorder.measure('photo_upload'):
+        client.post(f'/profile/{user_id}/photo', data={'file': (io.BytesIO(photo), 'photo.jpg')},
+                    content_type='multipart/form-data')
+
+    with app.app_context():
+        peer = model.db.session.query(model.Match.match_id).filter(model.Match.user_id == user_id).limit(1).scalar()
+    if peer is not None:
+        client.get(f'/room/{peer}')
+        # The Socket.IO handlers print every event.
+        with contextlib.redirect_stdout(io.StringIO()):
+            socket = socketio.test_client(app, flask_test_client=client)
+            for index in range(messages):
+                with recorder.measure('socket_message'):
+                    socket.emit('message', {'data': f'benchmark message {index}'})
+            socket.get_received()
+            with recorder.measure('chat_flush'):
+                server.chat_history.flush()
+            socket.disconnect()
+    return recorder.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='Database to seed; defaults to a temporary SQLite file')
+    parser.add_argument('--replica-url', action='append', help='Read replica to route SELECTs to (repeatable)')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--likes-per-user', type=int, default=10)
+    parser.add_argument('--seen', type=int, nargs='+', default=[0, 1000, 4000],
+                        help='Swipe history lengths to benchmark')
+    parser.add_argument('--swipes', type=int, default=100, help='Swipes per benchmarked user')
+    parser.add_argument('--messages', type=int, default=100, help='Chat messages per benchmarked user')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if database_url is None:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='matchmeet-bench-')
+        os.close(handle)
+        os.remove(path)
+        database_url = f'sqlite:///{path}'
+
+    import server
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.connect_to_db(server.app, database_url, replica_uris=args.replica_url, schema='migrate')
+    server.app.logger.disabled = True
+    # Uploaded photos and their variants go to a scratch folder, not the source tree.
+    upload_folder = tempfile.mkdtemp(prefix='matchmeet-bench-photos-')
+    server.app.config['UPLOAD_FOLDER'] = upload_folder
+    event.listen(Engine, 'before_cursor_execute', _count_query)
+
+    user_ids, dataset = seed(server.app, args.users, args.likes_per_user, args.seed)
+    rng = random.Random(args.seed)
+    photo = _jpeg()
+    runs = []
+    try:
+        for index, seen in enumerate(args.seen):
+            user_id = user_ids[index]
+            with server.app.app_context():
+                add_seen_history(user_id, seen, user_ids, rng)
+            runs.append({'seen': seen, 'routes': bench_user(server.app, server.socketio, user_id, args.swipes,
+                                                               args.messages, photo, rng)})
+    finally:
+        server.photo_pipeline.shutdown()
+        shutil.rmtree(upload_folder, ignore_errors=True)
+
+    results = {'database': database_url.split(':', 1)[0], 'dataset': dict(dataset, users=args.users),
+               'runs': runs}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.users} users, {dataset["likes"]} likes, {dataset["matches"]} matches '
+          f'on {results["database"]} (seeded in {dataset["seed_s"]}s)')
+    for run in runs:
+        print(f'\nseen={run["seen"]}')
+        for name, stats in run['routes'].items():
+            print(f'  {name:15} p50 {stats["p50_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms  '
+                  f'{stats["throughput_rps"]:8.1f} req/s  {stats["queries_per_request"]:5.2f} queries')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark radius queries on the geo grid against a full haversine scan.
+
+Profiles are scattered around a city centre with a normal distribution, so the
+centre is dense and the suburbs are sparse, like a real metro area.
+
+Usage:
+    python -m benchmarks.geo_bench --profiles 1000000 --radius-km 5 10 25
+"""
+
+import argparse
+import json
+import random
+import time
+
+from geo import GeoGrid, scan_within
+
+CITY_CENTRE = (40.7128, -74.0060)
+CITY_SPREAD_DEG = 0.25
+
+
+def synthetic_locations(count, seed=0):
+    """Return `(user_id, lat, lon)` triples around `CITY_CENTRE`."""
+    rng = random.Random(seed)
+    lat, lon = CITY_CENTRE
+    return [(user_id, rng.gauss(lat, CITY_SPREAD_DEG), rng.gauss(lon, CITY_SPREAD_DEG))
+            for user_id in range(1, count + 1)]
+
+
+def timed(function, queries):
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        function(*query)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', type=int, default=1_000_000)
+    parser.add_argument('--radius-km', type=float, nargs='+', default=[5, 10, 25])
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--scan-queries', type=int, default=3, help='full scans are slow; run fewer')
+    parser.add_argument('--cell-km', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    locations = synthetic_locations(args.profiles, args.seed)
+    grid = GeoGrid(cell_km=args.cell_km)
+    started = time.perf_counter()
+    grid.load(locations)
+    build_seconds = time.perf_counter() - started
+
+    rng = random.Random(args.seed + 1)
+    for radius_km in args.radius_km:
+        origins = [locations[rng.randrange(len(locations))] for _ in range(args.queries)]
+        grid_p50, grid_p99 = timed(
+            lambda user_id, lat, lon: grid.within(lat, lon, radius_km, args.limit, exclude={user_id}), origins)
+        scan_p50, scan_p99 = timed(
+            lambda user_id, lat, lon: scan_within(locations, lat, lon, radius_km, args.limit),
+            origins[:args.scan_queries])
+
+        user_id, lat, lon = origins[0]
+        expected = [u for u, _ in scan_within(locations, lat, lon, radius_km, args.limit + 1) if u != user_id]
+        actual = [u for u, _ in grid.within(lat, lon, radius_km, args.limit, exclude={user_id})]
+        result = {
+            'profiles': args.profiles,
+            'radius_km': radius_km,
+            'grid_build_s': round(build_seconds, 2),
+            'grid_p50_ms': round(grid_p50, 2),
+            'grid_p99_ms': round(grid_p99, 2),
+            'scan_p50_ms': round(scan_p50, 2),
+            'scan_p99_ms': round(scan_p99, 2),
+            'speedup': round(scan_p50 / grid_p50, 1) if grid_p50 else None,
+            'results_match': expected[:args.limit] == actual,
+        }
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(', '.join(f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
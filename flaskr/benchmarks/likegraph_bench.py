@@ -0,0 +1,105 @@
+"""Benchmark the in-memory like graph on a synthetic power-law graph.
+
+A few popular users receive most likes, as on a real dating site, so
+received lists range from empty to very long.
+
+Usage:
+    python -m benchmarks.likegraph_bench --users 1000000 --likes-per-user 50
+"""
+
+import argparse
+import json
+import random
+import resource
+import time
+
+import numpy as np
+
+from likegraph import LikeGraph
+
+
+def synthetic_edges(users, likes_per_user, seed=0):
+    """Return `(sources, targets)` arrays where targets follow a Zipf-like popularity."""
+    rng = np.random.default_rng(seed)
+    sources = np.repeat(np.arange(1, users + 1, dtype=np.uint32), likes_per_user)
+    popularity = 1 / np.arange(1, users + 1) ** 0.8
+    cumulative = np.cumsum(popularity)
+    targets = np.searchsorted(cumulative, rng.random(sources.size) * cumulative[-1]).astype(np.uint32) + 1
+    keep = sources != targets
+    return sources[keep], targets[keep]
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return (round(samples[len(samples) // 2] * 1e6, 2),
+            round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 2))
+
+
+def run(users, likes_per_user, lookups, seed):
+    sources, targets = synthetic_edges(users, likes_per_user, seed)
+    graph = LikeGraph()
+    started = time.perf_counter()
+    graph.load_arrays(sources, targets)
+    load_seconds = time.perf_counter() - started
+    del sources, targets
+
+    rng = random.Random(seed + 1)
+    pairs = [(rng.randint(1, users), rng.randint(1, users)) for _ in range(lookups)]
+    # Half the lookups check edges that exist, as a like on a candidate who liked you would.
+    popular = [(rng.randint(1, users), rng.randint(1, 100)) for _ in range(lookups)]
+    mutual_checks = []
+    for user_a, user_b in pairs + popular:
+        started = time.perf_counter()
+        graph.is_mutual(user_a, user_b)
+        mutual_checks.append(time.perf_counter() - started)
+
+    liked_you = []
+    for user_id in rng.sample(range(1, users + 1), min(users, lookups // 10 or 1)) + list(range(1, 11)):
+        started = time.perf_counter()
+        graph.liked_you(user_id)
+        liked_you.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for user_a, user_b in pairs[:1000]:
+        graph.add(user_a, user_b)
+    add_seconds = (time.perf_counter() - started) / min(1000, len(pairs))
+
+    edges = len(graph)
+    memory = graph.memory_bytes()
+    mutual_p50, mutual_p99 = _percentiles(mutual_checks)
+    liked_you_p50, liked_you_p99 = _percentiles(liked_you)
+    return {
+        'users': users,
+        'edges': edges,
+        'load_s': round(load_seconds, 2),
+        'memory_mb': round(memory / 2 ** 20, 1),
+        'bytes_per_edge': round(memory / edges, 1),
+        'mutual_check_p50_us': mutual_p50,
+        'mutual_check_p99_us': mutual_p99,
+        'liked_you_p50_us': liked_you_p50,
+        'liked_you_p99_us': liked_you_p99,
+        'add_us': round(add_seconds * 1e6, 2),
+        'max_received': graph.received_count(1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--likes-per-user', type=int, default=50)
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    result = run(args.users, args.likes_per_user, args.lookups, args.seed)
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        print(f'{key:>20}: {value}')
+
+
+if __name__ == '__main__':
+    main()
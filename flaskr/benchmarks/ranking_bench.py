@@ -0,0 +1,74 @@
+"""Benchmark top-k interest ranking over synthetic profiles.
+
+Usage:
+    python -m benchmarks.ranking_bench --sizes 100000 1000000 --k 20
+"""
+
+import argparse
+import json
+import random
+import time
+
+from ranking import InterestFeatureStore
+
+INTEREST_POOL = 500
+
+
+def synthetic_profiles(count, seed=0):
+    """Yield `(user_id, interests)` with 3-10 interests drawn from a skewed pool."""
+    rng = random.Random(seed)
+    pool = [f'interest-{i}' for i in range(INTEREST_POOL)]
+    weights = [1 / (i + 1) for i in range(INTEREST_POOL)]
+    for user_id in range(1, count + 1):
+        yield user_id, set(rng.choices(pool, weights, k=rng.randint(3, 10)))
+
+
+def run(size, k, repeats, seed):
+    store = InterestFeatureStore()
+    started = time.perf_counter()
+    store.load(synthetic_profiles(size, seed))
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed + 1)
+    timings = []
+    for _ in range(repeats):
+        user_id = rng.randint(1, size)
+        started = time.perf_counter()
+        store.top_k(user_id, k)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+
+    started = time.perf_counter()
+    store.upsert(rng.randint(1, size), ['interest-1', 'interest-2', 'interest-3'])
+    upsert_seconds = time.perf_counter() - started
+
+    return {
+        'profiles': size,
+        'k': k,
+        'generate_and_load_s': round(load_seconds, 3),
+        'top_k_p50_ms': round(timings[len(timings) // 2] * 1000, 2),
+        'top_k_p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000, 2),
+        'upsert_ms': round(upsert_seconds * 1000, 3),
+        'matrix_mb': round(store._bits.nbytes / 2**20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per size')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        result = run(size, args.k, args.repeats, args.seed)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(', '.join(f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
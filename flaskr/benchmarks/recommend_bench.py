@@ -0,0 +1,84 @@
+"""Benchmark the recommendation job's scoring on a synthetic like graph.
+
+Builds the CSR like matrix from a power-law graph held in memory, then times
+a full run over every user and an incremental run over a random share of
+them. Database reads and writes are left out; `flask recommend` reports
+those for a real database.
+
+Usage:
+    python -m benchmarks.recommend_bench --users 1000000 --likes-per-user 20 --workers 4
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.likegraph_bench import synthetic_edges
+from recommend import CHUNK_SIZE, TOP_N, LikeMatrix, peak_memory_mb, score_users
+
+
+def timed_run(matrix, user_ids, top_n, workers, chunk_size):
+    started = time.perf_counter()
+    recommendations = 0
+    for _, (owners, _, _) in score_users(matrix, user_ids, top_n, workers, chunk_size):
+        recommendations += owners.size
+    seconds = time.perf_counter() - started
+    return seconds, recommendations
+
+
+def run(users, likes_per_user, workers, top_n, chunk_size, active_share, seed):
+    sources, targets = synthetic_edges(users, likes_per_user, seed)
+    started = time.perf_counter()
+    matrix = LikeMatrix(sources, targets, seed)
+    build_seconds = time.perf_counter() - started
+    edges = int(sources.size)
+    del sources, targets
+
+    all_users = matrix.users()
+    full_seconds, full_recommendations = timed_run(matrix, all_users, top_n, workers, chunk_size)
+    rng = np.random.default_rng(seed + 1)
+    active = np.sort(rng.choice(all_users, max(1, int(all_users.size * active_share)), replace=False))
+    incremental_seconds, _ = timed_run(matrix, active, top_n, workers, chunk_size)
+
+    peak_mb, peak_worker_mb = peak_memory_mb()
+    return {
+        'users': users,
+        'edges': edges,
+        'workers': workers,
+        'build_s': round(build_seconds, 2),
+        'full_s': round(full_seconds, 2),
+        'full_users_per_s': round(all_users.size / full_seconds),
+        'recommendations_per_user': round(full_recommendations / all_users.size, 1),
+        'incremental_users': int(active.size),
+        'incremental_s': round(incremental_seconds, 2),
+        'peak_rss_mb': peak_mb,
+        'peak_worker_rss_mb': peak_worker_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--likes-per-user', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--top-n', type=int, default=TOP_N)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--active-share', type=float, default=0.01,
+                        help='Share of users with new likes in the incremental run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    result = run(args.users, args.likes_per_user, args.workers, args.top_n, args.chunk_size,
+                 args.active_share, args.seed)
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        print(f'{key:>24}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark the in-memory full-text profile index on a synthetic corpus.
+
+Descriptions draw words from a Zipf-distributed vocabulary, so common words
+have long postings lists and rare ones short lists, as in real text.
+
+Usage:
+    python -m benchmarks.search_bench --size 1000000 --queries 200
+"""
+
+import argparse
+import itertools
+import json
+import random
+import resource
+import time
+
+from search import InvertedIndex
+
+VOCABULARY = 20000
+INTERESTS = 500
+
+
+def _words(count, prefix):
+    return [f'{prefix}{i}' for i in range(count)]
+
+
+def synthetic_corpus(count, seed=0):
+    """Yield `(user_id, description, interests)` with 5-40 description words and 2-8 interests."""
+    rng = random.Random(seed)
+    words = _words(VOCABULARY, 'w')
+    word_weights = list(itertools.accumulate(1 / (i + 1) for i in range(VOCABULARY)))
+    interests = _words(INTERESTS, 'interest')
+    interest_weights = list(itertools.accumulate(1 / (i + 1) for i in range(INTERESTS)))
+    for user_id in range(1, count + 1):
+        description = ' '.join(rng.choices(words, cum_weights=word_weights, k=rng.randint(5, 40)))
+        yield user_id, description, rng.choices(interests, cum_weights=interest_weights, k=rng.randint(2, 8))
+
+
+def run(size, queries, per_page, seed):
+    index = InvertedIndex()
+    started = time.perf_counter()
+    index.load(synthetic_corpus(size, seed))
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed + 1)
+    words = _words(VOCABULARY, 'w')
+    timings = {'common': [], 'rare': [], 'mixed': []}
+    totals = []
+    for _ in range(queries):
+        kinds = {
+            'common': ' '.join(rng.sample(words[:50], 2)),
+            'rare': ' '.join(rng.sample(words[5000:], 2)),
+            'mixed': f'{rng.choice(words[:50])} {rng.choice(words[500:5000])} interest{rng.randint(0, 50)}',
+        }
+        for kind, query in kinds.items():
+            started = time.perf_counter()
+            _, total = index.search(query, per_page, offset=per_page)
+            timings[kind].append(time.perf_counter() - started)
+            totals.append(total)
+
+    started = time.perf_counter()
+    for user_id in rng.sample(range(1, size + 1), 1000):
+        index.upsert(user_id, ' '.join(rng.sample(words[:2000], 20)), ['interest1'])
+    upsert_seconds = (time.perf_counter() - started) / 1000
+
+    result = {
+        'profiles': size,
+        'load_s': round(load_seconds, 2),
+        'upsert_ms': round(upsert_seconds * 1000, 3),
+        'average_matches': round(sum(totals) / len(totals)),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    for kind, samples in timings.items():
+        samples.sort()
+        result[f'{kind}_p50_ms'] = round(samples[len(samples) // 2] * 1000, 2)
+        result[f'{kind}_p99_ms'] = round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    result = run(args.size, args.queries, args.per_page, args.seed)
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        print(f'{key:>18}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Benchmark the compact seen sets against exact swipe histories.
+
+For each history size, one user's swipes are spread evenly over the
+resurface horizon. The benchmark reports the memory of a `SeenSet` next to
+a Python set and a plain ``array('I')`` of the same IDs, the measured
+false-positive rate on IDs that were never swiped, and the time to filter
+one deck scan batch.
+
+Usage:
+    python -m benchmarks.seenset_bench --history 100 1000 10000 100000
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from array import array
+from datetime import date
+
+from deck import SCAN_BATCH_SIZE
+from seenset import RESURFACE_DAYS, SeenSet
+
+ID_SPACE = 10_000_000
+
+
+def run_history(size, probes, rng):
+    swiped = rng.sample(range(1, ID_SPACE), size)
+    today = date.today().toordinal()
+    seen_set = SeenSet()
+    started = time.perf_counter()
+    for index, user_id in enumerate(swiped):
+        seen_set.add(user_id, today - RESURFACE_DAYS + index * RESURFACE_DAYS // size)
+    add_seconds = (time.perf_counter() - started) / size
+
+    swiped_ids = set(swiped)
+    fresh = []
+    while len(fresh) < probes:
+        candidate = rng.randrange(1, ID_SPACE)
+        if candidate not in swiped_ids:
+            fresh.append(candidate)
+    false_positives = len(seen_set.seen_among(fresh))
+    missed = size - len(seen_set.seen_among(swiped))
+
+    batches = [fresh[start:start + SCAN_BATCH_SIZE] for start in range(0, len(fresh), SCAN_BATCH_SIZE)]
+    started = time.perf_counter()
+    for batch in batches:
+        seen_set.seen_among(batch)
+    batch_seconds = (time.perf_counter() - started) / len(batches)
+
+    exact = sys.getsizeof(swiped_ids)
+    return {
+        'history': size,
+        'seenset_bytes': seen_set.memory_bytes(),
+        'bytes_per_swipe': round(seen_set.memory_bytes() / size, 2),
+        'python_set_bytes': exact,
+        'array_bytes': sys.getsizeof(array('I', swiped)),
+        'false_positive_rate': round(false_positives / probes, 5),
+        'false_negatives': missed,
+        'add_us': round(add_seconds * 1e6, 2),
+        'batch_filter_us': round(batch_seconds * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='Swipe history sizes to measure')
+    parser.add_argument('--probes', type=int, default=100000, help='Never-swiped IDs probed per size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = [run_history(size, args.probes, rng) for size in args.history]
+    if args.json:
+        print(json.dumps(results))
+        return
+    columns = list(results[0])
+    print(' '.join(f'{column:>18}' for column in columns))
+    for result in results:
+        print(' '.join(f'{result[column]:>18}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
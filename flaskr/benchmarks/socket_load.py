@@ -0,0 +1,328 @@
+"""Load test the Socket.IO server with thousands of concurrent clients.
+
+Starts ``wsgi.py`` once per async mode on a fresh database and opens
+``--clients`` WebSocket connections to it, the way idle browser tabs keep
+them open. While every connection is held, a few logged-in chatters
+exchange messages in one room and a prober times plain page loads. The
+benchmark reports how many connections the server accepted, how long the
+Socket.IO handshake took, message and page latency under that load, and
+the server's memory and thread count.
+
+The clients speak just enough WebSocket, Engine.IO and Socket.IO to connect,
+answer pings and send chat messages, so one asyncio process can drive all
+of them.
+
+Usage:
+    python -m benchmarks.socket_load --modes threading gevent --clients 10000
+    python -m benchmarks.socket_load --database-url postgresql:///matchmeet_bench --json
+"""
+
+import argparse
+import asyncio
+import base64
+import http.cookiejar
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+FLASKR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Two of the users in static/data.json; every chatter logs in as the first and joins their room.
+CHATTER = ('elena', '1234')
+PEER_ID = 2
+
+
+def _percentile(timings, fraction):
+    """A percentile of `timings` in seconds, in milliseconds; None if there are none."""
+    if not timings:
+        return None
+    timings = sorted(timings)
+    return round(timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000, 1)
+
+
+class Connection:
+    """A Socket.IO client over a raw WebSocket, enough for the benchmark."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port, cookie=None):
+        reader, writer = await asyncio.open_connection(host, port)
+        connection = cls(reader, writer)
+        key = base64.b64encode(os.urandom(16)).decode()
+        headers = [f'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1', f'Host: {host}:{port}',
+                   'Upgrade: websocket', 'Connection: Upgrade', f'Sec-WebSocket-Key: {key}',
+                   'Sec-WebSocket-Version: 13']
+        if cookie:
+            headers.append(f'Cookie: {cookie}')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            writer.close()
+            raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+        opened = await connection.receive()
+        if not opened.startswith('0'):
+            raise ConnectionError(f'Unexpected Engine.IO open packet {opened!r}')
+        await connection.send('40')
+        while True:
+            packet = await connection.receive()
+            if packet.startswith('40'):
+                return connection
+            if packet.startswith('44'):
+                raise ConnectionError(f'Socket.IO connect refused: {packet}')
+
+    async def send(self, text):
+        payload = text.encode()
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, 0x80 | len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', 0x81, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x81, 0x80 | 127, len(payload))
+        masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        self.writer.write(header + mask + masked)
+        await self.writer.drain()
+
+    async def receive(self):
+        """The next Engine.IO packet, answering Engine.IO and WebSocket pings on the way."""
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7F
+            if length == 126:
+                length, = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0F
+            if opcode == 0x8:
+                raise ConnectionError('Server closed the WebSocket')
+            if opcode == 0x9:
+                self.writer.write(struct.pack('!BB', 0x8A, 0x80) + os.urandom(4))
+                continue
+            if opcode != 0x1:
+                continue
+            text = payload.decode()
+            if text == '2':
+                await self.send('3')
+                continue
+            return text
+
+    def close(self):
+        self.writer.close()
+
+
+class Idler:
+    """One idle client: connects, then answers pings until told to stop."""
+
+    def __init__(self):
+        self.connect_seconds = None
+        self.error = None
+        self.dropped = False
+
+    async def run(self, host, port, limit, timeout, stop):
+        async with limit:
+            started = time.perf_counter()
+            try:
+                connection = await asyncio.wait_for(Connection.open(host, port), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as error:
+                self.error = type(error).__name__
+                return
+            self.connect_seconds = time.perf_counter() - started
+        receiving = asyncio.ensure_future(connection.receive())
+        stopping = asyncio.ensure_future(stop.wait())
+        while True:
+            done, _ = await asyncio.wait({receiving, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if stopping in done:
+                receiving.cancel()
+                break
+            if receiving.exception() is not None:
+                self.dropped = True
+                stopping.cancel()
+                break
+            receiving = asyncio.ensure_future(connection.receive())
+        connection.close()
+
+
+def login_cookie(base_url):
+    """Log a chatter in and open their room, returning the session cookie for the WebSocket."""
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({'username': CHATTER[0], 'password': CHATTER[1]}).encode()
+    opener.open(f'{base_url}/login', form).read()
+    opener.open(f'{base_url}/room/{PEER_ID}').read()
+    return '; '.join(f'{cookie.name}={cookie.value}' for cookie in jar)
+
+
+async def chat(host, port, cookie, messages, interval, name, timings, failures):
+    """Send `messages` chat messages and time each until the server echoes it back to the room."""
+    try:
+        connection = await asyncio.wait_for(Connection.open(host, port, cookie), 60)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        failures.append(name)
+        return
+    try:
+        for sequence in range(messages):
+            token = f'{name}-{sequence}'
+            started = time.perf_counter()
+            await connection.send('42' + json.dumps(['message', {'data': token}]))
+            while f'"{token}"' not in await asyncio.wait_for(connection.receive(), 30):
+                pass
+            timings.append(time.perf_counter() - started)
+            await asyncio.sleep(interval)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        failures.append(name)
+    finally:
+        connection.close()
+
+
+def probe_pages(base_url, requests):
+    """Time sequential page loads; runs in a thread so the event loop keeps the idlers going."""
+    timings = []
+    failures = 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        try:
+            urllib.request.urlopen(f'{base_url}/login', timeout=30).read()
+        except OSError:
+            failures += 1
+            continue
+        timings.append(time.perf_counter() - started)
+    return timings, failures
+
+
+def server_status(pid):
+    """Resident memory in MB and thread count of the server process."""
+    fields = {}
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()
+    return round(int(fields['VmRSS'][0]) / 1024, 1), int(fields['Threads'][0])
+
+
+def start_server(mode, database_url, port):
+    environment = dict(os.environ, MATCHMEET_ASYNC_MODE=mode, MATCHMEET_DATABASE_URL=database_url,
+                       MATCHMEET_SCHEMA='migrate')
+    process = subprocess.Popen([sys.executable, 'wsgi.py', '--port', str(port)], cwd=FLASKR, env=environment,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1).read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f'The {mode} server exited with status {process.returncode}')
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'The {mode} server did not start')
+
+
+async def load(mode, host, port, args):
+    base_url = f'http://{host}:{port}'
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    limit = asyncio.Semaphore(args.concurrency)
+    idlers = [Idler() for _ in range(args.clients)]
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(idler.run(host, port, limit, args.connect_timeout, stop)) for idler in idlers]
+    while any(idler.connect_seconds is None and idler.error is None for idler in idlers):
+        await asyncio.sleep(0.1)
+    ramp_seconds = time.perf_counter() - started
+
+    cookies = [await loop.run_in_executor(None, login_cookie, base_url) for _ in range(args.chatters)]
+    message_timings, chat_failures = [], []
+    pages = loop.run_in_executor(None, probe_pages, base_url, args.page_requests)
+    await asyncio.gather(*(chat(host, port, cookie, args.messages, args.interval, f'chatter{index}',
+                                message_timings, chat_failures)
+                           for index, cookie in enumerate(cookies)))
+    page_timings, page_failures = await pages
+    server_rss_mb, server_threads = server_status(args.server_pid)
+
+    stop.set()
+    await asyncio.gather(*tasks)
+    connect_timings = [idler.connect_seconds for idler in idlers if idler.connect_seconds is not None]
+    errors = {}
+    for idler in idlers:
+        if idler.error:
+            errors[idler.error] = errors.get(idler.error, 0) + 1
+    return {
+        'mode': mode,
+        'clients': args.clients,
+        'connected': len(connect_timings),
+        'dropped': sum(idler.dropped for idler in idlers),
+        'connect_errors': errors,
+        'ramp_s': round(ramp_seconds, 2),
+        'connect_p50_ms': _percentile(connect_timings, 0.5),
+        'connect_p99_ms': _percentile(connect_timings, 0.99),
+        'messages': len(message_timings),
+        'chat_failures': len(chat_failures),
+        'message_p50_ms': _percentile(message_timings, 0.5),
+        'message_p99_ms': _percentile(message_timings, 0.99),
+        'pages': len(page_timings),
+        'page_failures': page_failures,
+        'page_p50_ms': _percentile(page_timings, 0.5),
+        'page_p99_ms': _percentile(page_timings, 0.99),
+        'server_rss_mb': server_rss_mb,
+        'server_threads': server_threads,
+    }
+
+
+def run(mode, args):
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or f'sqlite:///{os.path.join(directory, "socket_load.db")}'
+        process = start_server(mode, database_url, args.port)
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{args.port}/test_users').read()
+            args.server_pid = process.pid
+            return asyncio.run(load(mode, '127.0.0.1', args.port, args))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threading', 'gevent'], choices=['threading', 'gevent'])
+    parser.add_argument('--clients', type=int, default=10000, help='Idle Socket.IO connections to hold open')
+    parser.add_argument('--concurrency', type=int, default=200, help='Handshakes in flight at once')
+    parser.add_argument('--connect-timeout', type=float, default=60)
+    parser.add_argument('--chatters', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=50, help='Chat messages per chatter')
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds between a chatter\'s messages')
+    parser.add_argument('--page-requests', type=int, default=200)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--database-url', help='Database to serve from; defaults to a temporary SQLite file')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    # Both ends need a descriptor per connection.
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = [run(mode, args) for mode in args.modes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"{result['mode']:>9}: {result['connected']}/{result['clients']} connected "
+              f"(p50 {result['connect_p50_ms']} ms, p99 {result['connect_p99_ms']} ms, {result['ramp_s']} s ramp), "
+              f"{result['dropped']} dropped, errors {result['connect_errors']}")
+        print(f"{'':>9}  messages p50 {result['message_p50_ms']} ms, p99 {result['message_p99_ms']} ms "
+              f"({result['messages']} sent, {result['chat_failures']} chatters failed); "
+              f"pages p50 {result['page_p50_ms']} ms, p99 {result['page_p99_ms']} ms "
+              f"({result['page_failures']} failed); server {result['server_rss_mb']} MB, "
+              f"{result['server_threads']} threads")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""Message broker for chat fan-out and shared room state.
+
+The Socket.IO handlers publish through a broker so chat keeps working when the
+app runs as several worker processes. Two backends are provided:
+
+* `LocalBroker` keeps everything in the current process (the default).
+* `HubBroker` talks to a small hub process over a Unix socket. The hub fans
+  published messages out to every subscribed process and holds shared
+  values, such as how many members a chat room has.
+
+Start the hub with ``python -m broker`` and point the workers at the socket
+path it prints with ``MATCHMEET_BROKER_URL=unix://<path>``. By default the
+socket lives in a directory only the hub's user can open, and the socket
+itself is mode 0600. Frames are length-prefixed JSON, so a peer can send
+data but never code. Dates and datetimes are tagged so they round-trip;
+tuples arrive as lists.
+
+If the hub restarts, each worker reconnects and subscribes again. Messages
+published while it was down are lost.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('!I')
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                              f'matchmeet-{os.getuid()}', 'broker.sock')
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError(f'Cannot send {type(value).__name__} through the broker')
+
+
+def _decode_value(obj):
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            return datetime.fromisoformat(obj['__datetime__'])
+        if '__date__' in obj:
+            return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def _dumps(message):
+    return json.dumps(message, default=_encode_value, separators=(',', ':')).encode()
+
+
+def _loads(payload):
+    return json.loads(payload, object_hook=_decode_value)
+
+
+def _send_frame(sock, message):
+    payload = _dumps(message)
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = bytearray()
+    while len(chunks) < size:
+        chunk = sock.recv(size - len(chunks))
+        if not chunk:
+            raise ConnectionError('broker hub closed the connection')
+        chunks.extend(chunk)
+    return bytes(chunks)
+
+
+def _recv_frame(sock):
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return _loads(_recv_exactly(sock, size))
+
+
+class LocalBroker:
+    """In-process broker: subscribers are called directly, state lives in a dict."""
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self._subscribers = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        """Deliver `message` to every subscriber of `channel`."""
+        for callback in list(self._subscribers.get(channel, ())):
+            callback(message, self.origin)
+
+    def subscribe(self, channel, callback):
+        """Call `callback(message, origin)` for every message published on `channel`."""
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def setdefault(self, key, value):
+        with self._lock:
+            return self._values.setdefault(key, value)
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + delta
+            return self._values[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def client_manager(self):
+        """The Socket.IO client manager to use, or None for the default in-process one."""
+        return None
+
+
+class HubBroker:
+    """Broker backed by the Unix-socket hub, shared by every worker process."""
+
+    def __init__(self, path):
+        self.path = path
+        self.origin = uuid.uuid4().hex
+        self._subscribers = {}
+        self._command_socket = None
+        self._command_lock = threading.Lock()
+        self._publish_socket = None
+        self._publish_lock = threading.Lock()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def _send(self, attribute, message):
+        """Send on the socket held in `attribute`, reconnecting once if the hub went away."""
+        for attempt in range(2):
+            if getattr(self, attribute) is None:
+                setattr(self, attribute, self._connect())
+            try:
+                _send_frame(getattr(self, attribute), message)
+                return
+            except (ConnectionError, OSError):
+                getattr(self, attribute).close()
+                setattr(self, attribute, None)
+                if attempt:
+                    raise
+
+    def _command(self, *command):
+        with self._command_lock:
+            self._send('_command_socket', command)
+            try:
+                return _recv_frame(self._command_socket)
+            except (ConnectionError, OSError, ValueError):
+                # The command may have been applied, so it is not retried.
+                self._command_socket.close()
+                self._command_socket = None
+                raise
+
+    def publish(self, channel, message):
+        """Send `message` to every process subscribed to `channel`, including this one."""
+        with self._publish_lock:
+            self._send('_publish_socket', ('publish', channel, message, self.origin))
+
+    def subscribe(self, channel, callback):
+        """Call `callback(message, origin)` for every message published on `channel`."""
+        with self._listener_lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+            if self._listener is None:
+                self._listener = self._connect()
+                threading.Thread(target=self._listen, args=(self._listener,),
+                                 name='broker-listener', daemon=True).start()
+            _send_frame(self._listener, ('subscribe', channel))
+
+    def _listen(self, sock):
+        while True:
+            try:
+                _, channel, message, origin = _recv_frame(sock)
+            except (ConnectionError, OSError, ValueError):
+                logger.warning('Lost the broker hub at %s, reconnecting', self.path)
+                sock.close()
+                sock = self._resubscribe()
+                continue
+            for callback in list(self._subscribers.get(channel, ())):
+                try:
+                    callback(message, origin)
+                except Exception:
+                    logger.exception('Broker subscriber for %r failed', channel)
+
+    def _resubscribe(self):
+        """Reconnect the listener to the hub, retrying with backoff, and subscribe again."""
+        delay = RECONNECT_DELAY
+        while True:
+            time.sleep(delay)
+            try:
+                with self._listener_lock:
+                    sock = self._connect()
+                    for channel in self._subscribers:
+                        _send_frame(sock, ('subscribe', channel))
+                    self._listener = sock
+                return sock
+            except OSError:
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def get(self, key):
+        return self._command('get', key)
+
+    def set(self, key, value):
+        return self._command('set', key, value)
+
+    def setdefault(self, key, value):
+        return self._command('setdefault', key, value)
+
+    def incr(self, key, delta=1):
+        return self._command('incr', key, delta)
+
+    def delete(self, key):
+        return self._command('delete', key)
+
+    def client_manager(self):
+        """A Socket.IO client manager that fans events out through the hub."""
+        return HubClientManager(self)
+
+
+class HubClientManager(socketio.PubSubManager):
+    """python-socketio pub/sub manager on top of a `HubBroker`."""
+
+    name = 'matchmeet-hub'
+
+    def __init__(self, broker, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.broker = broker
+        self._inbox = queue.Queue()
+
+    def initialize(self):
+        if not self.write_only:
+            self.broker.subscribe(self.channel, lambda message, origin: self._inbox.put(message))
+        super().initialize()
+
+    def _publish(self, data):
+        self.broker.publish(self.channel, data)
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+
+class RoomRegistry:
+    """Chat rooms and their member counts, kept in the broker so every worker sees them."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    @staticmethod
+    def _key(room):
+        return f'room:{room}:members'
+
+    def open(self, room):
+        """Make sure a room exists."""
+        self.broker.setdefault(self._key(room), 0)
+
+    def exists(self, room):
+        return self.broker.get(self._key(room)) is not None
+
+    def join(self, room):
+        """Count a member in and return the new member count."""
+        return self.broker.incr(self._key(room), 1)
+
+    def leave(self, room):
+        """Count a member out and return the new member count."""
+        return self.broker.incr(self._key(room), -1)
+
+    def close(self, room):
+        self.broker.delete(self._key(room))
+
+
+def create_broker(url=None):
+    """Build a broker from a URL: None or ``local://`` for in-process, ``unix:///path`` for the hub."""
+    url = url or os.environ.get('MATCHMEET_BROKER_URL') or 'local://'
+    if url.startswith('local://'):
+        return LocalBroker()
+    if url.startswith('unix://'):
+        return HubBroker(url[len('unix://'):])
+    raise ValueError(f'Unsupported broker URL: {url}')
+
+
+class Hub:
+    """The hub process: relays published messages and serves shared values."""
+
+    def __init__(self):
+        self.values = {}
+        self.subscribers = {}
+
+    async def handle(self, reader, writer):
+        channels = set()
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                (size,) = _HEADER.unpack(header)
+                payload = await reader.readexactly(size)
+                try:
+                    command = _loads(payload)
+                except ValueError:
+                    break
+                op = command[0]
+                if op == 'publish':
+                    frame = header + payload
+                    for subscriber in list(self.subscribers.get(command[1], ())):
+                        subscriber.write(frame)
+                    continue
+                if op == 'subscribe':
+                    channels.add(command[1])
+                    self.subscribers.setdefault(command[1], set()).add(writer)
+                    continue
+
+                if op == 'get':
+                    result = self.values.get(command[1])
+                elif op == 'set':
+                    self.values[command[1]] = command[2]
+                    result = None
+                elif op == 'setdefault':
+                    result = self.values.setdefault(command[1], command[2])
+                elif op == 'incr':
+                    result = self.values[command[1]] = self.values.get(command[1], 0) + command[2]
+                elif op == 'delete':
+                    result = self.values.pop(command[1], None)
+                else:
+                    result = None
+                reply = _dumps(result)
+                writer.write(_HEADER.pack(len(reply)) + reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for channel in channels:
+                self.subscribers.get(channel, set()).discard(writer)
+            writer.close()
+
+    async def serve(self, path):
+        _private_directory(os.path.dirname(os.path.abspath(path)))
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        os.chmod(path, 0o600)
+        async with server:
+            await server.serve_forever()
+
+
+def _private_directory(path):
+    """Create `path` readable only by this user, or check that an existing one is."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+        raise PermissionError(f'{path} must be owned by this user and closed to others (mode 0700)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the chat broker hub.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket path to listen on')
+    args = parser.parse_args()
+    print(f'Broker hub listening on {args.socket}')
+    asyncio.run(Hub().serve(args.socket))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""Bulk loading of users, profiles and activity.
+
+Records are streamed from a JSON array, an NDJSON file or a synthetic
+generator and written in large batches: ``COPY`` on Postgres, a multi-row
+``executemany`` INSERT elsewhere. The database assigns every ID, so a load
+can run next to live sign-ups: on Postgres each batch reserves its IDs from
+the tables' sequences before the ``COPY``, elsewhere the INSERT returns them.
+
+User records use the same keys as ``static/data.json``: username, password,
+firstname, lastname, photo, gender, description, birth_year, birth_mon,
+birth_day, plus optional interests, latitude and longitude.
+"""
+
+import csv
+import io
+import itertools
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, insert, select, text, update
+
+import model
+
+BATCH_SIZE = 10000
+DEFAULT_PHOTO = '../static/unkown_user.png'
+
+FIRST_NAMES = ['Elena', 'Stefan', 'Damon', 'Bonnie', 'Caroline', 'Tyler', 'Matt', 'Jeremy', 'Alaric',
+               'Jenna', 'Katherine', 'Enzo', 'Lexi', 'Rose', 'Anna', 'Klaus', 'Rebekah', 'Elijah', 'Kol',
+               'Hayley', 'Davina', 'Marcel', 'Freya', 'Vincent', 'Camille', 'Josh', 'Aiden', 'Liv', 'Luke']
+LAST_NAMES = ['Gilbert', 'Salvatore', 'Bennett', 'Forbes', 'Lockwood', 'Donovan', 'Saltzman', 'Sommers',
+              'Pierce', 'Petrova', 'Mikaelson', 'Marshall', 'Claire', 'Gerard', 'OConnell', 'Parker']
+INTERESTS = ['hiking', 'reading', 'music', 'travel', 'cooking', 'movies', 'running', 'yoga', 'art',
+             'photography', 'gaming', 'dancing', 'wine', 'coffee', 'dogs', 'cats', 'history', 'science',
+             'fashion', 'football', 'basketball', 'tennis', 'swimming', 'cycling', 'climbing', 'poetry',
+             'theatre', 'jazz', 'techno', 'gardening', 'volunteering', 'startups', 'camping', 'surfing']
+WORDS = ['love', 'weekend', 'adventure', 'quiet', 'city', 'friends', 'family', 'sunsets', 'books',
+         'laughing', 'honest', 'curious', 'spontaneous', 'loyal', 'coffee', 'road', 'trips', 'nights']
+CITIES = [(40.7128, -74.0060), (34.0522, -118.2437), (41.8781, -87.6298), (29.7604, -95.3698),
+          (37.7749, -122.4194), (47.6062, -122.3321), (25.7617, -80.1918), (42.3601, -71.0589)]
+
+
+def read_records(path):
+    """Stream user records from a JSON array file or an NDJSON file (one record per line)."""
+    with open(path, encoding='utf-8') as file:
+        first = file.read(1)
+        while first.isspace():
+            first = file.read(1)
+        file.seek(0)
+        if first == '[':
+            yield from json.load(file)
+            return
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def synthetic_records(count, seed=0):
+    """Generate `count` realistic-looking user records."""
+    rng = random.Random(seed)
+    for index in range(count):
+        firstname, lastname = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        lat, lon = rng.choice(CITIES)
+        yield {
+            'username': f'{firstname.lower()}.{lastname.lower()}.{seed}.{index}',
+            'password': '1234',
+            'firstname': firstname,
+            'lastname': lastname,
+            'photo': DEFAULT_PHOTO,
+            'gender': rng.randint(0, 1),
+            'description': ' '.join(rng.choices(WORDS, k=rng.randint(5, 20))),
+            'birth_year': rng.randint(1960, 2005),
+            'birth_mon': rng.randint(1, 12),
+            'birth_day': rng.randint(1, 28),
+            'interests': rng.sample(INTERESTS, rng.randint(2, 8)),
+            'latitude': round(rng.gauss(lat, 0.2), 5),
+            'longitude': round(rng.gauss(lon, 0.2), 5),
+        }
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _dialect():
+    return model.db.session.get_bind().dialect.name
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        escaped = (str(item).replace('\\', '\\\\').replace('"', '\\"') for item in value)
+        return '{' + ','.join(f'"{item}"' for item in escaped) + '}'
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def write_rows(table, rows):
+    """Write a batch of row dicts to `table` with COPY on Postgres and executemany elsewhere."""
+    if not rows:
+        return
+    if _dialect() != 'postgresql':
+        model.db.session.execute(insert(table), rows)
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([_copy_value(row[column]) for column in columns])
+    buffer.seek(0)
+    cursor = model.db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')', buffer)
+
+
+def _reserve_ids(table, count):
+    """Take `count` IDs from a Postgres table's sequence; concurrent inserts never get them."""
+    return sorted(model.db.session.execute(
+        text(f"SELECT nextval(pg_get_serial_sequence('{table.name}', 'id')) FROM generate_series(1, :count)"),
+        {'count': count}).scalars())
+
+
+def _insert_returning_ids(table, rows):
+    """Insert rows without IDs and return the IDs the database gave them, in row order."""
+    return list(model.db.session.execute(
+        insert(table).returning(table.c.id, sort_by_parameter_order=True), rows).scalars())
+
+
+def load_users(records, batch_size=BATCH_SIZE):
+    """Insert users and their profiles in batches.
+
+    Returns:
+        The list of new user IDs, in record order.
+    """
+    model.db.session().use_primary()
+    users_table, profiles_table = model.User.__table__, model.UserProfile.__table__
+    user_ids = []
+    for batch in _batches(records, batch_size):
+        users, profiles = [], []
+        for record in batch:
+            users.append({'username': record['username'], 'password': record['password'],
+                          'email': record.get('email')})
+            profiles.append({
+                'firstname': record.get('firstname'),
+                'lastname': record.get('lastname'),
+                'birthday': datetime(record.get('birth_year', 1900), record.get('birth_mon', 1),
+                                     record.get('birth_day', 1)),
+                'gender': record.get('gender', 0),
+                'photo': record.get('photo') or DEFAULT_PHOTO,
+                'description': record.get('description', ''),
+                'interests': record.get('interests', []),
+                'latitude': record.get('latitude'),
+                'longitude': record.get('longitude'),
+            })
+        if _dialect() == 'postgresql':
+            batch_user_ids = _reserve_ids(users_table, len(users))
+            profile_ids = _reserve_ids(profiles_table, len(profiles))
+            for user, profile, user_id, profile_id in zip(users, profiles, batch_user_ids, profile_ids):
+                user.update(id=user_id, profile=profile_id)
+                profile.update(id=profile_id, user_id=user_id)
+            write_rows(users_table, users)
+            write_rows(profiles_table, profiles)
+        else:
+            batch_user_ids = _insert_returning_ids(users_table, users)
+            for profile, user_id in zip(profiles, batch_user_ids):
+                profile['user_id'] = user_id
+            profile_ids = _insert_returning_ids(profiles_table, profiles)
+            link = update(users_table).where(users_table.c.id == bindparam('user_id')) \
+                .values(profile=bindparam('profile_id'))
+            model.db.session.execute(link, [{'user_id': user_id, 'profile_id': profile_id}
+                                            for user_id, profile_id in zip(batch_user_ids, profile_ids)])
+        model.db.session.commit()
+        user_ids.extend(batch_user_ids)
+    return user_ids
+
+
+def load_activity(user_ids, likes_per_user=20, match_rate=0.2, messages_per_match=5, seed=0,
+                  batch_size=BATCH_SIZE):
+    """Generate a likes, matches and messages graph between `user_ids`.
+
+    Each user likes `likes_per_user` random users. A `match_rate` share of those likes is
+    returned, and so is any like on a user who had already liked back; every mutual pair is a
+    match with a short conversation.
+
+    Returns:
+        A dict with the number of likes, matches and messages written.
+    """
+    rng = random.Random(seed)
+    user_ids = list(user_ids)
+    now = datetime.utcnow()
+    likes, seen, matches, messages, inbox_entries = [], [], [], [], []
+    counts = {'likes': 0, 'matches': 0, 'messages': 0}
+    liked = set()
+
+    def flush(force=False):
+        if not force and len(likes) < batch_size:
+            return
+        write_rows(model.Like.__table__, likes)
+        write_rows(model.Seen.__table__, seen)
+        write_rows(model.Match.__table__, matches)
+        write_rows(model.Message.__table__, messages)
+        write_rows(model.InboxEntry.__table__, inbox_entries)
+        model.db.session.commit()
+        for rows in (likes, seen, matches, messages, inbox_entries):
+            rows.clear()
+
+    for user_id in user_ids:
+        for target_id in rng.sample(user_ids, min(likes_per_user, len(user_ids))):
+            if target_id == user_id or (user_id, target_id) in liked:
+                continue
+            like_time = now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+            pairs = [(user_id, target_id)]
+            # A like back on an earlier like completes a match on its own.
+            mutual = (target_id, user_id) in liked
+            if not mutual and rng.random() < match_rate:
+                pairs.append((target_id, user_id))
+                mutual = True
+            for liker, likee in pairs:
+                liked.add((liker, likee))
+                likes.append({'user_id': liker, 'target_id': likee, 'like_time': like_time})
+                seen.append({'user_id': liker, 'seen_user_id': likee, 'seen_time': like_time})
+            counts['likes'] += len(pairs)
+            if mutual:
+                counts['matches'] += 1
+                counts['messages'] += _add_match(rng, user_id, target_id, like_time, messages_per_match,
+                                                 matches, messages, inbox_entries)
+        flush()
+    flush(force=True)
+    _fill_peer_names()
+    return counts
+
+
+def _add_match(rng, user_id, target_id, match_time, messages_per_match, matches, messages, inbox_entries):
+    conversation = model.conversation_id(user_id, target_id)
+    send_time = int(match_time.timestamp() * 1000)
+    last = None
+    count = rng.randint(0, messages_per_match * 2)
+    for _ in range(count):
+        send_time += rng.randint(1000, 3600 * 1000)
+        sender, receiver = (user_id, target_id) if rng.random() < 0.5 else (target_id, user_id)
+        last = {'conversation_id': conversation, 'sender_id': sender, 'receiver_id': receiver,
+                'message': ' '.join(rng.choices(WORDS, k=rng.randint(1, 12))), 'send_time': send_time}
+        messages.append(last)
+    for owner, peer in ((user_id, target_id), (target_id, user_id)):
+        matches.append({'user_id': owner, 'match_id': peer, 'match_time': match_time})
+        inbox_entries.append({
+            'user_id': owner,
+            'peer_id': peer,
+            # Filled in from the profiles by `_fill_peer_names` once everything is written.
+            'peer_name': '',
+            'peer_photo': DEFAULT_PHOTO,
+            'last_message': last['message'] if last else None,
+            'last_message_time': last['send_time'] if last else None,
+            'last_activity': last['send_time'] if last else int(match_time.timestamp() * 1000),
+            'unread_count': 0,
+        })
+    return count
+
+
+def _fill_peer_names():
+    entry, profile = model.InboxEntry.__table__, model.UserProfile.__table__
+    peer = profile.c.user_id == entry.c.peer_id
+    model.db.session.execute(
+        update(entry).where(entry.c.peer_name == '')
+        .values(peer_name=select(profile.c.firstname + ' ' + profile.c.lastname).where(peer).scalar_subquery(),
+                peer_photo=select(profile.c.photo).where(peer).scalar_subquery()))
+    model.db.session.commit()
+
+
+def run(records, with_activity=False, likes_per_user=20, match_rate=0.2, messages_per_match=5, seed=0,
+        batch_size=BATCH_SIZE, log=print):
+    """Load `records` and optionally generate activity between the new users, logging timings."""
+    started = time.perf_counter()
+    user_ids = load_users(records, batch_size)
+    log(f'Loaded {len(user_ids)} users in {time.perf_counter() - started:.1f}s')
+    if with_activity and user_ids:
+        started = time.perf_counter()
+        counts = load_activity(user_ids, likes_per_user, match_rate, messages_per_match, seed, batch_size)
+        log(f'Generated {counts["likes"]} likes, {counts["matches"]} matches and {counts["messages"]} '
+            f'messages in {time.perf_counter() - started:.1f}s')
+    return user_ids
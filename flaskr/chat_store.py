@@ -0,0 +1,176 @@
+"""Chat storage engine.
+
+Every open room keeps its latest messages in a fixed-size ring buffer, so
+joining a room shows recent history without a query and a busy room never
+grows without bound. New messages are written to the `Message` table in
+batches by a background thread, either when enough of them are pending or
+after a short interval. Older history is read from the database on demand.
+"""
+
+import atexit
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import insert
+
+import inbox
+import model
+
+HISTORY_SIZE = 50
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 2.0
+
+
+def now_ms():
+    """The current time in milliseconds, as stored in `Message.send_time`."""
+    return int(time.time() * 1000)
+
+
+def room_members(room):
+    """Return the two user IDs of a room, which is named by its `model.conversation_id`."""
+    first, _, second = room.partition('-')
+    return int(first), int(second or first)
+
+
+class ChatStore:
+    """Ring-buffered chat history with write-behind persistence."""
+
+    def __init__(self, app=None, history_size=HISTORY_SIZE, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.history_size = history_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.app = None
+        self._buffers = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Bind the store to a Flask app and flush pending messages on exit."""
+        self.app = app
+        app.extensions['chat_store'] = self
+        atexit.register(self.flush)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='chat-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Flushing chat messages failed')
+
+    def history(self, room):
+        """Return the buffered recent messages of a room, oldest first.
+
+        The buffer is filled from the database the first time a room is opened.
+        """
+        buffer = self._buffer(room)
+        with self._lock:
+            return list(buffer)
+
+    def _buffer(self, room):
+        """Return a room's ring buffer, filling it from the database if this worker has none yet."""
+        with self._lock:
+            buffer = self._buffers.get(room)
+        if buffer is None:
+            loaded = self._load_recent(room)
+            with self._lock:
+                buffer = self._buffers.setdefault(room, loaded)
+        return buffer
+
+    def append(self, room, sender_id, name, text):
+        """Add a message to a room and queue it for persistence.
+
+        Returns:
+            The message as sent to clients.
+        """
+        first, second = room_members(room)
+        receiver_id = second if first == sender_id else first
+        buffer = self._buffer(room)
+        content = {'name': name, 'message': text, 'sender_id': sender_id, 'send_time': now_ms()}
+        with self._lock:
+            buffer.append(content)
+            self._pending.append({
+                'conversation_id': room,
+                'sender_id': sender_id,
+                'receiver_id': receiver_id,
+                'message': text,
+                'send_time': content['send_time'],
+            })
+            should_flush = len(self._pending) >= self.flush_size
+        self._start()
+        if should_flush:
+            self._wake.set()
+        return content
+
+    def remember(self, room, content):
+        """Add a message persisted by another worker to the buffer of a room open here."""
+        with self._lock:
+            buffer = self._buffers.get(room)
+            if buffer is not None:
+                buffer.append(content)
+
+    def close_room(self, room):
+        """Release the buffer of a room nobody is in. Pending messages are still flushed."""
+        with self._lock:
+            self._buffers.pop(room, None)
+
+    def flush(self):
+        """Write all pending messages with one multi-row insert."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            try:
+                with self.app.app_context():
+                    model.db.session.execute(insert(model.Message), pending)
+                    inbox.record_messages(pending)
+                    model.db.session.commit()
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = pending
+                raise
+            return len(pending)
+
+    def older(self, room, cursor, limit=HISTORY_SIZE):
+        """Load a page of a room's messages older than `cursor`.
+
+        `cursor` is either a cursor returned by a previous call or the ``send_time`` of the
+        oldest message the client already has.
+
+        Returns:
+            A tuple `(messages, next_cursor)` with messages oldest first.
+        """
+        self.flush()
+        first, second = room_members(room)
+        messages, next_cursor = model.Message.get_page(room, limit, cursor)
+        return self._to_content(first, second, reversed(messages)), next_cursor
+
+    def _load_recent(self, room):
+        # Messages from an earlier visit may still be waiting for the flusher.
+        self.flush()
+        first, second = room_members(room)
+        messages, _ = model.Message.get_page(room, self.history_size)
+        return deque(self._to_content(first, second, reversed(messages)), maxlen=self.history_size)
+
+    def _to_content(self, first, second, messages):
+        names = {user.id: user.username for user in model.User.get_all([first, second])}
+        return [{
+            'name': names.get(message.sender_id, ''),
+            'message': message.message,
+            'sender_id': message.sender_id,
+            'send_time': message.send_time,
+        } for message in messages]
@@ -0,0 +1,359 @@
+"""Candidate deck for the swipe flow.
+
+Keeps an ordered queue of the next eligible profiles for each user in memory,
+so showing the next card does not have to ship the user's whole swipe history
+to the database. Decks are refilled in the background once they run low.
+"""
+
+import threading
+from collections import deque
+
+import geo
+import model
+
+DECK_SIZE = 20
+LOW_WATER_MARK = 5
+SCAN_BATCH_SIZE = 200
+RECOMMENDATION_WINDOW = 100
+
+
+class _Deck:
+    """The queue of candidate user IDs for one user."""
+
+    def __init__(self):
+        self.queue = deque()
+        self.cursor = 0
+        self.exhausted = False
+        # Users who signed up after the deck ran out, still to be checked against its filters.
+        self.arrivals = []
+        self.refilling = False
+        # Set whenever no refill is running, so callers can wait for one to finish.
+        self.idle = threading.Event()
+        self.idle.set()
+
+
+class CandidateDeck:
+    """Per-user queues of candidate profiles.
+
+    Candidates are found by walking ``user_profile`` in ``user_id`` order from a
+    per-user cursor, so every refill only looks at rows the deck has not looked
+    at before. Swipes pop candidates from the front of the queue. A deck that ran
+    out of profiles only checks users who signed up since, not the whole table.
+
+    If a `ranker` (an `ranking.InterestFeatureStore`) is given, each refill
+    queues the most similar eligible profiles out of all profiles, by
+    interest similarity, instead of scanning by ID.
+
+    If a `geo_index` (a `geo.GeoGrid`) is given and the app sets
+    ``MATCH_RADIUS_KM``, users with a location get the nearest unseen profiles
+    within that radius instead, nearest first.
+
+    If a `filter_engine` (a `filters.FilterEngine`) is given, each user's
+    preferences are pushed into the candidate queries.
+
+    If a `seen_store` (a `seenset.SeenStore`) is given, swiped profiles are
+    filtered out against it instead of anti-joining the ``seen`` table, and
+    an exhausted deck starts over once some of the user's swipes expired.
+
+    If the app sets ``DECK_RECOMMENDATIONS``, the profiles the recommendation
+    job (see `recommend`) picked for the user are queued first, best first.
+    """
+
+    def __init__(self, app=None, size=DECK_SIZE, low_water_mark=LOW_WATER_MARK, ranker=None,
+                 geo_index=None, filter_engine=None, seen_store=None):
+        self.size = size
+        self.low_water_mark = low_water_mark
+        self.ranker = ranker
+        self.geo_index = geo_index
+        self.filter_engine = filter_engine
+        self.seen_store = seen_store
+        self.app = None
+        self._decks = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Bind the deck to a Flask app so background refills get an app context."""
+        self.app = app
+        app.extensions['candidate_deck'] = self
+
+    def _get_deck(self, user_id):
+        with self._lock:
+            deck = self._decks.get(user_id)
+            if deck is None:
+                deck = self._decks[user_id] = _Deck()
+            return deck
+
+    def peek(self, user_id):
+        """Return the user ID of the next candidate for a user, or None if there are none left.
+
+        An empty deck is refilled first; if a background refill is already running, it is waited for.
+        """
+        deck = self._get_deck(user_id)
+        self._resurface(user_id, deck)
+        with self._lock:
+            empty = not deck.queue and self._can_grow(deck)
+            refill = empty and self._start_refill(deck)
+        if refill:
+            self._refill(user_id, deck)
+        elif empty:
+            deck.idle.wait()
+        with self._lock:
+            return deck.queue[0] if deck.queue else None
+
+    def upcoming(self, user_id, limit):
+        """Return up to `limit` next candidates for a user, refilling the deck first if it runs short.
+
+        At most the deck size is returned. If a background refill is already running, the
+        candidates queued so far are returned instead of waiting for it.
+        """
+        deck = self._get_deck(user_id)
+        self._resurface(user_id, deck)
+        with self._lock:
+            refill = len(deck.queue) < min(limit, self.size) and self._can_grow(deck) and self._start_refill(deck)
+        if refill:
+            self._refill(user_id, deck)
+        with self._lock:
+            return list(deck.queue)[:limit]
+
+    def pop(self, user_id, target_id):
+        """Remove a candidate from a user's deck after it was liked or disliked."""
+        if self.seen_store is not None:
+            self.seen_store.add(user_id, [target_id])
+        deck = self._get_deck(user_id)
+        with self._lock:
+            if deck.queue and deck.queue[0] == target_id:
+                deck.queue.popleft()
+            else:
+                try:
+                    deck.queue.remove(target_id)
+                except ValueError:
+                    pass
+            needs_refill = (len(deck.queue) < self.low_water_mark
+                            and self._can_grow(deck) and self._start_refill(deck))
+        if needs_refill:
+            self._refill_in_background(user_id, deck)
+
+    def discard(self, user_id, target_ids):
+        """Forget candidates a user swiped on through another worker.
+
+        Unlike `pop`, this never creates or refills a deck; users swiping elsewhere may never open one here.
+        """
+        if self.seen_store is not None:
+            self.seen_store.add(user_id, target_ids)
+        with self._lock:
+            deck = self._decks.get(user_id)
+            if deck is not None:
+                for target_id in target_ids:
+                    try:
+                        deck.queue.remove(target_id)
+                    except ValueError:
+                        pass
+
+    def on_new_user(self, user_id):
+        """Offer a newly registered user to the decks that had run out of candidates.
+
+        Their next refill checks only this user against the deck's filters instead of scanning again.
+        """
+        with self._lock:
+            for owner, deck in self._decks.items():
+                if deck.exhausted and owner != user_id:
+                    deck.arrivals.append(user_id)
+
+    def invalidate(self, user_id):
+        """Drop a user's deck so it is rebuilt from scratch on the next swipe."""
+        with self._lock:
+            self._decks.pop(user_id, None)
+
+    def _resurface(self, user_id, deck):
+        """Restart an exhausted deck from the first profile once some of the user's swipes expired."""
+        with self._lock:
+            exhausted = deck.exhausted
+        if exhausted and self.seen_store is not None and self.seen_store.expire(user_id):
+            with self._lock:
+                deck.cursor = 0
+                deck.exhausted = False
+                deck.arrivals = []
+
+    @staticmethod
+    def _can_grow(deck):
+        """Whether a refill could find anything for the deck. Call with the lock held."""
+        return not deck.exhausted or bool(deck.arrivals)
+
+    @staticmethod
+    def _start_refill(deck):
+        """Claim the deck for a refill unless one is already running. Call with the lock held."""
+        if deck.refilling:
+            return False
+        deck.refilling = True
+        deck.idle.clear()
+        return True
+
+    def _refill_in_background(self, user_id, deck):
+        def run():
+            with self.app.app_context():
+                self._refill(user_id, deck)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+    def _refill(self, user_id, deck):
+        """Top the deck up to its target size and record whether candidates ran out.
+
+        Only the caller that claimed the deck with `_start_refill` may run this.
+        """
+        try:
+            with self._lock:
+                excluded = set(deck.queue)
+                excluded.add(user_id)
+                cursor = deck.cursor
+                missing = self.size - len(deck.queue)
+                arrivals = deck.arrivals if deck.exhausted else None
+                deck.arrivals = []
+
+            radius_km = self.app.config.get('MATCH_RADIUS_KM') if self.app is not None else None
+            origin = None
+            if self.geo_index is not None and radius_km:
+                if not self.geo_index.loaded:
+                    geo.load_geo_grid(self.geo_index)
+                origin = self.geo_index.location(user_id)
+
+            if arrivals is not None:
+                found, exhausted = self._admit_arrivals(user_id, arrivals, excluded, origin, radius_km), True
+                # Keep the eligible arrivals that do not fit for the next refill.
+                found, arrivals = found[:missing], found[missing:]
+            elif origin is not None:
+                found, exhausted = self._find_nearby(user_id, origin, radius_km, excluded, missing)
+            else:
+                recommended = []
+                if self.app is not None and self.app.config.get('DECK_RECOMMENDATIONS'):
+                    recommended = self._recommended(user_id, excluded, missing)
+                    excluded.update(recommended)
+                missing -= len(recommended)
+                found, exhausted = [], False
+                if missing > 0 and self.ranker is not None:
+                    found, exhausted = self._find_ranked(user_id, excluded, missing)
+                elif missing > 0:
+                    found, cursor, exhausted = self._scan(user_id, cursor, excluded, missing)
+                found = recommended + found
+
+            with self._lock:
+                queued = set(deck.queue)
+                for candidate in found:
+                    if candidate not in queued:
+                        queued.add(candidate)
+                        deck.queue.append(candidate)
+                deck.cursor = cursor
+                deck.exhausted = exhausted
+                if arrivals and exhausted:
+                    deck.arrivals[:0] = arrivals
+        finally:
+            with self._lock:
+                deck.refilling = False
+                deck.idle.set()
+
+    def _criteria(self, user_id):
+        return self.filter_engine.criteria_for(user_id) if self.filter_engine is not None else None
+
+    def _seen_among(self, user_id, candidate_ids):
+        if not candidate_ids:
+            return set()
+        if self.seen_store is not None:
+            return self.seen_store.seen_among(user_id, candidate_ids)
+        return model.Seen.get_seen_among(user_id, candidate_ids)
+
+    def _recommended(self, user_id, excluded, missing):
+        """Up to `missing` recommended candidates the user has not swiped on and would accept, best first."""
+        candidates = [candidate for candidate in model.Recommendation.get_for_user(user_id, RECOMMENDATION_WINDOW)
+                      if candidate not in excluded]
+        seen = self._seen_among(user_id, candidates)
+        candidates = [candidate for candidate in candidates if candidate not in seen]
+        criteria = self._criteria(user_id)
+        if criteria and candidates:
+            allowed = self.filter_engine.allowed_among(candidates, criteria)
+            candidates = [candidate for candidate in candidates if candidate in allowed]
+        return candidates[:missing]
+
+    def _scan(self, user_id, cursor, excluded, missing):
+        """Scan forward from the deck's cursor until enough candidates are found or the table runs out."""
+        criteria = self._criteria(user_id)
+        # Without a seen store, swiped profiles are skipped in SQL.
+        unseen_by = user_id if self.seen_store is None else None
+        found = []
+        exhausted = False
+        while len(found) < missing:
+            if criteria:
+                batch, next_cursor = self.filter_engine.scan(user_id, cursor, SCAN_BATCH_SIZE, criteria,
+                                                             skip_seen=self.seen_store is None)
+            else:
+                batch = model.UserProfile.get_user_ids_after(cursor, SCAN_BATCH_SIZE, unseen_by=unseen_by)
+                next_cursor = batch[-1] if batch else None
+            if next_cursor is None:
+                exhausted = True
+                break
+            cursor = next_cursor
+            if self.seen_store is not None:
+                batch = self.seen_store.unseen(user_id, batch)
+            found.extend(candidate for candidate in batch if candidate not in excluded)
+        if len(found) > missing:
+            # Resume after the last candidate kept, so the rest of the batch is found next time.
+            found = found[:missing]
+            cursor = found[-1]
+        return found, cursor, exhausted
+
+    def _find_ranked(self, user_id, excluded, missing):
+        """Collect the most similar eligible candidates out of every profile, best first.
+
+        Asks the ranker for a growing top-k until enough of it is unseen and matches the
+        user's preferences, or every profile has been considered.
+        """
+        if not self.ranker.loaded:
+            import ranking
+
+            ranking.load_feature_store(self.ranker)
+        criteria = self._criteria(user_id)
+        limit = (max(missing, 1) + len(excluded)) * 2
+        while True:
+            ranked = self.ranker.top_k(user_id, limit)
+            candidates = [candidate for candidate, _ in ranked if candidate not in excluded]
+            seen = self._seen_among(user_id, candidates)
+            candidates = [candidate for candidate in candidates if candidate not in seen]
+            if criteria and candidates:
+                allowed = self.filter_engine.allowed_among(candidates, criteria)
+                candidates = [candidate for candidate in candidates if candidate in allowed]
+            exhausted = len(ranked) < limit
+            if len(candidates) >= missing or exhausted:
+                return candidates[:missing], exhausted and len(candidates) <= missing
+            limit *= 4
+
+    def _admit_arrivals(self, user_id, arrivals, excluded, origin, radius_km):
+        """The newly registered users the deck's owner has not swiped on and would accept, in order."""
+        candidates = [candidate for candidate in dict.fromkeys(arrivals) if candidate not in excluded]
+        if origin is not None:
+            locations = {candidate: self.geo_index.location(candidate) for candidate in candidates}
+            candidates = [candidate for candidate in candidates if locations[candidate] is not None
+                          and geo.haversine_km(*origin, *locations[candidate]) <= radius_km]
+        seen = self._seen_among(user_id, candidates)
+        candidates = [candidate for candidate in candidates if candidate not in seen]
+        criteria = self._criteria(user_id)
+        if criteria and candidates:
+            allowed = self.filter_engine.allowed_among(candidates, criteria)
+            candidates = [candidate for candidate in candidates if candidate in allowed]
+        return candidates
+
+    def _find_nearby(self, user_id, origin, radius_km, excluded, missing):
+        """Collect the nearest unseen candidates within `radius_km`, nearest first."""
+        limit = max(missing, 1) * 2
+        while True:
+            nearby = self.geo_index.within(origin[0], origin[1], radius_km, limit=limit, exclude=excluded)
+            candidates = [candidate for candidate, _ in nearby]
+            seen = self._seen_among(user_id, candidates)
+            criteria = self._criteria(user_id)
+            allowed = self.filter_engine.allowed_among(candidates, criteria) if criteria else None
+            found = [candidate for candidate in candidates
+                     if candidate not in seen and (allowed is None or candidate in allowed)]
+            exhausted = len(nearby) < limit
+            if len(found) >= missing or exhausted:
+                return found[:missing], exhausted and len(found) <= missing
+            limit *= 4
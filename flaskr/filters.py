@@ -0,0 +1,215 @@
+"""Preference filters for candidate profiles.
+
+A user's `model.Preference` becomes a `Criteria` that is pushed into the
+candidate query instead of being checked after the fact:
+
+* an age range becomes a ``birthday`` date range on its btree index,
+* gender is an equality on the ``(gender, user_id)`` index, which keeps the
+  deck's keyset order,
+* required interests use the GIN index on Postgres (``interests @> ...``).
+  Other databases get an in-memory inverted index from interest to user IDs,
+  and the query only looks at the IDs holding every required interest.
+"""
+
+import bisect
+import threading
+from datetime import date, timedelta
+
+import model
+
+# Interest combinations whose sorted holders `InterestIndex` keeps.
+MATCHING_CACHE_SIZE = 1024
+
+
+def _years_before(day, years):
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:  # 29 February in a non-leap year.
+        return day.replace(year=day.year - years, day=28)
+
+
+def birthday_range(min_age=None, max_age=None, today=None):
+    """Turn an age range into `(born_after, born_on_or_before)` dates; either bound may be None."""
+    today = today or date.today()
+    born_on_or_before = _years_before(today, min_age) if min_age is not None else None
+    born_after = _years_before(today, max_age + 1) if max_age is not None else None
+    return born_after, born_on_or_before
+
+
+class Criteria:
+    """What a user wants to see: an age range, a gender and interests every candidate must have."""
+
+    __slots__ = ('min_age', 'max_age', 'gender', 'interests')
+
+    def __init__(self, min_age=None, max_age=None, gender=None, interests=()):
+        self.min_age = min_age
+        self.max_age = max_age
+        self.gender = gender
+        self.interests = tuple(sorted(set(interests or ())))
+
+    @classmethod
+    def from_preference(cls, preference):
+        if preference is None:
+            return cls()
+        return cls(preference.min_age, preference.max_age, preference.gender, preference.interests)
+
+    def __bool__(self):
+        return any(value is not None for value in (self.min_age, self.max_age, self.gender)) or bool(self.interests)
+
+    def to_dict(self):
+        return {'min_age': self.min_age, 'max_age': self.max_age, 'gender': self.gender,
+                'interests': list(self.interests)}
+
+
+class InterestIndex:
+    """Inverted index from interest to the set of user IDs listing it.
+
+    The sorted holders of each requested interest combination are cached until a profile with
+    one of those interests changes, so a deck scan can bisect the same list batch after batch.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._interests = {}
+        self._matching = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def upsert(self, user_id, interests):
+        """Add or replace the interests of one profile."""
+        with self._lock:
+            self._discard(user_id)
+            interests = set(interests or ())
+            self._interests[user_id] = interests
+            for interest in interests:
+                self._users.setdefault(interest, set()).add(user_id)
+            self._forget_matching(interests)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def _forget_matching(self, interests):
+        if self._matching and interests:
+            for key in [key for key in self._matching if not key.isdisjoint(interests)]:
+                del self._matching[key]
+
+    def _discard(self, user_id):
+        interests = self._interests.pop(user_id, ())
+        self._forget_matching(interests)
+        for interest in interests:
+            users = self._users.get(interest)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._users[interest]
+
+    def load(self, profiles):
+        """Bulk load `(user_id, interests)` pairs."""
+        for user_id, interests in profiles:
+            self.upsert(user_id, interests)
+        self.loaded = True
+
+    def matching(self, interests):
+        """Return the sorted user IDs that have every interest in `interests`. Do not modify the list."""
+        key = frozenset(interests)
+        with self._lock:
+            holders = self._matching.get(key)
+            if holders is not None:
+                return holders
+            sets = sorted((self._users.get(interest, set()) for interest in key), key=len)
+            holders = sorted(sets[0].intersection(*sets[1:])) if sets else []
+            if len(self._matching) >= MATCHING_CACHE_SIZE:
+                del self._matching[next(iter(self._matching))]
+            self._matching[key] = holders
+            return holders
+
+
+def load_interest_index(index):
+    """Fill an interest index from every `UserProfile` in the database."""
+    query = model.db.session.query(model.UserProfile.user_id, model.UserProfile.interests)
+    index.load((row.user_id, row.interests) for row in query.yield_per(10000))
+    return index
+
+
+class FilterEngine:
+    """Turns users' preferences into candidate query conditions."""
+
+    def __init__(self, interest_index=None):
+        self.interest_index = interest_index if interest_index is not None else InterestIndex()
+        self._criteria = {}
+        self._lock = threading.Lock()
+
+    def criteria_for(self, user_id):
+        """Return a user's `Criteria`, cached after the first lookup."""
+        with self._lock:
+            criteria = self._criteria.get(user_id)
+        if criteria is None:
+            criteria = Criteria.from_preference(model.Preference.get_by_user_id(user_id))
+            with self._lock:
+                self._criteria[user_id] = criteria
+        return criteria
+
+    def forget(self, user_id):
+        """Drop a user's cached criteria after their preferences changed."""
+        with self._lock:
+            self._criteria.pop(user_id, None)
+
+    @staticmethod
+    def _interests_in_sql():
+        return model.db.session.get_bind().dialect.name == 'postgresql'
+
+    def conditions(self, criteria, today=None):
+        """SQL conditions on `UserProfile` for everything in `criteria` the database can index."""
+        profile = model.UserProfile
+        conditions = []
+        born_after, born_on_or_before = birthday_range(criteria.min_age, criteria.max_age, today)
+        if born_after is not None:
+            conditions.append(profile.birthday >= born_after + timedelta(days=1))
+        if born_on_or_before is not None:
+            conditions.append(profile.birthday < born_on_or_before + timedelta(days=1))
+        if criteria.gender is not None:
+            conditions.append(profile.gender == criteria.gender)
+        if criteria.interests and self._interests_in_sql():
+            conditions.append(profile.interests.contains(list(criteria.interests)))
+        return conditions
+
+    def scan(self, user_id, cursor, limit, criteria, skip_seen=True):
+        """Fetch the next candidate IDs after `cursor` that satisfy `criteria`.
+
+        Profiles the user has already swiped on are skipped in SQL unless `skip_seen` is False.
+
+        Returns:
+            A tuple `(user_ids, next_cursor)`. `next_cursor` is None once nothing is left; a
+            batch can be empty while the scan is not finished yet.
+        """
+        conditions = self.conditions(criteria)
+        unseen_by = user_id if skip_seen else None
+        if criteria.interests and not self._interests_in_sql():
+            if not self.interest_index.loaded:
+                load_interest_index(self.interest_index)
+            holders = self.interest_index.matching(criteria.interests)
+            start = bisect.bisect_right(holders, cursor)
+            chunk = holders[start:start + limit]
+            if not chunk:
+                return [], None
+            conditions.append(model.UserProfile.user_id.in_(chunk))
+            return model.UserProfile.get_user_ids_after(cursor, limit, unseen_by, conditions), chunk[-1]
+        batch = model.UserProfile.get_user_ids_after(cursor, limit, unseen_by, conditions)
+        return batch, (batch[-1] if batch else None)
+
+    def allowed_among(self, candidate_ids, criteria):
+        """Return the subset of `candidate_ids` that satisfies `criteria`."""
+        candidate_ids = list(candidate_ids)
+        if not criteria or not candidate_ids:
+            return set(candidate_ids)
+        if criteria.interests and not self._interests_in_sql():
+            if not self.interest_index.loaded:
+                load_interest_index(self.interest_index)
+            holders = set(self.interest_index.matching(criteria.interests))
+            candidate_ids = [candidate for candidate in candidate_ids if candidate in holders]
+            if not candidate_ids:
+                return set()
+        rows = model.db.session.query(model.UserProfile.user_id).filter(
+            model.UserProfile.user_id.in_(candidate_ids), *self.conditions(criteria))
+        return {row.user_id for row in rows}
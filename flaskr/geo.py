@@ -0,0 +1,209 @@
+"""Location-based candidate lookup.
+
+Profiles with coordinates are bucketed into a fixed grid of latitude/longitude
+cells. A radius query only visits the cells overlapping the circle's bounding
+box and runs the exact haversine check on the points inside them, instead of
+computing the distance to every profile. Nearest-first queries with a limit
+walk the cells in rings outwards from the centre and stop as soon as no
+unvisited cell can hold a closer profile.
+"""
+
+import heapq
+import math
+import threading
+
+import model
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_KM / 180
+DEFAULT_CELL_KM = 5.0
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """Return `(min_lat, max_lat, min_lon, max_lon)` of a box containing the circle.
+
+    The longitude half-width is that of the circle's widest point, which lies poleward of
+    `lat`, so it is wider than `radius_km` measured along the parallel through the centre.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat < 1e-6 or abs(lat) + dlat >= 90:
+        return max(-90.0, lat - dlat), min(90.0, lat + dlat), -180.0, 180.0
+    ratio = min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / cos_lat)
+    dlon = min(180.0, math.degrees(math.asin(ratio)))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+class GeoGrid:
+    """A uniform lat/lon grid of profile locations, updatable one profile at a time."""
+
+    def __init__(self, cell_km=DEFAULT_CELL_KM):
+        self.cell_deg = cell_km / KM_PER_DEGREE_LAT
+        self._cells = {}
+        self._locations = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._locations)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def upsert(self, user_id, lat, lon):
+        """Add or move a profile. Passing `None` coordinates removes it."""
+        with self._lock:
+            self._discard(user_id)
+            if lat is None or lon is None:
+                return
+            self._locations[user_id] = (lat, lon)
+            self._cells.setdefault(self._cell(lat, lon), {})[user_id] = (lat, lon)
+
+    def remove(self, user_id):
+        """Forget a profile's location."""
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        old = self._locations.pop(user_id, None)
+        if old is not None:
+            cell = self._cell(*old)
+            members = self._cells.get(cell)
+            if members is not None:
+                members.pop(user_id, None)
+                if not members:
+                    del self._cells[cell]
+
+    def load(self, locations):
+        """Bulk load `(user_id, lat, lon)` triples."""
+        for user_id, lat, lon in locations:
+            self.upsert(user_id, lat, lon)
+        self.loaded = True
+
+    def location(self, user_id):
+        """Return the `(lat, lon)` of a profile, or None."""
+        return self._locations.get(user_id)
+
+    def _cells_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        row_min, col_min = self._cell(min_lat, min_lon)
+        row_max, col_max = self._cell(max_lat, max_lon)
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self._cells):
+            # A huge radius covers more grid cells than are occupied; walk the occupied ones.
+            for (row, col), members in self._cells.items():
+                if row_min <= row <= row_max and col_min <= col <= col_max:
+                    yield members
+            return
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                members = self._cells.get((row, col))
+                if members:
+                    yield members
+
+    def within(self, lat, lon, radius_km, limit=None, exclude=()):
+        """Return `(user_id, distance_km)` pairs within `radius_km`, nearest first.
+
+        Args:
+            lat, lon: The centre of the search.
+            radius_km: The search radius in kilometres.
+            limit: Optional maximum number of results.
+            exclude: User IDs to leave out, e.g. the user searching and profiles already queued.
+        """
+        if limit is not None and limit <= 0:
+            return []
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        if limit is not None and -180 <= min_lon and max_lon <= 180 and (min_lon, max_lon) != (-180, 180):
+            return self._nearest(lat, lon, radius_km, limit, exclude, (min_lat, max_lat, min_lon, max_lon))
+
+        boxes = [(min_lat, max_lat, min_lon, max_lon)]
+        # Split boxes that wrap around the antimeridian.
+        if min_lon < -180:
+            boxes = [(min_lat, max_lat, -180.0, max_lon), (min_lat, max_lat, min_lon + 360, 180.0)]
+        elif max_lon > 180:
+            boxes = [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon - 360)]
+
+        results = []
+        with self._lock:
+            for box in boxes:
+                for members in self._cells_in_box(*box):
+                    for user_id, (other_lat, other_lon) in members.items():
+                        if user_id in exclude:
+                            continue
+                        distance = haversine_km(lat, lon, other_lat, other_lon)
+                        if distance <= radius_km:
+                            results.append((distance, user_id))
+
+        if limit is not None:
+            results = heapq.nsmallest(limit, results)
+        else:
+            results.sort()
+        return [(user_id, distance) for distance, user_id in results]
+
+    def _nearest(self, lat, lon, radius_km, limit, exclude, box):
+        """Visit grid cells in rings around the centre and stop once no closer point can exist.
+
+        This keeps nearest-first queries with a `limit` cheap even when the radius covers most
+        of a dense city.
+        """
+        min_lat, max_lat, min_lon, max_lon = box
+        row0, col0 = self._cell(lat, lon)
+        row_min, col_min = self._cell(min_lat, min_lon)
+        row_max, col_max = self._cell(max_lat, max_lon)
+        max_ring = max(row0 - row_min, row_max - row0, col0 - col_min, col_max - col0)
+        # A cell r rings away is at least r - 1 cells from the centre in latitude or longitude.
+        # Longitude cells shrink towards the poles, so use the narrowest width in the box.
+        cos_min = math.cos(math.radians(min(90.0, max(abs(min_lat), abs(max_lat)))))
+        ring_km = self.cell_deg * KM_PER_DEGREE_LAT * cos_min * 0.99
+
+        heap = []
+        with self._lock:
+            for ring in range(max_ring + 1):
+                if len(heap) == limit and (ring - 1) * ring_km > -heap[0][0]:
+                    break
+                for row in range(row0 - ring, row0 + ring + 1):
+                    if row < row_min or row > row_max:
+                        continue
+                    on_edge = row in (row0 - ring, row0 + ring)
+                    cols = range(col0 - ring, col0 + ring + 1) if on_edge else (col0 - ring, col0 + ring)
+                    for col in cols:
+                        if col < col_min or col > col_max:
+                            continue
+                        members = self._cells.get((row, col))
+                        if not members:
+                            continue
+                        for user_id, (other_lat, other_lon) in members.items():
+                            if user_id in exclude:
+                                continue
+                            distance = haversine_km(lat, lon, other_lat, other_lon)
+                            if distance > radius_km:
+                                continue
+                            if len(heap) < limit:
+                                heapq.heappush(heap, (-distance, -user_id))
+                            elif (-distance, -user_id) > heap[0]:
+                                heapq.heapreplace(heap, (-distance, -user_id))
+
+        return [(-neg_user_id, -neg_distance) for neg_distance, neg_user_id in sorted(heap, reverse=True)]
+
+
+def scan_within(locations, lat, lon, radius_km, limit=None):
+    """Reference full scan over `(user_id, lat, lon)` triples, for benchmarks and checks."""
+    results = []
+    for user_id, other_lat, other_lon in locations:
+        distance = haversine_km(lat, lon, other_lat, other_lon)
+        if distance <= radius_km:
+            results.append((distance, user_id))
+    results = heapq.nsmallest(limit, results) if limit is not None else sorted(results)
+    return [(user_id, distance) for distance, user_id in results]
+
+
+def load_geo_grid(grid):
+    """Fill a grid from every `UserProfile` that has coordinates."""
+    grid.load(model.UserProfile.get_locations())
+    return grid
@@ -0,0 +1,67 @@
+"""Request-scoped identity map for users and profiles.
+
+Each request keeps the `User` and `UserProfile` rows it has already loaded, so
+asking for the same user twice does not go back to the database. Routes that
+need several rows can prefetch them with a single ``IN`` query.
+
+Per-request query counts are recorded and logged by `metrics`.
+"""
+
+from flask import g
+
+import model
+
+
+def _cache():
+    if '_identity_map' not in g:
+        g._identity_map = {'users': {}, 'profiles': {}}
+    return g._identity_map
+
+
+def get_user(user_id):
+    """Get a user by ID, loading it at most once per request."""
+    user_id = int(user_id)
+    users = _cache()['users']
+    if user_id not in users:
+        users[user_id] = model.User.get_by_id(user_id)
+    return users[user_id]
+
+
+def get_profile(user_id):
+    """Get a user profile by the user ID, loading it at most once per request."""
+    user_id = int(user_id)
+    profiles = _cache()['profiles']
+    if user_id not in profiles:
+        profiles[user_id] = model.UserProfile.get_by_user_id(user_id)
+    return profiles[user_id]
+
+
+def prefetch_users(user_ids):
+    """Load every user in `user_ids` not yet cached with one query and return them in order."""
+    user_ids = [int(user_id) for user_id in user_ids]
+    users = _cache()['users']
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if missing:
+        for user_id in missing:
+            users[user_id] = None
+        for user in model.User.get_all(missing):
+            users[user.id] = user
+    return [users[user_id] for user_id in user_ids if users[user_id] is not None]
+
+
+def prefetch_profiles(user_ids):
+    """Load every profile in `user_ids` not yet cached with one query and return them in order."""
+    user_ids = [int(user_id) for user_id in user_ids]
+    profiles = _cache()['profiles']
+    missing = [user_id for user_id in user_ids if user_id not in profiles]
+    if missing:
+        for user_id in missing:
+            profiles[user_id] = None
+        for profile in model.UserProfile.get_with_user_ids(missing):
+            profiles[profile.user_id] = profile
+    return [profiles[user_id] for user_id in user_ids if profiles[user_id] is not None]
+
+
+def forget_profile(user_id):
+    """Drop a cached profile, e.g. after it was replaced in the session."""
+    _cache()['profiles'].pop(int(user_id), None)
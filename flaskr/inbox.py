@@ -0,0 +1,136 @@
+"""Materialized chat inbox.
+
+Every match gets one `InboxEntry` per side holding what the chat list shows:
+the peer's name and photo, the latest message and the unread count. The
+entries are updated in place when a match is made, when messages are flushed,
+when a chat is opened and when a profile changes, so rendering the chat list
+is a single indexed read.
+
+None of these functions commit; they run inside the caller's transaction.
+"""
+
+import time
+
+from sqlalchemy import update
+
+import model
+
+PAGE_SIZE = 30
+SNIPPET_LENGTH = 140
+
+
+def _display_name(firstname, lastname):
+    return f'{firstname or ""} {lastname or ""}'.strip()
+
+
+def add_match(user_id, peer_id, now_ms=None):
+    """Create the inbox entries on both sides of a new match."""
+    now_ms = now_ms or int(time.time() * 1000)
+    profiles = {profile.user_id: profile for profile in model.UserProfile.get_with_user_ids([user_id, peer_id])}
+    rows = []
+    for owner, peer in ((user_id, peer_id), (peer_id, user_id)):
+        profile = profiles.get(peer)
+        rows.append({
+            'user_id': owner,
+            'peer_id': peer,
+            'peer_name': _display_name(profile.firstname, profile.lastname) if profile else '',
+            'peer_photo': profile.photo if profile else None,
+            'last_activity': now_ms,
+            'unread_count': 0,
+        })
+    model.db.session.execute(model.insert_ignore(model.InboxEntry.__table__), rows)
+
+
+def record_messages(messages, count_unread=True):
+    """Fold a batch of new message rows into the inbox entries of both participants.
+
+    Args:
+        messages: Dicts with `conversation_id`, `sender_id`, `receiver_id`, `message` and
+            `send_time`, as written by the chat store.
+        count_unread: Whether the messages count as unread for their receivers.
+    """
+    latest = {}
+    received = {}
+    for message in messages:
+        conversation = message['conversation_id']
+        if conversation not in latest or message['send_time'] >= latest[conversation]['send_time']:
+            latest[conversation] = message
+        if count_unread:
+            key = (message['receiver_id'], message['sender_id'])
+            received[key] = received.get(key, 0) + 1
+
+    entry = model.InboxEntry
+    for message in latest.values():
+        for owner, peer in ((message['sender_id'], message['receiver_id']),
+                            (message['receiver_id'], message['sender_id'])):
+            model.db.session.execute(
+                update(entry)
+                .where(entry.user_id == owner, entry.peer_id == peer)
+                .values(last_message=message['message'][:SNIPPET_LENGTH],
+                        last_message_time=message['send_time'],
+                        last_activity=message['send_time'],
+                        unread_count=entry.unread_count + received.get((owner, peer), 0)))
+
+
+def mark_read(user_id, peer_id):
+    """Reset the unread count of one conversation."""
+    entry = model.InboxEntry
+    model.db.session.execute(
+        update(entry).where(entry.user_id == user_id, entry.peer_id == int(peer_id), entry.unread_count != 0)
+        .values(unread_count=0))
+
+
+def refresh_peer(profile):
+    """Copy a changed name or photo into every inbox that shows this profile."""
+    entry = model.InboxEntry
+    model.db.session.execute(
+        update(entry).where(entry.peer_id == profile.user_id)
+        .values(peer_name=_display_name(profile.firstname, profile.lastname), peer_photo=profile.photo))
+
+
+def parse_cursor(cursor):
+    """Split a `page` cursor, ``last_activity:peer_id``, into integers.
+
+    Raises:
+        ValueError: If either part is not an integer.
+    """
+    activity, _, peer_id = cursor.partition(':')
+    return int(activity), int(peer_id or 0)
+
+
+def page(user_id, limit=PAGE_SIZE, cursor=None):
+    """Get a user's inbox entries, most recent activity first.
+
+    Returns:
+        A tuple `(entries, next_cursor)`. `next_cursor` is None on the last page.
+    """
+    entry = model.InboxEntry
+    query = entry.query.filter(entry.user_id == user_id)
+    if cursor:
+        activity, peer_id = parse_cursor(cursor)
+        query = query.filter(model.db.or_(
+            entry.last_activity < activity,
+            model.db.and_(entry.last_activity == activity, entry.peer_id < peer_id)))
+    entries = query.order_by(entry.last_activity.desc(), entry.peer_id.desc()).limit(limit + 1).all()
+    if len(entries) <= limit:
+        return entries, None
+    entries = entries[:limit]
+    return entries, f'{entries[-1].last_activity}:{entries[-1].peer_id}'
+
+
+def rebuild():
+    """Create missing inbox entries for existing matches, e.g. after writing matches outside the app."""
+    match, entry = model.Match, model.InboxEntry
+    missing = model.db.session.query(match.user_id, match.match_id, match.match_time).filter(
+        match.user_id < match.match_id,
+        ~entry.query.filter(entry.user_id == match.user_id, entry.peer_id == match.match_id).exists())
+    count = 0
+    for user_id, peer_id, match_time in missing.all():
+        add_match(user_id, peer_id, int(match_time.timestamp() * 1000))
+        messages, _ = model.Message.get_page(model.conversation_id(user_id, peer_id), limit=1)
+        if messages:
+            record_messages([{column: getattr(messages[0], column) for column in
+                              ('conversation_id', 'sender_id', 'receiver_id', 'message', 'send_time')}],
+                            count_unread=False)
+        count += 1
+    return count
@@ -0,0 +1,97 @@
+"""Keep every worker's in-memory indexes in step with writes made in any of them.
+
+The ranking store, interest and location indexes, search index, like graph,
+seen sets and candidate decks live in each process and are loaded from the
+database once. A write path updates them in its own process and publishes the
+change on a broker channel; every other process applies the same update when
+it receives it, the way `profilecache.ProfileCache` drops invalidated entries.
+
+Messages carry the changed values, so applying them needs no database access
+or app context on the broker's listener thread.
+"""
+
+PROFILES_CHANNEL = 'index-profiles'
+SWIPES_CHANNEL = 'index-swipes'
+PREFERENCES_CHANNEL = 'index-preferences'
+
+
+class IndexSync:
+    """Applies profile, swipe and preference changes to the in-memory indexes of every process."""
+
+    def __init__(self, broker, interest_store, filter_engine, geo_index, search_engine, like_graph, candidate_deck):
+        self.broker = broker
+        self.interest_store = interest_store
+        self.filter_engine = filter_engine
+        self.geo_index = geo_index
+        self.search_engine = search_engine
+        self.like_graph = like_graph
+        self.candidate_deck = candidate_deck
+        broker.subscribe(PROFILES_CHANNEL, self._on_profile)
+        broker.subscribe(SWIPES_CHANNEL, self._on_swipes)
+        broker.subscribe(PREFERENCES_CHANNEL, self._on_preferences)
+
+    def profile_changed(self, profile, new=False):
+        """Index a committed profile here and in every other process.
+
+        Call `search.SearchEngine.index_profile` before committing: it writes the search vector on
+        Postgres and updates this process's in-memory search index, so only the other processes
+        reindex the profile here. Pass `new` for newly created users, so decks that ran out of
+        candidates look again.
+        """
+        update = {
+            'user_id': profile.user_id,
+            'description': profile.description,
+            'interests': list(profile.interests or []),
+            'latitude': profile.latitude,
+            'longitude': profile.longitude,
+            'new': new,
+        }
+        self._apply_profile(update)
+        self.broker.publish(PROFILES_CHANNEL, update)
+
+    def swiped(self, user_id, target_ids, liked_ids=()):
+        """Record committed swipes here and in every other process.
+
+        `liked_ids` are the targets among `target_ids` that were liked.
+        """
+        target_ids, liked_ids = list(target_ids), list(liked_ids)
+        for target_id in target_ids:
+            self.candidate_deck.pop(user_id, target_id)
+        self._add_likes(user_id, liked_ids)
+        self.broker.publish(SWIPES_CHANNEL, {'user_id': user_id, 'targets': target_ids, 'liked': liked_ids})
+
+    def preferences_changed(self, user_id):
+        """Drop a user's cached criteria and deck here and in every other process."""
+        self._apply_preferences(user_id)
+        self.broker.publish(PREFERENCES_CHANNEL, user_id)
+
+    def _apply_profile(self, update):
+        user_id, interests = update['user_id'], update['interests']
+        self.interest_store.upsert(user_id, interests)
+        self.filter_engine.interest_index.upsert(user_id, interests)
+        self.geo_index.upsert(user_id, update['latitude'], update['longitude'])
+        if update['new']:
+            self.candidate_deck.on_new_user(user_id)
+
+    def _add_likes(self, user_id, liked_ids):
+        if self.like_graph.loaded:
+            for target_id in liked_ids:
+                self.like_graph.add(user_id, target_id)
+
+    def _apply_preferences(self, user_id):
+        self.filter_engine.forget(user_id)
+        self.candidate_deck.invalidate(user_id)
+
+    def _on_profile(self, update, origin):
+        if origin != self.broker.origin:
+            self.search_engine.reindex(update['user_id'], update['description'], update['interests'])
+            self._apply_profile(update)
+
+    def _on_swipes(self, swipes, origin):
+        if origin != self.broker.origin:
+            self.candidate_deck.discard(swipes['user_id'], swipes['targets'])
+            self._add_likes(swipes['user_id'], swipes['liked'])
+
+    def _on_preferences(self, user_id, origin):
+        if origin != self.broker.origin:
+            self._apply_preferences(user_id)
@@ -0,0 +1,183 @@
+"""In-memory like graph.
+
+Every user has two sorted ``array('I')`` adjacency lists, one for the users
+they liked and one for the users who liked them, at four bytes per edge per
+direction. Membership is a binary search over a short contiguous array, so
+"does B like A back" costs a few comparisons, and counts are array lengths.
+Set operations such as "liked you, not yet liked back" run as numpy merges
+over zero-copy views of the arrays.
+
+The database stays the source of truth: the graph is loaded in bulk on first
+use and updated after each committed swipe.
+"""
+
+import bisect
+import sys
+import threading
+from array import array
+
+import numpy as np
+from sqlalchemy import select
+
+import model
+
+LOAD_BATCH_SIZE = 100000
+
+_EMPTY = array('I')
+
+
+def _view(adjacency):
+    return np.frombuffer(adjacency, dtype=np.uint32) if adjacency else np.empty(0, dtype=np.uint32)
+
+
+def _contains(adjacency, user_id):
+    index = bisect.bisect_left(adjacency, user_id)
+    return index < len(adjacency) and adjacency[index] == user_id
+
+
+def _insert(adjacency, user_id):
+    index = bisect.bisect_left(adjacency, user_id)
+    if index < len(adjacency) and adjacency[index] == user_id:
+        return False
+    adjacency.insert(index, user_id)
+    return True
+
+
+def _group(sources, targets):
+    """Group edge arrays into `{source: sorted array('I') of targets}`."""
+    order = np.lexsort((targets, sources))
+    sources, targets = sources[order], targets[order]
+    keep = np.ones(sources.size, dtype=bool)
+    keep[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+    sources, targets = sources[keep], targets[keep]
+    starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+    ends = np.r_[starts[1:], sources.size]
+    return {int(sources[start]): array('I', targets[start:end].tobytes()) for start, end in zip(starts, ends)}
+
+
+class LikeGraph:
+    """Likes sent and received per user, as sorted adjacency arrays."""
+
+    def __init__(self):
+        self._sent = {}
+        self._received = {}
+        self._edges = 0
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        """The number of like edges."""
+        return self._edges
+
+    def add(self, user_id, target_id):
+        """Record that `user_id` liked `target_id`. Returns whether the edge is new."""
+        with self._lock:
+            if not _insert(self._sent.setdefault(user_id, array('I')), target_id):
+                return False
+            _insert(self._received.setdefault(target_id, array('I')), user_id)
+            self._edges += 1
+            return True
+
+    def remove(self, user_id, target_id):
+        with self._lock:
+            sent = self._sent.get(user_id, _EMPTY)
+            if not _contains(sent, target_id):
+                return
+            sent.pop(bisect.bisect_left(sent, target_id))
+            received = self._received[target_id]
+            received.pop(bisect.bisect_left(received, user_id))
+            self._edges -= 1
+
+    def load(self, edges):
+        """Bulk load an iterable of `(user_id, target_id)` pairs, replacing the current graph."""
+        pairs = np.fromiter((value for edge in edges for value in edge), dtype=np.uint32).reshape(-1, 2)
+        self.load_arrays(pairs[:, 0], pairs[:, 1])
+
+    def load_arrays(self, sources, targets):
+        """Bulk load edges given as two equally long integer arrays."""
+        sources = np.asarray(sources, dtype=np.uint32)
+        targets = np.asarray(targets, dtype=np.uint32)
+        sent = _group(sources, targets) if sources.size else {}
+        received = _group(targets, sources) if sources.size else {}
+        with self._lock:
+            self._sent, self._received = sent, received
+            self._edges = sum(len(adjacency) for adjacency in sent.values())
+            self.loaded = True
+
+    def likes(self, user_id, target_id):
+        """Whether `user_id` has liked `target_id`."""
+        with self._lock:
+            sent = self._sent.get(user_id, _EMPTY)
+            received = self._received.get(target_id, _EMPTY)
+            if len(received) < len(sent):
+                return _contains(received, user_id)
+            return _contains(sent, target_id)
+
+    def is_mutual(self, user_a, user_b):
+        return self.likes(user_a, user_b) and self.likes(user_b, user_a)
+
+    def sent_count(self, user_id):
+        return len(self._sent.get(user_id, _EMPTY))
+
+    def received_count(self, user_id):
+        return len(self._received.get(user_id, _EMPTY))
+
+    def sent(self, user_id):
+        """The sorted IDs `user_id` has liked."""
+        with self._lock:
+            return self._sent.get(user_id, _EMPTY).tolist()
+
+    def received(self, user_id):
+        """The sorted IDs that liked `user_id`."""
+        with self._lock:
+            return self._received.get(user_id, _EMPTY).tolist()
+
+    def _merge(self, operation, first, second):
+        # Views pin the arrays' buffers, so they must be gone before the lock is released.
+        with self._lock:
+            first, second = _view(first), _view(second)
+            result = operation(first, second, assume_unique=True).tolist()
+            del first, second
+        return result
+
+    def mutual(self, user_id):
+        """The sorted IDs that `user_id` likes and that like `user_id` back."""
+        return self._merge(np.intersect1d, self._sent.get(user_id), self._received.get(user_id))
+
+    def liked_you(self, user_id):
+        """The sorted IDs that liked `user_id` and `user_id` has not liked back."""
+        return self._merge(np.setdiff1d, self._received.get(user_id), self._sent.get(user_id))
+
+    def common_likes(self, user_a, user_b):
+        """The sorted IDs both users have liked."""
+        return self._merge(np.intersect1d, self._sent.get(user_a), self._sent.get(user_b))
+
+    def memory_bytes(self):
+        """Approximate memory held by the graph, adjacency arrays and dictionaries included."""
+        with self._lock:
+            total = sys.getsizeof(self._sent) + sys.getsizeof(self._received)
+            for adjacency_lists in (self._sent, self._received):
+                for user_id, adjacency in adjacency_lists.items():
+                    total += sys.getsizeof(adjacency) + sys.getsizeof(user_id)
+            return total
+
+
+def read_like_edges():
+    """Read every `Like` row in streaming batches into `(sources, targets)` uint32 arrays."""
+    like = model.Like
+    sources, targets = [], []
+    result = model.db.session.execute(
+        select(like.user_id, like.target_id).execution_options(yield_per=LOAD_BATCH_SIZE))
+    for rows in result.partitions():
+        pairs = np.array([tuple(row) for row in rows], dtype=np.uint32).reshape(-1, 2)
+        sources.append(pairs[:, 0])
+        targets.append(pairs[:, 1])
+    if not sources:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+    return np.concatenate(sources), np.concatenate(targets)
+
+
+def load_like_graph(graph):
+    """Fill a like graph from every `Like` row in the database."""
+    graph.load_arrays(*read_like_edges())
+    return graph
@@ -0,0 +1,238 @@
+"""Request and SQL instrumentation.
+
+Hooks the SQLAlchemy engine and the Flask request lifecycle to record, per
+route, a latency histogram, the number of SQL statements and the time spent
+in the database. Statements slower than ``METRICS_SLOW_QUERY_MS`` are kept as
+samples together with the application frames that issued them.
+
+Everything is exposed in the Prometheus text format on ``/metrics``; the slow
+query samples, with their SQL and call sites, are on ``/metrics/slow-queries``.
+Both answer 404 unless ``METRICS_TOKEN`` is set, and then only to requests
+with an ``Authorization: Bearer <token>`` header. With
+``METRICS_SERVER_TIMING`` set, each response also carries a ``Server-Timing``
+header with its own app and database time, which browser dev tools display.
+Every request also logs how many queries it issued.
+
+Recording is a few dict updates per request and a ``perf_counter`` call per
+statement, so it is meant to stay on in production.
+"""
+
+import bisect
+import hmac
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+from flask import Response, abort, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_QUERY_MS = 100
+SLOW_QUERY_SAMPLES = 50
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus layout."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            yield bound, running
+
+
+class _RouteStats:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+class Registry:
+    """Process-wide metric values."""
+
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS, slow_query_samples=SLOW_QUERY_SAMPLES):
+        self.slow_query_ms = slow_query_ms
+        self.routes = {}
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slow_queries = deque(maxlen=slow_query_samples)
+        self.slow_query_count = 0
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def add_collector(self, collect):
+        """Append the lines returned by `collect()` to every render, for metrics kept elsewhere."""
+        self._collectors.append(collect)
+
+    def record_request(self, method, route, status, seconds, queries, db_seconds):
+        with self._lock:
+            stats = self.routes.get((method, route))
+            if stats is None:
+                stats = self.routes[(method, route)] = _RouteStats()
+            stats.latency.observe(seconds)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.queries += queries
+            stats.db_seconds += db_seconds
+
+    def record_query(self, statement, seconds):
+        with self._lock:
+            self.queries += 1
+            self.db_seconds += seconds
+        if seconds * 1000 >= self.slow_query_ms:
+            sample = {
+                'statement': statement,
+                'duration_ms': round(seconds * 1000, 2),
+                'route': request.path if has_request_context() else None,
+                'call_site': _call_site(),
+                'time': time.time(),
+            }
+            with self._lock:
+                self.slow_query_count += 1
+                self.slow_queries.append(sample)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            routes = sorted(self.routes.items())
+            lines += ['# HELP matchmeet_request_duration_seconds Request latency by route.',
+                      '# TYPE matchmeet_request_duration_seconds histogram']
+            for (method, route), stats in routes:
+                labels = f'method="{method}",route="{_escape(route)}"'
+                for bound, count in stats.latency.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'matchmeet_request_duration_seconds_bucket{{{labels},le="{le}"}} {count}')
+                lines.append(f'matchmeet_request_duration_seconds_sum{{{labels}}} {stats.latency.total}')
+                lines.append(f'matchmeet_request_duration_seconds_count{{{labels}}} {stats.latency.count}')
+
+            lines += ['# HELP matchmeet_requests_total Requests by route and status.',
+                      '# TYPE matchmeet_requests_total counter']
+            for (method, route), stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f'matchmeet_requests_total{{method="{method}",route="{_escape(route)}",'
+                                 f'status="{status}"}} {count}')
+
+            lines += ['# HELP matchmeet_request_queries_total SQL statements issued by requests, by route.',
+                      '# TYPE matchmeet_request_queries_total counter']
+            lines += [f'matchmeet_request_queries_total{{method="{method}",route="{_escape(route)}"}} '
+                      f'{stats.queries}' for (method, route), stats in routes]
+
+            lines += ['# HELP matchmeet_request_db_seconds_total Database time spent by requests, by route.',
+                      '# TYPE matchmeet_request_db_seconds_total counter']
+            lines += [f'matchmeet_request_db_seconds_total{{method="{method}",route="{_escape(route)}"}} '
+                      f'{stats.db_seconds}' for (method, route), stats in routes]
+
+            lines += ['# HELP matchmeet_db_queries_total SQL statements issued, including background work.',
+                      '# TYPE matchmeet_db_queries_total counter',
+                      f'matchmeet_db_queries_total {self.queries}',
+                      '# HELP matchmeet_db_seconds_total Time spent executing SQL statements.',
+                      '# TYPE matchmeet_db_seconds_total counter',
+                      f'matchmeet_db_seconds_total {self.db_seconds}',
+                      '# HELP matchmeet_slow_queries_total SQL statements slower than the slow query threshold.',
+                      '# TYPE matchmeet_slow_queries_total counter',
+                      f'matchmeet_slow_queries_total {self.slow_query_count}']
+        for collect in self._collectors:
+            lines += collect()
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _call_site(depth=3):
+    """The innermost application frames outside this module, as 'file:line in function' strings."""
+    frames = []
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(_APP_DIR) and frame.filename != __file__:
+            frames.append(f'{os.path.relpath(frame.filename, _APP_DIR)}:{frame.lineno} in {frame.name}')
+            if len(frames) == depth:
+                break
+    return frames
+
+
+registry = Registry()
+
+
+def query_count():
+    """Return the number of SQL statements issued so far by the current request."""
+    return g.get('query_count', 0)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    registry.record_query(statement, elapsed)
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + elapsed
+
+
+def init_app(app):
+    """Instrument every engine and request of `app` and register the metrics endpoints."""
+    app.config.setdefault('METRICS_SERVER_TIMING', False)
+    app.config.setdefault('METRICS_SLOW_QUERY_MS', SLOW_QUERY_MS)
+    app.config.setdefault('METRICS_TOKEN', None)
+    registry.slow_query_ms = app.config['METRICS_SLOW_QUERY_MS']
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_start', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        db_seconds = g.get('db_seconds', 0.0)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.record_request(request.method, route, response.status_code, elapsed, query_count(), db_seconds)
+        app.logger.info('%s %s issued %d queries', request.method, request.path, query_count())
+        if app.config['METRICS_SERVER_TIMING']:
+            response.headers.add('Server-Timing', f'db;dur={db_seconds * 1000:.2f};desc="{query_count()} queries"')
+            response.headers.add('Server-Timing', f'app;dur={elapsed * 1000:.2f}')
+        return response
+
+    def require_token():
+        token = app.config['METRICS_TOKEN']
+        if not token:
+            abort(404)
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+            abort(401)
+
+    @app.route('/metrics')
+    def metrics():
+        require_token()
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/metrics/slow-queries')
+    def slow_queries():
+        require_token()
+        return jsonify(list(registry.slow_queries))
@@ -0,0 +1,322 @@
+"""Versioned schema migrations.
+
+The schema is changed by numbered migrations run as a separate command, not
+by every process on boot. ``schema_migrations`` records which versions a
+database has; `upgrade` applies the missing ones in order, each in its own
+transaction together with its version row.
+
+A fresh database gets the current models through ``create_all`` and is
+stamped with every version, since the models already include what the
+migrations add. A database created by ``create_all`` before migrations
+existed has tables but no ``schema_migrations``, and may have any shape
+from the original schema to the current one. It is adopted by running
+every migration from version 1. Migrations inspect the tables and only
+add the columns, tables and indexes that are missing, so each one is safe
+on a database that already has its change.
+
+To change the schema, edit the models and add a migration with the next
+version that makes the same change to an existing database.
+
+By default `model.connect_to_db` only checks that the recorded version is
+`head`. Its ``migrate`` schema mode runs `upgrade` on connect instead, for
+development and benchmarks, and ``skip`` does not touch the schema at all.
+
+Usage:
+    python migrations.py upgrade --create-database
+    python migrations.py status --database-url postgresql:///matchmeet
+"""
+
+import argparse
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table, case, cast, column, func, inspect, insert,
+                        select, table, update)
+from sqlalchemy.exc import DBAPIError
+
+import inbox
+import model
+
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# version -> (description, function taking a connection)
+MIGRATIONS = {}
+
+
+class SchemaOutOfDate(RuntimeError):
+    """The database schema is not at the version this code expects."""
+
+
+def migration(version, description):
+    """Register the decorated function as the migration to `version`."""
+    def register(function):
+        if version in MIGRATIONS:
+            raise ValueError(f'Duplicate migration version {version}')
+        MIGRATIONS[version] = (description, function)
+        return function
+    return register
+
+
+def head():
+    """The newest migration version."""
+    return max(MIGRATIONS)
+
+
+def _table(name):
+    return model.db.metadata.tables[name]
+
+
+def _create_tables(connection, *names):
+    """Create the current model of each named table, with its indexes, unless it exists."""
+    for name in names:
+        _table(name).create(connection, checkfirst=True)
+
+
+def _add_columns(connection, table_name, *column_names):
+    """Add the model's columns to an existing table unless they are there already.
+
+    Columns are added nullable; existing rows have no value for them yet.
+    """
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    preparer = connection.dialect.identifier_preparer
+    for name in column_names:
+        if name in existing:
+            continue
+        column = _table(table_name).c[name]
+        connection.exec_driver_sql(
+            f'ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(name)} '
+            f'{column.type.compile(dialect=connection.dialect)}')
+
+
+def _create_indexes(connection, table_name, *index_names):
+    """Create the model's indexes on a table unless they exist. Postgres-only indexes are skipped elsewhere."""
+    existing = {index['name'] for index in inspect(connection).get_indexes(table_name)}
+    for index in _table(table_name).indexes:
+        if index.name not in index_names or index.name in existing:
+            continue
+        ddl_if = index._ddl_if
+        if ddl_if is not None and ddl_if.dialect and ddl_if.dialect != connection.dialect.name:
+            continue
+        index.create(connection)
+
+
+@migration(1, 'Initial schema')
+def initial_schema(connection):
+    _create_tables(connection, 'users', 'user_profile', 'messages')
+
+
+@migration(2, 'Index profiles by user ID')
+def profile_user_index(connection):
+    _create_indexes(connection, 'user_profile', 'ix_user_profile_user_id')
+
+
+# users array column -> (edge table, whether the array holds the other end's incoming edges)
+_EDGE_ARRAYS = {
+    'likes_sent': ('likes', False),
+    'likes_received': ('likes', True),
+    'matches': ('matches', False),
+    'users_seen': ('seen', False),
+}
+# edge table -> (other end column, time column)
+_EDGE_COLUMNS = {
+    'likes': ('target_id', 'like_time'),
+    'matches': ('match_id', 'match_time'),
+    'seen': ('seen_user_id', 'seen_time'),
+}
+
+
+def _id_list(value):
+    """The IDs in an array column value; arrays are lists on Postgres and JSON text elsewhere."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = json.loads(value)
+    return [int(user_id) for user_id in value]
+
+
+@migration(3, 'Like, match and seen edge tables')
+def edge_tables(connection):
+    _create_tables(connection, 'likes', 'matches', 'seen')
+    _create_indexes(connection, 'likes', 'ix_likes_target_id_user_id')
+    arrays = [name for name in _EDGE_ARRAYS
+              if name in {column['name'] for column in inspect(connection).get_columns('users')}]
+    if not arrays:
+        return
+    # Copy the swipe history out of the old users arrays; their times were never stored.
+    users = table('users', *(column(name) for name in ['id', *arrays]))
+    user_ids = set(connection.execute(select(users.c.id)).scalars())
+    edges = {edge_table: set() for edge_table in _EDGE_COLUMNS}
+    for row in connection.execute(select(users)):
+        for name in arrays:
+            edge_table, incoming = _EDGE_ARRAYS[name]
+            for other in _id_list(getattr(row, name)):
+                if other in user_ids and other != row.id:
+                    edges[edge_table].add((other, row.id) if incoming else (row.id, other))
+    now = datetime.utcnow()
+    for edge_table, pairs in edges.items():
+        other_column, time_column = _EDGE_COLUMNS[edge_table]
+        rows = [{'user_id': user_id, other_column: other, time_column: now} for user_id, other in sorted(pairs)]
+        if rows:
+            connection.execute(model.insert_ignore(_table(edge_table), connection.dialect.name), rows)
+    for name in arrays:
+        connection.exec_driver_sql(f'ALTER TABLE users DROP COLUMN {name}')
+
+
+@migration(4, 'Profile locations')
+def profile_locations(connection):
+    _add_columns(connection, 'user_profile', 'latitude', 'longitude')
+    _create_indexes(connection, 'user_profile', 'ix_user_profile_latitude_longitude')
+
+
+def _conversation_id(first, second):
+    """SQL for `model.conversation_id` of two user ID columns."""
+    low = case((first < second, first), else_=second)
+    high = case((first < second, second), else_=first)
+    return cast(low, String) + '-' + cast(high, String)
+
+
+@migration(5, 'Key messages by conversation')
+def message_conversations(connection):
+    _add_columns(connection, 'messages', 'conversation_id')
+    messages = _table('messages')
+    connection.execute(update(messages).where(messages.c.conversation_id.is_(None)).values(
+        conversation_id=_conversation_id(messages.c.sender_id, messages.c.receiver_id)))
+    if connection.dialect.name != 'sqlite':
+        # SQLite cannot change a column's constraints in place.
+        connection.exec_driver_sql('ALTER TABLE messages ALTER COLUMN conversation_id SET NOT NULL')
+    _create_indexes(connection, 'messages', 'ix_messages_conversation_id_send_time')
+
+
+@migration(6, 'Chat inbox')
+def chat_inbox(connection):
+    _create_tables(connection, 'inbox')
+    # Give every existing match its entry, with the peer's profile and the latest message.
+    matches, profiles, messages = _table('matches'), _table('user_profile'), _table('messages')
+    recent = messages.alias('recent')
+    latest = select(recent.c.id).where(
+        recent.c.conversation_id == _conversation_id(matches.c.user_id, matches.c.match_id)) \
+        .order_by(recent.c.send_time.desc(), recent.c.id.desc()).limit(1).correlate(matches).scalar_subquery()
+    rows = connection.execute(
+        select(matches.c.user_id, matches.c.match_id, matches.c.match_time, profiles.c.firstname,
+               profiles.c.lastname, profiles.c.photo, messages.c.message, messages.c.send_time)
+        .outerjoin(profiles, profiles.c.user_id == matches.c.match_id)
+        .outerjoin(messages, messages.c.id == latest))
+    insert_entries = model.insert_ignore(_table('inbox'), connection.dialect.name)
+    while True:
+        batch = rows.fetchmany(10000)
+        if not batch:
+            return
+        connection.execute(insert_entries, [{
+            'user_id': row.user_id,
+            'peer_id': row.match_id,
+            'peer_name': f'{row.firstname or ""} {row.lastname or ""}'.strip(),
+            'peer_photo': row.photo,
+            'last_message': row.message[:inbox.SNIPPET_LENGTH] if row.message is not None else None,
+            'last_message_time': row.send_time,
+            'last_activity': row.send_time if row.send_time is not None else int(row.match_time.timestamp() * 1000),
+            'unread_count': 0,
+        } for row in batch])
+
+
+@migration(7, 'Candidate preferences and profile filter indexes')
+def preferences(connection):
+    _create_tables(connection, 'preferences')
+    _create_indexes(connection, 'user_profile', 'ix_user_profile_birthday', 'ix_user_profile_gender_user_id',
+                    'ix_user_profile_interests')
+
+
+@migration(8, 'Profile search vectors')
+def profile_search(connection):
+    _add_columns(connection, 'user_profile', 'search_vector')
+    _create_indexes(connection, 'user_profile', 'ix_user_profile_search_vector')
+    if connection.dialect.name == 'postgresql':
+        import search
+
+        search.backfill_vectors(connection)
+
+
+@migration(9, 'Recommendations')
+def recommendations(connection):
+    _create_tables(connection, 'recommendations', 'recommendation_runs')
+    _create_indexes(connection, 'likes', 'ix_likes_like_time')
+
+
+def current_version(connection):
+    """The database's newest applied version, 0 if it has none, or None if it predates migrations."""
+    if not inspect(connection).has_table(schema_migrations.name):
+        return None
+    return connection.execute(select(func.max(schema_migrations.c.version))).scalar() or 0
+
+
+def _stamp(connection, versions):
+    now = datetime.utcnow()
+    connection.execute(insert(schema_migrations), [
+        {'version': version, 'description': MIGRATIONS[version][0], 'applied_at': now} for version in versions])
+
+
+def upgrade(engine):
+    """Bring the database behind `engine` up to `head`. Returns the versions applied."""
+    with engine.begin() as connection:
+        version = current_version(connection)
+        _metadata.create_all(connection)
+        if version is None:
+            if not set(inspect(connection).get_table_names()) & set(model.db.metadata.tables):
+                model.db.metadata.create_all(connection)
+                _stamp(connection, sorted(MIGRATIONS))
+                return sorted(MIGRATIONS)
+            # Created before migrations: its shape is unknown, so every migration checks it.
+            version = 0
+    applied = []
+    for pending in sorted(v for v in MIGRATIONS if v > version):
+        with engine.begin() as connection:
+            MIGRATIONS[pending][1](connection)
+            _stamp(connection, [pending])
+        applied.append(pending)
+    return applied
+
+
+def check(engine):
+    """Raise `SchemaOutOfDate` unless the database is at `head`. One query, no schema inspection."""
+    try:
+        with engine.connect() as connection:
+            version = connection.execute(select(func.max(schema_migrations.c.version))).scalar() or 0
+    except DBAPIError:
+        version = None
+    if version != head():
+        raise SchemaOutOfDate(f'Database schema is at version {version}, expected {head()}; '
+                              f'run `python migrations.py upgrade`.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['upgrade', 'status'])
+    parser.add_argument('--database-url', default=os.environ.get('MATCHMEET_DATABASE_URL', 'postgresql:///matchmeet'))
+    parser.add_argument('--create-database', action='store_true', help='Create the database if it does not exist')
+    args = parser.parse_args()
+
+    # A bare app: migrating needs the models, not the server's routes, Socket.IO or indexes.
+    from flask import Flask
+
+    app = Flask(__name__)
+    model.connect_to_db(app, args.database_url, schema='skip')
+    with app.app_context():
+        if args.command == 'status':
+            with model.db.engine.connect() as connection:
+                version = current_version(connection)
+            print(f'Database is at version {version}, head is {head()}.')
+            return
+        if args.create_database:
+            model.validate_database(model.db.engine)
+        applied = upgrade(model.db.engine)
+        print(f'Applied {applied}.' if applied else f'Already at version {head()}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,15 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 import json
+import os
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.dialects.postgresql import ARRAY
-from sqlalchemy import create_engine
-from sqlalchemy_utils import database_exists, create_database
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
 
-db = SQLAlchemy()
+import replicas
+
+db = SQLAlchemy(session_options={'class_': replicas.RoutingSession})
 
 class User(db.Model):
     """A user."""
@@ -18,10 +22,6 @@ class User(db.Model):
     password = db.Column(db.String(128), nullable=False)
     email = db.Column(db.String(120), unique=True)
     profile = db.Column(db.Integer, nullable=True, unique=True)
-    matches = db.Column(ARRAY(db.Integer), nullable=True)
-    likes_sent = db.Column(ARRAY(db.Integer), nullable=True)
-    likes_received = db.Column(ARRAY(db.Integer), nullable=True)
-    users_seen = db.Column(ARRAY(db.Integer), nullable=True)
 
     def __repr__(self):
       """Return a string representation of the User object."""
@@ -57,14 +57,27 @@ class UserProfile(db.Model):
     __tablename__ = "user_profile"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    user_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
     firstname = db.Column(db.String(64), nullable=True)
     lastname = db.Column(db.String(64), nullable=True)
     birthday = db.Column(db.DateTime, nullable=True)
     gender = db.Column(db.Integer, nullable=True)
     photo = db.Column(db.String(255), nullable=True)
     description = db.Column(db.Text)
-    interests = db.Column(ARRAY(db.String(255)))
+    interests = db.Column(db.JSON().with_variant(ARRAY(db.String(255)), "postgresql"))
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    # Full-text search document, maintained by `search.SearchEngine`; only used on Postgres.
+    search_vector = db.Column(db.Text().with_variant(postgresql.TSVECTOR(), "postgresql"), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_user_profile_latitude_longitude', 'latitude', 'longitude'),
+        # Preference filters: age becomes a birthday range, gender keeps the user_id keyset order.
+        db.Index('ix_user_profile_birthday', 'birthday'),
+        db.Index('ix_user_profile_gender_user_id', 'gender', 'user_id'),
+        db.Index('ix_user_profile_interests', 'interests', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_user_profile_search_vector', 'search_vector', postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
 
     @classmethod
     def create(cls, user_id):
@@ -90,30 +103,202 @@ class UserProfile(db.Model):
     def get_with_user_ids(cls, user_ids):
        return cls.query.filter(UserProfile.user_id.in_(user_ids)).all()
 
+    @classmethod
+    def get_user_ids_after(cls, user_id, limit, unseen_by=None, filters=()):
+      """Get the next `limit` profile user IDs greater than `user_id`, in order.
+
+      If `unseen_by` is given, profiles that user has already swiped on are skipped.
+      `filters` are extra SQL conditions on `UserProfile`, see `filters.FilterEngine`.
+      """
+      query = db.session.query(UserProfile.user_id).filter(UserProfile.user_id > user_id, *filters)
+      if unseen_by is not None:
+        query = query.filter(~Seen.query.filter(
+            Seen.user_id == unseen_by, Seen.seen_user_id == UserProfile.user_id).exists())
+      rows = query.order_by(UserProfile.user_id).limit(limit).all()
+      return [row.user_id for row in rows]
+
+    @classmethod
+    def get_locations(cls):
+      """Stream `(user_id, latitude, longitude)` for every profile with a location."""
+      query = db.session.query(UserProfile.user_id, UserProfile.latitude, UserProfile.longitude) \
+          .filter(UserProfile.latitude.isnot(None), UserProfile.longitude.isnot(None))
+      return ((row.user_id, row.latitude, row.longitude) for row in query.yield_per(10000))
+
+
+class Like(db.Model):
+    """A like sent by `user_id` to `target_id`."""
+    __tablename__ = "likes"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    target_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    like_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Serves "who liked me" and the reverse lookup of the mutual-like check.
+        db.Index('ix_likes_target_id_user_id', 'target_id', 'user_id'),
+        # Finds the users with new likes for incremental recommendation runs.
+        db.Index('ix_likes_like_time', 'like_time'),
+    )
+
+    @classmethod
+    def get_sent(cls, user_id):
+      """Get the IDs of the users a user has liked."""
+      return [row.target_id for row in db.session.query(Like.target_id).filter(Like.user_id == user_id)]
+
+    @classmethod
+    def get_received(cls, user_id):
+      """Get the IDs of the users who liked a user."""
+      return [row.user_id for row in db.session.query(Like.user_id).filter(Like.target_id == user_id)]
+
+
+class Match(db.Model):
+    """A mutual like. Every match is stored once from each side."""
+    __tablename__ = "matches"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    match_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def get_match_ids(cls, user_id):
+      """Get the IDs of the users a user has matched with."""
+      return [row.match_id for row in db.session.query(Match.match_id).filter(Match.user_id == user_id)]
+
+
+class Seen(db.Model):
+    """A profile a user has already swiped on."""
+    __tablename__ = "seen"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    seen_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    seen_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def get_seen_among(cls, user_id, candidate_ids):
+      """Get the subset of `candidate_ids` a user has already swiped on."""
+      rows = db.session.query(Seen.seen_user_id).filter(
+          Seen.user_id == user_id, Seen.seen_user_id.in_(list(candidate_ids)))
+      return {row.seen_user_id for row in rows}
+
+
+class Recommendation(db.Model):
+    """A candidate the recommendation job (see `recommend`) suggests to a user."""
+    __tablename__ = "recommendations"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    candidate_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_recommendations_user_id_score', 'user_id', 'score'),
+    )
+
+    @classmethod
+    def get_for_user(cls, user_id, limit):
+      """Get up to `limit` recommended candidate IDs for a user, best first."""
+      rows = db.session.query(Recommendation.candidate_id).filter(Recommendation.user_id == user_id) \
+          .order_by(Recommendation.score.desc(), Recommendation.candidate_id).limit(limit)
+      return [row.candidate_id for row in rows]
+
+
+class RecommendationRun(db.Model):
+    """One run of the recommendation job. Incremental runs start from the last one."""
+    __tablename__ = "recommendation_runs"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False)
+    full = db.Column(db.Boolean, nullable=False)
+    users = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def get_last(cls):
+      """Get the most recent finished run, or None."""
+      return cls.query.order_by(cls.started_at.desc()).first()
+
+
+class Preference(db.Model):
+    """The profiles a user wants to see. Empty columns mean no preference."""
+    __tablename__ = "preferences"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    min_age = db.Column(db.Integer, nullable=True)
+    max_age = db.Column(db.Integer, nullable=True)
+    gender = db.Column(db.Integer, nullable=True)
+    interests = db.Column(db.JSON().with_variant(ARRAY(db.String(255)), "postgresql"))
+
+    @classmethod
+    def get_by_user_id(cls, user_id):
+      """Get a user's preferences, or None if they have not set any."""
+      return cls.query.get(user_id)
+
+
+def conversation_id(user_a, user_b):
+    """The canonical ID of the conversation between two users, e.g. ``'3-12'``."""
+    user_a, user_b = sorted((int(user_a), int(user_b)))
+    return f'{user_a}-{user_b}'
+
 
 class Message(db.Model):
     """A message between two users."""
     __tablename__ = "messages"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    conversation_id = db.Column(db.String(32), nullable=False)
     sender_id = db.Column(db.Integer, nullable=False)
     receiver_id = db.Column(db.Integer, nullable=False)
     message = db.Column(db.Text, nullable=False)
     send_time = db.Column(db.BigInteger, nullable=False)
 
+    __table_args__ = (
+        # Opening a chat is one range scan on this index, however long the history is.
+        db.Index('ix_messages_conversation_id_send_time', 'conversation_id', 'send_time', 'id'),
+    )
+
     @classmethod
     def create(cls, sender_id, receiver_id, message, send_time):
-      """Create and return a new user profile."""
-      return cls(sender_id=sender_id, receiver_id=receiver_id, message=message, send_time=send_time)
+      """Create and return a new message."""
+      return cls(conversation_id=conversation_id(sender_id, receiver_id), sender_id=sender_id,
+                 receiver_id=receiver_id, message=message, send_time=send_time)
+
+    @staticmethod
+    def parse_cursor(cursor):
+      """Split a `get_page` cursor, ``send_time`` or ``send_time:id``, into `(send_time, id or None)`.
+
+      Raises:
+          ValueError: If either part is not an integer.
+      """
+      send_time, _, message_id = cursor.partition(':')
+      return int(send_time), (int(message_id) if message_id else None)
 
     @classmethod
-    def get_message_as_sender(cls, user_id):
-       return cls.query.filter(Message.sender_id == user_id).all()
-    
-    @classmethod
-    def get_message_receiver(cls, user_id):
-       return cls.query.filter(Message.receiver_id == user_id).all()
-    
+    def get_page(cls, conversation, limit=50, cursor=None):
+      """Get the latest `limit` messages of a conversation older than `cursor`.
+
+      Args:
+          conversation: The conversation ID, see `conversation_id`.
+          limit: The page size.
+          cursor: A cursor from a previous page, or None for the newest messages.
+
+      Returns:
+          A tuple `(messages, next_cursor)`. Messages are newest first. `next_cursor` is None
+          once there are no older messages.
+      """
+      query = cls.query.filter(Message.conversation_id == conversation)
+      if cursor:
+        send_time, message_id = cls.parse_cursor(cursor)
+        if message_id is not None:
+          query = query.filter(db.or_(
+              Message.send_time < send_time,
+              db.and_(Message.send_time == send_time, Message.id < message_id)))
+        else:
+          query = query.filter(Message.send_time < send_time)
+      messages = query.order_by(Message.send_time.desc(), Message.id.desc()).limit(limit + 1).all()
+      if len(messages) <= limit:
+        return messages, None
+      messages = messages[:limit]
+      return messages, f'{messages[-1].send_time}:{messages[-1].id}'
+
     def toJSON(self):
         return {
            "sender_id": self.sender_id,
@@ -122,32 +307,102 @@ class Message(db.Model):
            "send_time": self.send_time
         }
 
-def validate_database(db_uri):
-     """Validates the existence of a database and creates a new one if it doesn't exist."""
-     engine = create_engine(db_uri)
-     if not database_exists(engine.url): # Checks for the first time  
-         create_database(engine.url)     # Create new DB    
-         print("New Database Created" + str(database_exists(engine.url))) # Verifies if database is there or not.
-     else:
-         print("Database Already Exists")
+class InboxEntry(db.Model):
+    """One row of a user's chat list: a match, the latest message with them and the unread count.
+
+    The peer's name and photo are copied in so the chat list is read without joining profiles.
+    """
+    __tablename__ = "inbox"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    peer_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    peer_name = db.Column(db.String(129), nullable=False, default='')
+    peer_photo = db.Column(db.String(255), nullable=True)
+    last_message = db.Column(db.String(140), nullable=True)
+    last_message_time = db.Column(db.BigInteger, nullable=True)
+    last_activity = db.Column(db.BigInteger, nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_inbox_user_id_last_activity', 'user_id', 'last_activity', 'peer_id'),
+    )
+
+
+def insert_ignore(table, dialect=None):
+    """Build an INSERT into `table` that silently skips rows whose primary key already exists.
 
+    `dialect` defaults to that of the session's database.
+    """
+    dialect = dialect or db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with('IGNORE')
 
-def connect_to_db(flask_app, db_uri="postgresql:///matchmeet", echo=True):
-    """Connects to the database."""
-    validate_database(db_uri)
 
+def upsert(table, update_columns):
+    """Build an INSERT into `table` that overwrites `update_columns` of rows whose primary key already exists."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        statement = (postgresql if dialect == 'postgresql' else sqlite).insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns),
+            set_={column: statement.excluded[column] for column in update_columns})
+    statement = mysql.insert(table)
+    return statement.on_duplicate_key_update({column: statement.inserted[column] for column in update_columns})
+
+
+def validate_database(engine):
+     """Creates the database behind `engine` if it doesn't exist yet."""
+     from sqlalchemy_utils import database_exists, create_database
+
+     try:
+         with engine.connect():
+             return
+     except OperationalError:
+         if database_exists(engine.url):
+             raise
+     create_database(engine.url)
+     engine.dispose()
+     print("New Database Created" + str(database_exists(engine.url)))
+
+
+def connect_to_db(flask_app, db_uri="postgresql:///matchmeet", echo=False, replica_uris=None, schema=None):
+    """Connects to the database.
+
+    Pool options and read replicas come from the environment unless `replica_uris` is given,
+    see `replicas`.
+
+    `schema` says what to do about the database schema on connect, defaulting to
+    ``MATCHMEET_SCHEMA``: ``'check'``, the default, fails unless the schema is up to date,
+    ``'migrate'`` creates the database if needed and applies pending migrations, and ``'skip'``
+    does neither. Migrations normally run as their own command, see `migrations`.
+    """
+    schema = schema or os.environ.get('MATCHMEET_SCHEMA', 'check')
+    if schema not in ('migrate', 'check', 'skip'):
+      raise ValueError(f'Unknown schema mode {schema!r}')
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     flask_app.config['SQLALCHEMY_ECHO'] = echo
     flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    replicas.configure(flask_app, replica_uris)
 
     db.app = flask_app
     db.init_app(flask_app)
 
     print('Connected to the db!')
 
+    if schema == 'skip':
+      return
+    import migrations
+
     with flask_app.app_context():
-      db.create_all()
+      if schema == 'check':
+        migrations.check(db.engine)
+        return
+      validate_database(db.engine)
+      migrations.upgrade(db.engine)
 
 if __name__ == '__main__':
     from server import app
-    connect_to_db(app)
\ No newline at end of file
+    connect_to_db(app, schema='migrate')
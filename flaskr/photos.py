@@ -0,0 +1,172 @@
+"""Photo upload pipeline.
+
+Uploads are streamed to disk once under a content-hash filename, so uploading
+the same image twice stores it once. Resizing happens off the request in a
+process pool, which writes a fixed set of size variants and then points the
+user's profile at the new photo.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import inbox
+import model
+
+CHUNK_SIZE = 64 * 1024
+
+# name -> (width, height, crop to fill). Variants without crop keep the aspect ratio.
+VARIANTS = {
+    'thumb': (96, 96, True),
+    'card': (500, 500, True),
+    'full': (1080, 1080, False),
+}
+DEFAULT_VARIANT = 'card'
+
+_VARIANT_FILENAME = re.compile(r'^(?P<digest>[0-9a-f]{64})_(?P<variant>[a-z]+)\.(?:jpg|webp)$')
+
+
+def upload_size(file):
+    """Return the size in bytes of an uploaded file without reading it into memory.
+
+    Returns None if the upload stream cannot seek.
+    """
+    stream = file.stream
+    try:
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(position)
+    except (AttributeError, OSError):
+        return None
+    return size
+
+
+def variant_filename(digest, variant, extension='.jpg'):
+    """Filename of one size variant of a photo."""
+    return f'{digest}_{variant}{extension}'
+
+
+def parse_variant_filename(filename):
+    """Return the content digest of a variant filename, or None for other (legacy) filenames."""
+    found = _VARIANT_FILENAME.match(filename or '')
+    return found.group('digest') if found else None
+
+
+def save_upload(file, folder):
+    """Stream an upload to `folder` under its SHA-256 and return `(digest, path)`.
+
+    If a file with the same content was uploaded before, the new copy is discarded and the
+    existing path is returned.
+    """
+    extension = os.path.splitext(file.filename)[1].lower() or '.jpg'
+    digest = hashlib.sha256()
+    file.stream.seek(0)
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.upload', delete=False) as temp:
+        while True:
+            chunk = file.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            temp.write(chunk)
+
+    digest = digest.hexdigest()
+    path = os.path.join(folder, digest + extension)
+    if os.path.exists(path):
+        os.remove(temp.name)
+    else:
+        os.replace(temp.name, path)
+    return digest, path
+
+
+def make_variants(source_path, folder, digest, webp=False):
+    """Write every size variant of a photo. Runs in a worker process.
+
+    Variants that already exist are left alone, so re-uploads of the same image are free.
+
+    Returns:
+        The list of filenames written or found.
+    """
+    from PIL import Image, ImageOps
+
+    filenames = []
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+        for variant, (width, height, crop) in VARIANTS.items():
+            extensions = ['.jpg', '.webp'] if webp else ['.jpg']
+            targets = [os.path.join(folder, variant_filename(digest, variant, ext)) for ext in extensions]
+            filenames.extend(os.path.basename(target) for target in targets)
+            if all(os.path.exists(target) for target in targets):
+                continue
+
+            if crop:
+                resized = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            else:
+                resized = image.copy()
+                resized.thumbnail((width, height), Image.LANCZOS)
+            for target in targets:
+                if target.endswith('.webp'):
+                    resized.save(target, 'WEBP', quality=80, method=4)
+                else:
+                    resized.save(target, 'JPEG', quality=85, optimize=True, progressive=True)
+    return filenames
+
+
+class PhotoPipeline:
+    """Hands photo processing to a process pool and updates profiles when it finishes."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Bind the pipeline to a Flask app and set its config defaults."""
+        app.config.setdefault('PHOTO_WORKERS', 2)
+        app.config.setdefault('PHOTO_WEBP', False)
+        self.app = app
+        app.extensions['photo_pipeline'] = self
+
+    @property
+    def executor(self):
+        """The process pool, started on first use so importing the app stays cheap."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.app.config['PHOTO_WORKERS'])
+        return self._executor
+
+    def submit(self, user_id, digest, source_path):
+        """Queue resizing of an uploaded photo for a user's profile.
+
+        Returns:
+            The `concurrent.futures.Future` of the job.
+        """
+        folder = os.path.dirname(source_path)
+        future = self.executor.submit(make_variants, source_path, folder, digest,
+                                      self.app.config['PHOTO_WEBP'])
+        future.add_done_callback(lambda done: self._on_done(user_id, digest, done))
+        return future
+
+    def _on_done(self, user_id, digest, future):
+        if future.exception() is not None:
+            self.app.logger.error('Processing photo %s for user %s failed: %s',
+                                  digest, user_id, future.exception())
+            return
+        with self.app.app_context():
+            profile = model.UserProfile.get_by_user_id(user_id)
+            if profile is None:
+                return
+            profile.photo = variant_filename(digest, DEFAULT_VARIANT)
+            inbox.refresh_peer(profile)
+            model.db.session.commit()
+            profile_cache = self.app.extensions.get('profile_cache')
+            if profile_cache is not None:
+                profile_cache.invalidate(user_id)
+
+    def shutdown(self):
+        """Wait for queued jobs and stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,198 @@
+"""Read-through cache of user profiles and their rendered swipe cards.
+
+Profiles are read far more often than they change, so views read them
+through `ProfileCache` instead of the database. Each process keeps an LRU of
+`serializers.ProfileDTO`s and rendered cards with a time to live. With
+``PROFILE_CACHE_SHARED`` set, misses also consult the broker's key-value
+store, so a profile one worker loaded serves every other worker. That store
+lives in the hub with `broker.HubBroker`, and `broker.LocalBroker` stands in
+for it in a single process.
+
+Every write path calls `ProfileCache.invalidate`, which drops the entry here
+and in the shared store and publishes the user ID so the other processes
+drop their copies too. The time to live only bounds how long a write made
+outside the app, such as a bulk load, stays invisible.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import model
+import serializers
+
+CHANNEL = 'profile-cache'
+MAX_ENTRIES = 10000
+TTL_SECONDS = 300
+# Cards link the photo in one of these formats, so each is cached separately.
+CARD_FORMATS = ('jpg', 'webp')
+
+
+class ProfileCache:
+    """LRU with TTL over profile lookups, optionally backed by the broker's shared store."""
+
+    def __init__(self, app=None, broker=None):
+        self.broker = broker
+        self.max_entries = MAX_ENTRIES
+        self.ttl = TTL_SECONDS
+        self.shared = False
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        # user ID -> the invalidation clock at the user's last invalidation. Only the latest
+        # `max_entries` are kept; older ones read as `_generation_floor`, which is never lower.
+        self._generations = OrderedDict()
+        self._clock = 0
+        self._generation_floor = 0
+        self._lock = threading.Lock()
+        if broker is not None:
+            broker.subscribe(CHANNEL, self._on_invalidate)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read the cache settings from the app config and register the cache as an extension."""
+        app.config.setdefault('PROFILE_CACHE_SIZE', MAX_ENTRIES)
+        app.config.setdefault('PROFILE_CACHE_TTL', TTL_SECONDS)
+        app.config.setdefault('PROFILE_CACHE_SHARED', False)
+        self.max_entries = app.config['PROFILE_CACHE_SIZE']
+        self.ttl = app.config['PROFILE_CACHE_TTL']
+        self.shared = app.config['PROFILE_CACHE_SHARED'] and self.broker is not None
+        app.extensions['profile_cache'] = self
+
+    def _lookup(self, key, count):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def _generation(self, user_id):
+        return self._generations.get(user_id, self._generation_floor)
+
+    def _store(self, key, value, generation):
+        with self._lock:
+            # An invalidation while the value was loading means it may already be stale.
+            if self._generation(key[1]) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _read_through(self, key, load, count=True):
+        """Return the value under `key`, loading it on a miss. `count` says whether to count the lookup."""
+        value = self._lookup(key, count)
+        if value is not None:
+            return value
+        with self._lock:
+            generation = self._generation(key[1])
+        shared_key = f'{key[0]}:{key[1]}'
+        if self.shared:
+            # Shared entries carry their own expiry, since the hub never expires keys itself.
+            entry = self.broker.get(shared_key)
+            if entry is not None and entry[0] >= time.time():
+                value = entry[1]
+                if count:
+                    with self._lock:
+                        self.shared_hits += 1
+        if value is None:
+            if count:
+                with self._lock:
+                    self.misses += 1
+            value = load()
+            if value is None:
+                return None
+            if self.shared:
+                self.broker.set(shared_key, (time.time() + self.ttl, value))
+        self._store(key, value, generation)
+        return value
+
+    def get(self, user_id, count=True):
+        """Return a user's profile as a `serializers.ProfileDTO`, or None if there is none."""
+        user_id = int(user_id)
+
+        def load():
+            profile = model.UserProfile.get_by_user_id(user_id)
+            # Plain tuples travel through the shared store as JSON; generated DTO classes cannot.
+            return tuple(getattr(profile, field) for field in serializers.ProfileDTO.fields) if profile else None
+
+        values = self._read_through(('profile', user_id), load, count)
+        return serializers.ProfileDTO(*values) if values is not None else None
+
+    def card(self, user_id, render, image_format='jpg'):
+        """Return the rendered swipe card of a user, calling `render(profile)` on a miss.
+
+        `image_format` is the photo format the card links to, one of `CARD_FORMATS`; the
+        request's format must be passed so cards are not shared between browsers that
+        accept different formats. Returns None if the user has no profile.
+        """
+        if image_format not in CARD_FORMATS:
+            raise ValueError(f'Unknown card image format {image_format!r}')
+        user_id = int(user_id)
+
+        def load():
+            # The card lookup is already counted.
+            profile = self.get(user_id, count=False)
+            return render(profile) if profile is not None else None
+
+        return self._read_through((f'card-{image_format}', user_id), load)
+
+    def invalidate(self, user_id):
+        """Forget a user's profile and card in every process. Call after committing a change."""
+        user_id = int(user_id)
+        self._drop(user_id)
+        if self.broker is None:
+            return
+        if self.shared:
+            for kind in self._kinds():
+                self.broker.delete(f'{kind}:{user_id}')
+        self.broker.publish(CHANNEL, user_id)
+
+    def _on_invalidate(self, user_id, origin):
+        if origin != self.broker.origin:
+            self._drop(user_id)
+
+    @staticmethod
+    def _kinds():
+        return ('profile',) + tuple(f'card-{image_format}' for image_format in CARD_FORMATS)
+
+    def _drop(self, user_id):
+        with self._lock:
+            self._clock += 1
+            self._generations[user_id] = self._clock
+            self._generations.move_to_end(user_id)
+            while len(self._generations) > self.max_entries:
+                _, generation = self._generations.popitem(last=False)
+                self._generation_floor = max(self._generation_floor, generation)
+            for kind in self._kinds():
+                self._entries.pop((kind, user_id), None)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'shared_hits': self.shared_hits,
+                    'misses': self.misses, 'invalidations': self.invalidations}
+
+    def metric_lines(self):
+        """The cache counters in the Prometheus text format, for `metrics.Registry.add_collector`."""
+        stats = self.stats()
+        return ['# HELP matchmeet_profile_cache_lookups_total Profile and card lookups by result.',
+                '# TYPE matchmeet_profile_cache_lookups_total counter',
+                f'matchmeet_profile_cache_lookups_total{{result="hit"}} {stats["hits"]}',
+                f'matchmeet_profile_cache_lookups_total{{result="shared_hit"}} {stats["shared_hits"]}',
+                f'matchmeet_profile_cache_lookups_total{{result="miss"}} {stats["misses"]}',
+                '# HELP matchmeet_profile_cache_invalidations_total Profiles dropped after a write.',
+                '# TYPE matchmeet_profile_cache_invalidations_total counter',
+                f'matchmeet_profile_cache_invalidations_total {stats["invalidations"]}',
+                '# HELP matchmeet_profile_cache_entries Profiles and cards held in this process.',
+                '# TYPE matchmeet_profile_cache_entries gauge',
+                f'matchmeet_profile_cache_entries {stats["entries"]}']
@@ -0,0 +1,213 @@
+"""Interest-similarity ranking for candidate profiles.
+
+Every distinct interest gets an integer ID, and every profile is stored as a
+row of packed 64-bit words with one bit per interest. Scoring a user against
+all candidates is then a single vectorized AND/OR plus a popcount over the
+matrix, which gives the Jaccard similarity of the two interest sets.
+"""
+
+import threading
+
+import numpy as np
+
+import model
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+INITIAL_CAPACITY = 1024
+
+
+def popcount(words):
+    """Count set bits per row of a 2-D uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        counts = np.bitwise_count(words)
+        return counts[:, 0].astype(np.int32) if counts.shape[1] == 1 else counts.sum(axis=1, dtype=np.int32)
+    as_bytes = np.ascontiguousarray(words).view(np.uint8)
+    return _POPCOUNT[as_bytes].reshape(words.shape[0], -1).sum(axis=1, dtype=np.int32)
+
+
+class InterestVocabulary:
+    """Maps interest strings to dense integer IDs."""
+
+    def __init__(self):
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def encode(self, interests, grow=True):
+        """Return the IDs for `interests`, assigning new IDs to unseen interests if `grow`."""
+        ids = []
+        for interest in interests or []:
+            key = interest.strip().lower()
+            if not key:
+                continue
+            if key not in self._ids:
+                if not grow:
+                    continue
+                self._ids[key] = len(self._ids)
+            ids.append(self._ids[key])
+        return ids
+
+
+class InterestFeatureStore:
+    """Packed interest bitsets for every profile, updatable one profile at a time."""
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.vocabulary = InterestVocabulary()
+        self._lock = threading.Lock()
+        self._bits = np.zeros((capacity, 1), dtype=np.uint64)
+        self._sizes = np.zeros(capacity, dtype=np.int32)
+        self._user_ids = np.zeros(capacity, dtype=np.int64)
+        self._active = np.zeros(capacity, dtype=bool)
+        self._rows = {}
+        self._free = []
+        self._count = 0
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _grow(self, rows, words):
+        """Grow the matrix to at least `rows` rows and `words` words per row."""
+        capacity, width = self._bits.shape
+        if rows <= capacity and words <= width:
+            return
+        new_capacity = capacity if rows <= capacity else max(rows, capacity * 2)
+        new_width = max(width, words)
+        bits = np.zeros((new_capacity, new_width), dtype=np.uint64)
+        bits[:capacity, :width] = self._bits
+        self._bits = bits
+        if new_capacity > capacity:
+            extra = new_capacity - capacity
+            self._sizes = np.concatenate([self._sizes, np.zeros(extra, dtype=np.int32)])
+            self._user_ids = np.concatenate([self._user_ids, np.zeros(extra, dtype=np.int64)])
+            self._active = np.concatenate([self._active, np.zeros(extra, dtype=bool)])
+
+    def _row_for(self, user_id):
+        """Return the matrix row of a profile, allocating one if it is new."""
+        index = self._rows.get(user_id)
+        if index is None:
+            if self._free:
+                index = self._free.pop()
+            else:
+                index = self._count
+                self._count += 1
+            self._rows[user_id] = index
+        return index
+
+    def _encode_row(self, interests):
+        ids = sorted(set(self.vocabulary.encode(interests)))
+        words = max(1, (len(self.vocabulary) + 63) // 64)
+        row = np.zeros(words, dtype=np.uint64)
+        for interest_id in ids:
+            row[interest_id // 64] |= np.uint64(1) << np.uint64(interest_id % 64)
+        return row, len(ids)
+
+    def upsert(self, user_id, interests):
+        """Add or replace the interests of one profile."""
+        with self._lock:
+            row, size = self._encode_row(interests)
+            index = self._row_for(user_id)
+            self._grow(index + 1, row.shape[0])
+            self._bits[index, :] = 0
+            self._bits[index, :row.shape[0]] = row
+            self._sizes[index] = size
+            self._user_ids[index] = user_id
+            self._active[index] = True
+
+    def remove(self, user_id):
+        """Forget a profile."""
+        with self._lock:
+            index = self._rows.pop(user_id, None)
+            if index is not None:
+                self._active[index] = False
+                self._bits[index, :] = 0
+                self._free.append(index)
+
+    def load(self, profiles):
+        """Bulk load `(user_id, interests)` pairs, setting all bits in one vectorized pass."""
+        with self._lock:
+            rows, interest_ids = [], []
+            for user_id, interests in profiles:
+                index = self._row_for(user_id)
+                ids = set(self.vocabulary.encode(interests))
+                self._grow(index + 1, 1)
+                self._bits[index, :] = 0
+                self._sizes[index] = len(ids)
+                self._user_ids[index] = user_id
+                self._active[index] = True
+                rows.extend([index] * len(ids))
+                interest_ids.extend(ids)
+
+            self._grow(self._count, max(1, (len(self.vocabulary) + 63) // 64))
+            if interest_ids:
+                rows = np.asarray(rows, dtype=np.int64)
+                interest_ids = np.asarray(interest_ids, dtype=np.uint64)
+                masks = np.left_shift(np.uint64(1), interest_ids % np.uint64(64))
+                np.bitwise_or.at(self._bits, (rows, (interest_ids // np.uint64(64)).astype(np.int64)), masks)
+            self.loaded = True
+
+    def scores(self, user_id, candidate_ids=None):
+        """Jaccard similarity between a user and candidates.
+
+        Args:
+            user_id: The user to score candidates for.
+            candidate_ids: Optional iterable of candidate user IDs. All profiles are scored if omitted.
+
+        Returns:
+            A tuple `(user_ids, scores)` of NumPy arrays. The user themselves is never included.
+        """
+        with self._lock:
+            index = self._rows.get(user_id)
+            if candidate_ids is None:
+                # Score the whole matrix as one contiguous block and drop inactive rows afterwards,
+                # which is much cheaper than gathering the active rows first.
+                rows = slice(0, self._count)
+                keep = self._active[:self._count].copy()
+                if index is not None:
+                    keep[index] = False
+            else:
+                rows = np.fromiter((self._rows[c] for c in candidate_ids if c in self._rows),
+                                   dtype=np.int64)
+                keep = rows != index if index is not None else np.ones(rows.size, dtype=bool)
+            user_ids = self._user_ids[rows]
+            sizes = self._sizes[rows]
+            if index is None or self._sizes[index] == 0 or user_ids.size == 0:
+                return user_ids[keep], np.zeros(int(keep.sum()), dtype=np.float32)
+
+            mine = self._bits[index, :]
+            intersection = popcount(self._bits[rows] & mine)
+            union = sizes + self._sizes[index] - intersection
+            scores = np.divide(intersection, union, out=np.zeros(union.size, dtype=np.float32),
+                               where=union > 0, dtype=np.float32)
+            return user_ids[keep], scores[keep]
+
+    def top_k(self, user_id, k, candidate_ids=None):
+        """Return the `k` most similar candidates as a list of `(user_id, score)`, best first."""
+        user_ids, scores = self.scores(user_id, candidate_ids)
+        if user_ids.size == 0:
+            return []
+        k = min(k, user_ids.size)
+        best = np.arange(user_ids.size)
+        if k < user_ids.size:
+            # Keep every candidate tied with the k-th score, so the tie break below picks among all of them.
+            cutoff = -np.partition(-scores, k - 1)[k - 1]
+            best = best[scores >= cutoff]
+        # Ties keep the lower user ID first so the order is stable between refills.
+        best = best[np.lexsort((user_ids[best], -scores[best]))][:k]
+        return [(int(user_ids[i]), float(scores[i])) for i in best]
+
+    def rank(self, user_id, candidate_ids):
+        """Order `candidate_ids` by similarity to `user_id`, most similar first."""
+        candidate_ids = list(candidate_ids)
+        ranked = [candidate for candidate, _ in self.top_k(user_id, len(candidate_ids), candidate_ids)]
+        known = set(ranked)
+        return ranked + [candidate for candidate in candidate_ids if candidate not in known]
+
+
+def load_feature_store(store):
+    """Fill a feature store from every `UserProfile` in the database."""
+    query = model.db.session.query(model.UserProfile.user_id, model.UserProfile.interests)
+    store.load((row.user_id, row.interests) for row in query.yield_per(10000))
+    return store
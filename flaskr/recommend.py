@@ -0,0 +1,216 @@
+"""Offline collaborative-filtering recommendations.
+
+`run` reads the likes table in streaming batches into two compressed sparse
+row (CSR) arrays, likes by user and likers by profile, and scores candidates
+item-item style: a profile scores high when people who liked the same
+profiles as you also liked it. Scores are damped by the candidate's like
+count so a few popular profiles do not top every list.
+
+The walk from a user to candidates samples at most ``MAX_LIKES`` likes per
+user and ``MAX_LIKERS`` likers per profile, so scoring one user costs the
+same however popular the profiles they liked are. Users are scored in
+chunks across a process pool, and each user's best ``TOP_N`` candidates are
+written to the ``recommendations`` table, which the candidate deck serves
+before scanning for other profiles.
+
+Runs are incremental: unless a full run is asked for, only users who liked
+someone since the previous run started are rescored.
+"""
+
+import itertools
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import delete
+
+import bulk_load
+import likegraph
+import model
+
+TOP_N = 100
+MAX_LIKES = 30
+MAX_LIKERS = 10
+CHUNK_SIZE = 512
+WRITE_BATCH_SIZE = 50000
+
+
+def _csr(rows, columns, shuffle, size):
+    """CSR arrays `(indptr, columns)` with each row's columns in `shuffle` order."""
+    order = np.lexsort((shuffle, rows))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, columns[order]
+
+
+def _gather(indptr, values, rows, cap):
+    """Concatenate the first `cap` values of each of `rows`.
+
+    Returns:
+        `(values, owners)`, where `owners[k]` is the position in `rows` that value `k` came from.
+    """
+    starts = indptr[rows]
+    lengths = np.minimum(indptr[rows + 1] - starts, cap)
+    owners = np.repeat(np.arange(rows.size), lengths)
+    offsets = np.arange(owners.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return values[starts[owners] + offsets].astype(np.int64), owners
+
+
+class LikeMatrix:
+    """The like graph as CSR arrays in both directions, indexed by user ID.
+
+    Each row is shuffled once, so its first entries are a random sample of it.
+    """
+
+    def __init__(self, sources, targets, seed=0):
+        sources = np.asarray(sources, dtype=np.uint32)
+        targets = np.asarray(targets, dtype=np.uint32)
+        self.size = int(max(sources.max(), targets.max())) + 1 if sources.size else 1
+        shuffle = np.random.default_rng(seed).random(sources.size, dtype=np.float32)
+        self.likes_indptr, self.likes = _csr(sources, targets, shuffle, self.size)
+        self.likers_indptr, self.likers = _csr(targets, sources, shuffle, self.size)
+        self.sent = np.diff(self.likes_indptr)
+        self.received = np.diff(self.likers_indptr)
+
+    def users(self):
+        """The IDs of every user who liked someone."""
+        return np.flatnonzero(self.sent)
+
+
+def score_chunk(matrix, user_ids, top_n=TOP_N):
+    """Score candidates for a chunk of users.
+
+    Each path user -> liked profile -> co-liker -> candidate adds a weight that undoes the
+    sampling of the two middle steps and divides by the square root of both profiles' like
+    counts, a cosine similarity between the liked profile and the candidate.
+
+    Returns:
+        `(user_ids, candidate_ids, scores)` arrays with up to `top_n` rows per user, grouped
+        by user and best first. Profiles the user already liked are left out.
+    """
+    users = np.asarray(user_ids, dtype=np.int64)
+    users = users[users < matrix.size]
+    liked, owners = _gather(matrix.likes_indptr, matrix.likes, users, MAX_LIKES)
+    co_likers, via = _gather(matrix.likers_indptr, matrix.likers, liked, MAX_LIKERS)
+    candidates, steps = _gather(matrix.likes_indptr, matrix.likes, co_likers, MAX_LIKES)
+
+    liked_received = matrix.received[liked]
+    liked_weight = np.sqrt(liked_received) / np.minimum(liked_received, MAX_LIKERS)
+    co_liker_sent = matrix.sent[co_likers]
+    co_liker_weight = co_liker_sent / np.minimum(co_liker_sent, MAX_LIKES)
+    path_liked = via[steps]
+    weights = liked_weight[path_liked] * co_liker_weight[steps] / np.sqrt(matrix.received[candidates])
+
+    keys, inverse = np.unique(owners[path_liked] * matrix.size + candidates, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights)
+    key_owners, key_candidates = np.divmod(keys, matrix.size)
+
+    all_liked, all_owners = _gather(matrix.likes_indptr, matrix.likes, users, matrix.size)
+    keep = (key_candidates != users[key_owners]) & ~np.isin(keys, all_owners * matrix.size + all_liked)
+    key_owners, key_candidates, scores = key_owners[keep], key_candidates[keep], scores[keep]
+
+    # Sort by user, then best score first; ties keep candidate ID order since the keys were sorted.
+    order = np.argsort(key_owners + 0.5 - 0.5 * scores / (scores.max() if scores.size else 1), kind='stable')
+    key_owners, key_candidates, scores = key_owners[order], key_candidates[order], scores[order]
+    group_starts = np.searchsorted(key_owners, key_owners)
+    best = np.arange(key_owners.size) - group_starts < top_n
+    return users[key_owners[best]], key_candidates[best], scores[best].astype(np.float32)
+
+
+# Set in the parent before the pool forks, so workers share the matrix instead of unpickling it.
+_matrix = None
+
+
+def _score_in_worker(user_ids, top_n):
+    return score_chunk(_matrix, user_ids, top_n)
+
+
+def score_users(matrix, user_ids, top_n=TOP_N, workers=1, chunk_size=CHUNK_SIZE):
+    """Score `user_ids` in chunks, in a pool of `workers` forked processes if more than one.
+
+    Yields:
+        `(chunk, (user_ids, candidate_ids, scores))` per chunk of user IDs, in order.
+    """
+    global _matrix
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    chunks = [user_ids[start:start + chunk_size] for start in range(0, user_ids.size, chunk_size)]
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, score_chunk(matrix, chunk, top_n)
+        return
+    _matrix = matrix
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            yield from zip(chunks, executor.map(_score_in_worker, chunks, itertools.repeat(top_n)))
+    finally:
+        _matrix = None
+
+
+def active_users(since):
+    """The IDs of users who liked someone at or after `since`."""
+    rows = model.db.session.query(model.Like.user_id).filter(model.Like.like_time >= since).distinct()
+    return np.array(sorted(row.user_id for row in rows), dtype=np.int64)
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process and of its largest finished child, in MB."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / 1024, 1), round(children / 1024, 1)
+
+
+def run(full=False, workers=1, top_n=TOP_N, chunk_size=CHUNK_SIZE):
+    """Recompute recommendations and record the run.
+
+    Commits after every ``WRITE_BATCH_SIZE`` rows, so an incremental run replaces lists a batch
+    at a time. A full run clears the table first, and users wait for their batch to get a list.
+
+    Returns:
+        A dict with the users rescored, the rows written, the time spent and peak memory.
+    """
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    session = model.db.session
+    session().use_primary()
+    last = model.RecommendationRun.get_last()
+    full = full or last is None
+
+    matrix = LikeMatrix(*likegraph.read_like_edges())
+    load_seconds = time.perf_counter() - started
+    users = matrix.users() if full else active_users(last.started_at)
+    table = model.Recommendation.__table__
+    if full:
+        session.execute(delete(table))
+
+    written = 0
+    rows = []
+    for chunk, (owners, candidates, scores) in score_users(matrix, users, top_n, workers, chunk_size):
+        if not full:
+            session.execute(delete(table).where(table.c.user_id.in_(chunk.tolist())))
+        rows.extend({'user_id': owner, 'candidate_id': candidate, 'score': score}
+                    for owner, candidate, score in zip(owners.tolist(), candidates.tolist(), scores.tolist()))
+        if len(rows) >= WRITE_BATCH_SIZE:
+            bulk_load.write_rows(table, rows)
+            session.commit()
+            written += len(rows)
+            rows = []
+    bulk_load.write_rows(table, rows)
+    written += len(rows)
+
+    session.add(model.RecommendationRun(started_at=started_at, finished_at=datetime.utcnow(), full=full,
+                                        users=int(users.size)))
+    session.commit()
+    peak_mb, peak_worker_mb = peak_memory_mb()
+    return {
+        'full': full,
+        'edges': int(matrix.likes.size),
+        'users': int(users.size),
+        'recommendations': written,
+        'load_s': round(load_seconds, 2),
+        'total_s': round(time.perf_counter() - started, 2),
+        'peak_rss_mb': peak_mb,
+        'peak_worker_rss_mb': peak_worker_mb,
+    }
@@ -0,0 +1,111 @@
+"""Connection pooling and read replica routing.
+
+Engine pool settings and replica URLs are read from the environment:
+
+* ``MATCHMEET_DB_POOL_SIZE``, ``MATCHMEET_DB_MAX_OVERFLOW``,
+  ``MATCHMEET_DB_POOL_TIMEOUT``, ``MATCHMEET_DB_POOL_RECYCLE`` and
+  ``MATCHMEET_DB_POOL_PRE_PING`` tune every engine's connection pool.
+* ``MATCHMEET_REPLICA_URLS`` is a comma-separated list of read replicas. Each
+  one becomes a ``replica-N`` bind.
+
+`RoutingSession` sends plain SELECTs to a replica and everything else to the
+primary. A session stays on the primary once it has written, so a request
+reads its own writes. `stick_to_primary` extends that to the next few
+seconds of the user's requests, e.g. after a profile update, so they do not
+see stale data while the replicas catch up.
+"""
+
+import itertools
+import os
+import time
+
+from flask import current_app, g, has_app_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+
+STICKY_SECONDS = 5
+
+_POOL_OPTIONS = {
+    'MATCHMEET_DB_POOL_SIZE': ('pool_size', int),
+    'MATCHMEET_DB_MAX_OVERFLOW': ('max_overflow', int),
+    'MATCHMEET_DB_POOL_TIMEOUT': ('pool_timeout', float),
+    'MATCHMEET_DB_POOL_RECYCLE': ('pool_recycle', int),
+}
+
+
+def engine_options(environ=os.environ):
+    """Build `SQLALCHEMY_ENGINE_OPTIONS` from the environment."""
+    options = {'pool_pre_ping': environ.get('MATCHMEET_DB_POOL_PRE_PING', '1') == '1'}
+    for variable, (option, convert) in _POOL_OPTIONS.items():
+        if environ.get(variable):
+            options[option] = convert(environ[variable])
+    return options
+
+
+def replica_binds(environ=os.environ):
+    """Build the replica entries of `SQLALCHEMY_BINDS` from ``MATCHMEET_REPLICA_URLS``."""
+    urls = [url.strip() for url in environ.get('MATCHMEET_REPLICA_URLS', '').split(',') if url.strip()]
+    return {f'replica-{index}': url for index, url in enumerate(urls)}
+
+
+def configure(app, replica_urls=None):
+    """Set pool options and replica binds on `app` before the database extension is initialized."""
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options())
+    binds = replica_binds() if replica_urls is None else {
+        f'replica-{index}': url for index, url in enumerate(replica_urls)}
+    app.config.setdefault('SQLALCHEMY_BINDS', {}).update(binds)
+    app.config.setdefault('REPLICA_STICKY_SECONDS', STICKY_SECONDS)
+
+
+def init_app(app):
+    """Honour read-your-writes stickiness set by earlier requests of the same user."""
+
+    @app.before_request
+    def check_sticky_primary():
+        if session.get('read_primary_until', 0) > time.time():
+            g.read_primary = True
+
+
+def stick_to_primary(seconds=None):
+    """Read from the primary for the rest of this request and the user's next few seconds."""
+    seconds = current_app.config['REPLICA_STICKY_SECONDS'] if seconds is None else seconds
+    session['read_primary_until'] = time.time() + seconds
+    g.read_primary = True
+
+
+class RoutingSession(Session):
+    """Session that reads from replicas and writes to the primary."""
+
+    _replica_cycle = None
+    _replica_keys = ()
+
+    def _replica(self):
+        keys = tuple(key for key in self._db.engines if isinstance(key, str) and key.startswith('replica-'))
+        if not keys:
+            return None
+        if keys != RoutingSession._replica_keys:
+            RoutingSession._replica_keys = keys
+            RoutingSession._replica_cycle = itertools.cycle(keys)
+        return self._db.engines[next(RoutingSession._replica_cycle)]
+
+    def _reads_from_replica(self, clause):
+        if self._flushing:
+            self.info['wrote'] = True
+        if self.info.get('wrote'):
+            return False
+        if not isinstance(clause, Select) or clause._for_update_arg is not None:
+            if clause is not None:
+                self.info['wrote'] = True
+            return False
+        return not (has_app_context() and g.get('read_primary'))
+
+    def use_primary(self):
+        """Send every statement of this session to the primary, e.g. to read a value about to be written."""
+        self.info['wrote'] = True
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._reads_from_replica(clause):
+            replica = self._replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -0,0 +1,250 @@
+"""Full-text search over profile descriptions and interests.
+
+On Postgres every profile keeps a ``search_vector`` tsvector column with a
+GIN index. It is written whenever the profile changes, and queries are ranked
+by ``ts_rank`` with interests weighted above the description. Other
+databases, such as SQLite in development and in the benchmarks, use
+`InvertedIndex`, an in-memory BM25 index that is updated incrementally from
+the same write paths.
+
+In the in-memory index interests count double, so a profile listing
+"hiking" ranks above one that mentions hiking once in passing.
+"""
+
+import re
+import threading
+from array import array
+
+import numpy as np
+from sqlalchemy import func, update
+
+import model
+
+TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have i im in is it its me my of on or so that the this to '
+    'was we were with you your'.split())
+INTEREST_WEIGHT = 2
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+K1 = 1.2
+B = 0.75
+COMPACT_RATIO = 0.25
+
+
+def tokenize(text):
+    """Lowercase word tokens of `text`, without stopwords and single letters."""
+    return [token for token in TOKEN_RE.findall((text or '').lower())
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+def profile_terms(description, interests):
+    """Term frequencies of a profile, with interest terms weighted up."""
+    terms = {}
+    for token in tokenize(description):
+        terms[token] = terms.get(token, 0) + 1
+    for interest in interests or ():
+        for token in tokenize(interest):
+            terms[token] = terms.get(token, 0) + INTEREST_WEIGHT
+    return terms
+
+
+class InvertedIndex:
+    """In-memory BM25 index with append-only postings.
+
+    Each profile version is a document number. Postings are arrays of document
+    numbers and term frequencies, appended in increasing order, so updating a
+    profile appends a new document and marks the old one dead. Dead postings
+    are dropped once they make up a quarter of the index.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._doc_user = array('I')
+        self._doc_length = array('I')
+        self._alive = bytearray()
+        self._user_doc = {}
+        self._total_length = 0
+        self._dead = 0
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._user_doc)
+
+    def upsert(self, user_id, description, interests):
+        """Add or replace the searchable text of one profile."""
+        terms = profile_terms(description, interests)
+        with self._lock:
+            self._discard(user_id)
+            if not terms:
+                return
+            doc = len(self._doc_user)
+            length = sum(terms.values())
+            self._doc_user.append(user_id)
+            self._doc_length.append(length)
+            self._alive.append(1)
+            self._user_doc[user_id] = doc
+            self._total_length += length
+            for term, frequency in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = (array('I'), array('H'))
+                postings[0].append(doc)
+                postings[1].append(min(frequency, 0xFFFF))
+            if self._dead > COMPACT_RATIO * len(self._user_doc) and self._dead > 1000:
+                self._compact()
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        doc = self._user_doc.pop(user_id, None)
+        if doc is not None:
+            self._alive[doc] = 0
+            self._total_length -= self._doc_length[doc]
+            self._dead += 1
+
+    def _compact(self):
+        alive = np.frombuffer(self._alive, dtype=np.uint8).astype(bool)
+        for term, (docs, frequencies) in list(self._postings.items()):
+            doc_array = np.frombuffer(docs, dtype=np.uint32)
+            keep = alive[doc_array]
+            if keep.all():
+                continue
+            if not keep.any():
+                del self._postings[term]
+                continue
+            kept_frequencies = np.frombuffer(frequencies, dtype=np.uint16)[keep]
+            kept_docs = doc_array[keep]
+            del doc_array
+            self._postings[term] = (array('I', kept_docs.tobytes()), array('H', kept_frequencies.tobytes()))
+        self._dead = 0
+
+    def load(self, profiles):
+        """Bulk load `(user_id, description, interests)` tuples."""
+        for user_id, description, interests in profiles:
+            self.upsert(user_id, description, interests)
+        self.loaded = True
+
+    def search(self, query, limit, offset=0):
+        """Rank profiles against `query` with BM25.
+
+        Returns:
+            A tuple `(results, total)` with up to `limit` `(user_id, score)` pairs after skipping
+            `offset`, best first, and the number of matching profiles.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            live = len(self._user_doc)
+            if not terms or not live:
+                return [], 0
+            doc_count = len(self._doc_user)
+            lengths = np.frombuffer(self._doc_length, dtype=np.uint32)
+            average = self._total_length / live
+            scores = np.zeros(doc_count, dtype=np.float32)
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                docs = np.frombuffer(postings[0], dtype=np.uint32)
+                frequencies = np.frombuffer(postings[1], dtype=np.uint16).astype(np.float32)
+                idf = np.log1p((live - docs.size + 0.5) / (docs.size + 0.5))
+                norm = K1 * (1 - B + B * lengths[docs] / average)
+                scores[docs] += idf * frequencies * (K1 + 1) / (frequencies + norm)
+                del docs
+            scores *= np.frombuffer(self._alive, dtype=np.uint8)
+            del lengths
+            matched = np.flatnonzero(scores > 0)
+            total = int(matched.size)
+            wanted = min(offset + limit, total)
+            if wanted <= offset:
+                return [], total
+            if wanted < total:
+                # Keep every profile tied with the last wanted score so ties break the same way on every page.
+                cutoff = -np.partition(-scores[matched], wanted - 1)[wanted - 1]
+                matched = matched[scores[matched] >= cutoff]
+            # Equal scores keep the lower user ID first so pages are stable.
+            users = np.frombuffer(self._doc_user, dtype=np.uint32)[matched]
+            order = np.lexsort((users, -scores[matched]))[offset:wanted]
+            return [(int(users[i]), float(scores[matched[i]])) for i in order], total
+
+
+def _tsvector(description, interests):
+    """Postgres tsvector expression with interests weighted above the description."""
+    return func.setweight(func.to_tsvector('english', interests), 'A').op('||')(
+        func.setweight(func.to_tsvector('english', description), 'B'))
+
+
+def backfill_vectors(executor):
+    """Compute missing tsvectors on Postgres through a session or connection. Returns the rows updated."""
+    profile = model.UserProfile
+    result = executor.execute(
+        update(profile).where(profile.search_vector.is_(None))
+        .values(search_vector=_tsvector(func.coalesce(profile.description, ''),
+                                        func.coalesce(func.array_to_string(profile.interests, ' '), ''))))
+    return result.rowcount
+
+
+class SearchEngine:
+    """Profile search on Postgres full-text search or an `InvertedIndex`."""
+
+    def __init__(self, index=None):
+        self.index = index if index is not None else InvertedIndex()
+
+    @staticmethod
+    def _uses_postgres():
+        return model.db.session.get_bind().dialect.name == 'postgresql'
+
+    def _ensure_loaded(self):
+        if not self.index.loaded:
+            profile = model.UserProfile
+            query = model.db.session.query(profile.user_id, profile.description, profile.interests)
+            self.index.load((row.user_id, row.description, row.interests) for row in query.yield_per(10000))
+
+    def warm(self):
+        """Build the in-memory index now rather than on the first search. Does nothing on Postgres."""
+        if not self._uses_postgres():
+            self._ensure_loaded()
+
+    def index_profile(self, profile):
+        """Bring a changed profile's search entry up to date. Call before committing the profile."""
+        if self._uses_postgres():
+            profile.search_vector = _tsvector(profile.description or '', ' '.join(profile.interests or ()))
+        else:
+            self.index.upsert(profile.user_id, profile.description, profile.interests)
+
+    def reindex(self, user_id, description, interests):
+        """Update the in-memory index for a profile another worker changed and indexed.
+
+        Needs no database access. Postgres keeps the index in the profile row, so nothing is
+        loaded here and nothing is done.
+        """
+        if self.index.loaded:
+            self.index.upsert(user_id, description, interests)
+
+    def backfill(self):
+        """Compute missing tsvectors on Postgres, e.g. after a bulk load. Returns the rows updated."""
+        if not self._uses_postgres():
+            return 0
+        return backfill_vectors(model.db.session)
+
+    def search(self, query, page=1, per_page=PAGE_SIZE):
+        """Return `(results, total)` for one page of ranked `(user_id, score)` matches."""
+        offset = (page - 1) * per_page
+        if not self._uses_postgres():
+            self._ensure_loaded()
+            return self.index.search(query, per_page, offset)
+
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+        profile = model.UserProfile
+        # Any term may match, like the in-memory index; ranking favours profiles matching more.
+        tsquery = func.to_tsquery('english', ' | '.join(terms))
+        rank = func.ts_rank(profile.search_vector, tsquery).label('rank')
+        matches = model.db.session.query(profile.user_id, rank).filter(profile.search_vector.op('@@')(tsquery))
+        total = matches.count()
+        rows = matches.order_by(rank.desc(), profile.user_id).offset(offset).limit(per_page)
+        return [(row.user_id, float(row.rank)) for row in rows], total
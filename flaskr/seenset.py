@@ -0,0 +1,209 @@
+"""Compact, expiring record of the profiles each user has swiped on.
+
+The deck checks every candidate against the user's swipe history, which grows
+with every swipe. A `SeenSet` splits it into tiers of ``TIER_DAYS`` days by
+when each profile was seen:
+
+* the current tier is an exact array of user IDs, so a profile passed on
+  recently never shows up again because of a false positive,
+* once a tier is over it is sealed into a Bloom filter of
+  ``BITS_PER_SWIPE`` bits per swipe, half the size of the exact IDs.
+
+Tiers older than the resurface horizon are dropped whole, so profiles passed
+on long ago can show up again. A sealed tier reports about 0.05% of the
+profiles never swiped on as seen, which hides those candidates; it never lets
+a swiped profile through early. With the default horizon of six tiers the
+overall false-positive rate stays below 0.3% however long the history is.
+
+The ``seen`` table stays the source of truth: a user's set is built from it
+on first use and updated as the deck pops swiped candidates. `SeenStore`
+keeps the sets of the most recently active users only and rebuilds an
+evicted one from the table when that user swipes again.
+"""
+
+import math
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import model
+
+TIER_DAYS = 30
+RESURFACE_DAYS = 180
+# Users whose seen sets `SeenStore` keeps in memory; the least recently used are evicted.
+MAX_USERS = 10000
+BITS_PER_SWIPE = 16
+BLOOM_HASHES = 11
+MIN_BLOOM_BYTES = 64
+
+
+def _positions(user_ids, bits):
+    """Bloom filter bit positions of `user_ids`, as an `(n, BLOOM_HASHES)` array.
+
+    Each position is an independent splitmix64 hash of the ID and the hash number. Double
+    hashing is cheaper but its arithmetic progressions collide too often in small filters.
+    """
+    with np.errstate(over='ignore'):
+        mixed = np.asarray(user_ids, dtype=np.uint64)[:, None] * np.uint64(BLOOM_HASHES) \
+            + np.arange(BLOOM_HASHES, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        mixed = (mixed ^ (mixed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        mixed ^= mixed >> np.uint64(31)
+    return mixed % np.uint64(bits)
+
+
+class _Bloom:
+    """An immutable Bloom filter over one sealed tier."""
+
+    __slots__ = ('bits', 'count')
+
+    def __init__(self, user_ids):
+        self.count = len(user_ids)
+        size = max(MIN_BLOOM_BYTES, math.ceil(self.count * BITS_PER_SWIPE / 8))
+        bits = np.zeros(size, dtype=np.uint8)
+        positions = _positions(user_ids, size * 8)
+        np.bitwise_or.at(bits, positions >> np.uint64(3), (1 << (positions & np.uint64(7))).astype(np.uint8))
+        self.bits = bits.tobytes()
+
+    def contains_many(self, user_ids):
+        """Membership of `user_ids`, as a boolean array."""
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        positions = _positions(user_ids, bits.size * 8)
+        return ((bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1)
+
+
+class SeenSet:
+    """One user's swipe history: the current tier exactly, older tiers as Bloom filters.
+
+    Days are proleptic ordinals (`date.toordinal`). Swipes should be added oldest first.
+    """
+
+    __slots__ = ('_recent', '_recent_tier', '_tiers')
+
+    def __init__(self):
+        self._recent = array('I')
+        self._recent_tier = None
+        self._tiers = {}
+
+    def __len__(self):
+        """The number of swipes held, counting a profile swiped twice twice."""
+        return len(self._recent) + sum(bloom.count for bloom in self._tiers.values())
+
+    def add(self, user_id, day):
+        tier = day // TIER_DAYS
+        if self._recent_tier is None or tier > self._recent_tier:
+            self._seal()
+            self._recent_tier = tier
+        self._recent.append(user_id)
+
+    def _seal(self):
+        if self._recent:
+            self._tiers[self._recent_tier] = _Bloom(self._recent)
+            self._recent = array('I')
+
+    def __contains__(self, user_id):
+        return bool(self.seen_among([user_id]))
+
+    def seen_among(self, candidate_ids):
+        """Return the subset of `candidate_ids` that was (probably) swiped on."""
+        candidates = np.asarray(list(candidate_ids), dtype=np.uint32)
+        if not candidates.size:
+            return set()
+        seen = np.isin(candidates, np.array(self._recent, dtype=np.uint32))
+        for bloom in self._tiers.values():
+            seen |= bloom.contains_many(candidates)
+        return set(candidates[seen].tolist())
+
+    def expire(self, oldest_day):
+        """Forget the tiers that ended before `oldest_day`. Returns how many swipes were dropped."""
+        dropped = 0
+        for tier in [tier for tier in self._tiers if (tier + 1) * TIER_DAYS <= oldest_day]:
+            dropped += self._tiers.pop(tier).count
+        if self._recent_tier is not None and (self._recent_tier + 1) * TIER_DAYS <= oldest_day:
+            dropped += len(self._recent)
+            self._recent = array('I')
+        return dropped
+
+    def memory_bytes(self):
+        total = sys.getsizeof(self._recent) + sys.getsizeof(self._tiers)
+        for bloom in self._tiers.values():
+            total += sys.getsizeof(bloom) + sys.getsizeof(bloom.bits)
+        return total
+
+
+def load_seen_set(seen_set, user_id, since):
+    """Fill a seen set with a user's swipes since the datetime `since`, oldest first."""
+    seen = model.Seen
+    rows = model.db.session.query(seen.seen_user_id, seen.seen_time) \
+        .filter(seen.user_id == user_id, seen.seen_time >= since).order_by(seen.seen_time)
+    for row in rows.yield_per(10000):
+        seen_set.add(row.seen_user_id, row.seen_time.toordinal())
+    return seen_set
+
+
+class SeenStore:
+    """The `SeenSet` of every user who swiped since startup, loaded lazily from the ``seen`` table.
+
+    Profiles swiped more than `resurface_days` days ago (give or take a tier) count as unseen again.
+    """
+
+    def __init__(self, resurface_days=RESURFACE_DAYS, max_users=MAX_USERS):
+        self.resurface_days = resurface_days
+        self.max_users = max_users
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _oldest_day(self):
+        return datetime.utcnow().toordinal() - self.resurface_days
+
+    def _get(self, user_id):
+        with self._lock:
+            seen_set = self._sets.get(user_id)
+            if seen_set is not None:
+                self._sets.move_to_end(user_id)
+                return seen_set
+        since = datetime.utcnow() - timedelta(days=self.resurface_days)
+        seen_set = load_seen_set(SeenSet(), user_id, since)
+        with self._lock:
+            seen_set = self._sets.setdefault(user_id, seen_set)
+            while len(self._sets) > self.max_users:
+                self._sets.popitem(last=False)
+        return seen_set
+
+    def add(self, user_id, target_ids, when=None):
+        """Record swipes already written to the ``seen`` table.
+
+        Users whose set is not loaded yet are skipped, since loading reads the table.
+        """
+        day = (when or datetime.utcnow()).toordinal()
+        with self._lock:
+            seen_set = self._sets.get(user_id)
+            if seen_set is not None:
+                for target_id in target_ids:
+                    seen_set.add(target_id, day)
+
+    def seen_among(self, user_id, candidate_ids):
+        """Return the subset of `candidate_ids` the user has swiped on within the resurface horizon."""
+        seen_set = self._get(user_id)
+        with self._lock:
+            return seen_set.seen_among(candidate_ids)
+
+    def unseen(self, user_id, candidate_ids):
+        """Return `candidate_ids` without the ones the user has swiped on, keeping their order."""
+        candidate_ids = list(candidate_ids)
+        seen = self.seen_among(user_id, candidate_ids)
+        return [candidate for candidate in candidate_ids if candidate not in seen]
+
+    def expire(self, user_id):
+        """Drop the user's swipes that passed the resurface horizon. Returns how many were dropped."""
+        seen_set = self._get(user_id)
+        with self._lock:
+            return seen_set.expire(self._oldest_day())
+
+    def memory_bytes(self):
+        with self._lock:
+            return sys.getsizeof(self._sets) + sum(seen_set.memory_bytes() for seen_set in self._sets.values())
@@ -0,0 +1,91 @@
+"""Compact data transfer objects for the JSON API.
+
+The DTO classes are generated from lists of public model columns and use
+``__slots__``, so building one from a row is a plain tuple unpack with no
+ORM state. Batch reads select only the requested columns straight into DTOs,
+skipping the model objects altogether.
+"""
+
+from datetime import date, datetime
+
+from flask import jsonify, request
+
+import model
+
+
+class DTO:
+    """Base class of the generated DTOs. `fields` lists the slots in column order."""
+
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, *values, **named):
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+        for field in self.fields[len(values):]:
+            setattr(self, field, named.get(field))
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(*(getattr(obj, field) for field in cls.fields))
+
+    def to_dict(self, fields=None):
+        """Return the JSON-ready values of `fields` (default all), with dates in ISO format."""
+        result = {}
+        for field in fields or self.fields:
+            value = getattr(self, field)
+            result[field] = value.isoformat() if isinstance(value, (date, datetime)) else value
+        return result
+
+
+def make_dto(model_class, fields):
+    """Generate a slotted DTO class holding the listed columns of `model_class`.
+
+    Fields are listed explicitly so a column added to the model later stays out of the API
+    until it is added here.
+    """
+    columns = model_class.__table__.columns
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise ValueError(f'{model_class.__name__} has no columns {", ".join(unknown)}')
+    fields = tuple(fields)
+    return type(f'{model_class.__name__}DTO', (DTO,), {'__slots__': fields, 'fields': fields})
+
+
+UserDTO = make_dto(model.User, ('id', 'username', 'email', 'profile'))
+ProfileDTO = make_dto(model.UserProfile, ('id', 'user_id', 'firstname', 'lastname', 'birthday', 'gender', 'photo',
+                                          'description', 'interests', 'latitude', 'longitude'))
+
+MAX_BATCH = 200
+
+
+def parse_fields(dto_class, raw):
+    """Parse a comma-separated field list, raising ValueError for unknown fields."""
+    if not raw:
+        return dto_class.fields
+    fields = tuple(dict.fromkeys(field.strip() for field in raw.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in dto_class.fields]
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+
+def load_profiles(user_ids, fields=ProfileDTO.fields):
+    """Load the profiles of `user_ids` with one query over only `fields`, in `user_ids` order.
+
+    Returns:
+        A list of dicts with the requested fields plus ``user_id``.
+    """
+    columns = ('user_id',) + tuple(field for field in fields if field != 'user_id')
+    table = model.UserProfile.__table__
+    rows = model.db.session.execute(
+        model.db.select(*(table.c[column] for column in columns)).where(table.c.user_id.in_(user_ids)))
+    by_user = {row[0]: ProfileDTO(**dict(zip(columns, row))) for row in rows}
+    return [by_user[user_id].to_dict(columns) for user_id in user_ids if user_id in by_user]
+
+
+def conditional_json(payload):
+    """A JSON response with a strong ETag, answered with 304 when the client already has it."""
+    response = jsonify(payload)
+    response.add_etag()
+    return response.make_conditional(request)
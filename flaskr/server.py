@@ -2,17 +2,33 @@
 
 import os
 import model
+import broker
+import chat_store
+import deck
+import filters
+import geo
+import identity_map
+import inbox
+import indexsync
+import metrics
+import photos
+import profilecache
+import replicas
+import serializers
+import swipes
 from datetime import datetime
-import uuid
 import json
+import click
 from flask import Flask
-from flask import abort, jsonify, session, url_for, request, redirect, render_template, g, flash
+from flask import abort, jsonify, session, url_for, request, redirect, render_template, g, flash, send_from_directory
 from sqlalchemy.exc import IntegrityError
 from flask_socketio import join_room, leave_room, send, SocketIO
-from PIL import Image
+from markupsafe import Markup
 
 from jinja2 import StrictUndefined
 import functools
+import importlib
+import threading
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_mapping(
@@ -34,7 +50,73 @@ app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024
 current_dir = os.path.dirname(os.path.abspath(__file__))
 app.config['UPLOAD_FOLDER'] = os.path.join(current_dir, 'static', 'photos')
 app.config['SECRET_KEY'] = 'somesecretkey#'
-socketio = SocketIO(app)
+# Only show candidates within this many km of users who have set a location. None disables it.
+app.config['MATCH_RADIUS_KM'] = None
+# Queue the candidates from the last `flask recommend` run before other profiles.
+app.config['DECK_RECOMMENDATIONS'] = True
+# 'threading' for the development server; wsgi.py sets 'gevent' before importing this module.
+ASYNC_MODE = os.environ.get('MATCHMEET_ASYNC_MODE', 'threading')
+message_broker = broker.create_broker()
+socketio = SocketIO(app, async_mode=ASYNC_MODE, client_manager=message_broker.client_manager())
+rooms = broker.RoomRegistry(message_broker)
+# Share cached profiles between workers through the broker hub.
+app.config['PROFILE_CACHE_SHARED'] = os.environ.get('MATCHMEET_PROFILE_CACHE_SHARED') == '1'
+profile_cache = profilecache.ProfileCache(app, broker=message_broker)
+
+
+class _LazyIndex:
+    """Stands in for an index whose module is imported and object built on first attribute use.
+
+    The numpy-backed indexes cost most of the server's import time, and many processes, such as
+    CLI commands and workers that only serve chat, never touch some of them.
+    """
+
+    def __init__(self, module, build):
+        self._lazy_module = module
+        self._lazy_build = build
+        self._lazy_target = None
+        self._lazy_lock = threading.Lock()
+
+    def _lazy_get(self):
+        if self._lazy_target is None:
+            with self._lazy_lock:
+                if self._lazy_target is None:
+                    self._lazy_target = self._lazy_build(importlib.import_module(self._lazy_module))
+        return self._lazy_target
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_get(), name)
+
+
+interest_store = _LazyIndex('ranking', lambda ranking: ranking.InterestFeatureStore())
+geo_index = geo.GeoGrid()
+filter_engine = filters.FilterEngine()
+search_engine = _LazyIndex('search', lambda search: search.SearchEngine())
+like_graph = _LazyIndex('likegraph', lambda likegraph: likegraph.LikeGraph())
+# Profiles swiped this many days ago become candidates again.
+seen_store = _LazyIndex('seenset', lambda seenset: seenset.SeenStore(
+    resurface_days=int(os.environ.get('MATCHMEET_RESURFACE_DAYS', seenset.RESURFACE_DAYS))))
+candidate_deck = deck.CandidateDeck(app, ranker=interest_store, geo_index=geo_index, filter_engine=filter_engine,
+                                    seen_store=seen_store)
+# Applies each worker's index updates in every other worker too.
+index_sync = indexsync.IndexSync(message_broker, interest_store, filter_engine, geo_index, search_engine, like_graph,
+                                 candidate_deck)
+photo_pipeline = photos.PhotoPipeline(app)
+chat_history = chat_store.ChatStore(app)
+MAX_SWIPE_BATCH = 100
+MAX_NEARBY_RADIUS_KM = 500
+MAX_NEARBY_LIMIT = 200
+MAX_MESSAGE_PAGE = 200
+SWIPE_BATCH_NEXT = 10
+# Set to an nginx internal location (e.g. '/protected-photos/') to let the proxy send photo files.
+app.config['PHOTO_X_ACCEL_PREFIX'] = None
+# Add a Server-Timing header with app and database time to every response.
+app.config['METRICS_SERVER_TIMING'] = os.environ.get('MATCHMEET_SERVER_TIMING') == '1'
+# Scrapers send it as a bearer token; the metrics endpoints are off without it.
+app.config['METRICS_TOKEN'] = os.environ.get('MATCHMEET_METRICS_TOKEN')
+metrics.init_app(app)
+metrics.registry.add_collector(profile_cache.metric_lines)
+replicas.init_app(app)
 
 
 @app.route('/register', methods=('GET', 'POST'))
@@ -79,13 +161,11 @@ def register():
                 profile.interests = []
                 profile.gender = 0
                 user.profile = profile.id
-                user.matches = []
-                user.likes_sent = []
-                user.likes_received = []
-                user.messages_sent = []
-                user.messages_received = []
-                user.users_seen = []
+                search_engine.index_profile(profile)
                 model.db.session.commit()
+                index_sync.profile_changed(profile, new=True)
+                profile_cache.invalidate(user.id)
+                replicas.stick_to_primary()
 
             except IntegrityError as e:
                 error = f"User {username} is already registered."
@@ -148,7 +228,7 @@ def load_logged_in_user():
         g.user = None
     else:
         # Load the user object from the database based on the user ID stored in the session.
-        g.user = model.User.get_by_id(user_id)
+        g.user = identity_map.get_user(user_id)
 
 
 @app.route('/logout')
@@ -179,32 +259,36 @@ def login_required(view):
 def index():
     """Homepage route.
 
-    Displays a random user profile to the logged-in user. 
+    Displays the next profile from the logged-in user's candidate deck.
     If there are more profiles to display, it renders the "match.html" template with
-        the details of the random user profile.
+        the profile's card, which is cached by `profile_cache`.
     If there are no more profiles to display, it renders a rest.html template.
     """
-    current_user = model.User.get_by_id(session['user_id'])
-    users_seen = current_user.users_seen
-    users_seen.append(current_user.id)
+    profile_user_id = candidate_deck.peek(g.user.id)
+    if profile_user_id is None:
+        return render_template('rest.html')
 
-    random_profile = model.UserProfile.get_one_with_explicit_out_user_list(users_seen)
-    if not random_profile:
+    card = profile_cache.card(profile_user_id, render_card, photo_format())
+    if card is None:
         return render_template('rest.html')
+    return render_template('match.html', card=Markup(card), profile_user_id=profile_user_id)
+
+
+def render_card(profile):
+    """Render the swipe card of a profile."""
     current_date = datetime.now().date()
-    age = current_date.year - random_profile.birthday.year
-    if current_date.month < random_profile.birthday.month or (current_date.month == random_profile.birthday.month and current_date.day < random_profile.birthday.day):
+    age = current_date.year - profile.birthday.year
+    if current_date.month < profile.birthday.month or (current_date.month == profile.birthday.month and current_date.day < profile.birthday.day):
         age -= 1
-    name = f'{random_profile.firstname} {random_profile.lastname}'
-    gender = 'Male' if random_profile.gender == 0 else 'Female'
-    return render_template('match.html',
+    name = f'{profile.firstname} {profile.lastname}'
+    gender = 'Male' if profile.gender == 0 else 'Female'
+    return render_template('_card.html',
                            name=name,
                            age=age,
                            gender=gender,
-                           interests=random_profile.interests,
-                           description=random_profile.description,
-                           profile_photo=random_profile.photo,
-                           profile_user_id=random_profile.user_id)
+                           interests=profile.interests,
+                           description=profile.description,
+                           profile_photo=profile.photo)
 
 
 @app.route('/user/like/<user_id>', methods=['POST'])
@@ -212,44 +296,19 @@ def index():
 def like_user(user_id):
     """Like a user.
 
-    Adds the liked user to the current user's likes sent and the liked user's likes received.
+    Records the like and marks the liked user as seen in a single transaction.
     If there is a mutual like (both users have liked each other), it adds a match between them.
-    The user who receives the like is also added to the current user's list of seen users.
     """
+    current_user = g.user
+    target_user = identity_map.get_user(_user_id_arg(user_id))
 
-    current_user = model.User.get_by_id(session['user_id'])
-    target_user = model.User.get_by_id(user_id)
-
-    current_user_users_seen = current_user.users_seen
-    current_user_likes_sent = current_user.likes_sent
-    target_user_likes_received = target_user.likes_received
-    current_user_likes_sent.append(target_user.id)
-    target_user_likes_received.append(current_user.id)
-    current_user_users_seen.append(target_user.id)
-
-    current_user.likes_sent = None
-    target_user.likes_received = None
-    current_user.users_seen = None
-    model.db.session.commit()
-
-    current_user.likes_sent = current_user_likes_sent
-    target_user.likes_received = target_user_likes_received
-    current_user.users_seen = current_user_users_seen
-    model.db.session.commit()
-
-    if current_user.id in target_user.likes_sent:
-        current_user_matches = current_user.matches
-        target_user_matches = target_user.matches
-        current_user_matches.append(target_user.id)
-        target_user_matches.append(current_user.id)
-        current_user.matches = None
-        target_user.matches = None
-        model.db.session.commit()
-
-        current_user.matches = current_user_matches
-        target_user.matches = target_user_matches
-        model.db.session.commit()
+    if target_user is None:
+        abort(404)
+    if target_user.id == current_user.id:
+        abort(400)
 
+    swipes.record_swipe(current_user.id, target_user.id, liked=True)
+    index_sync.swiped(current_user.id, [target_user.id], liked_ids=[target_user.id])
     return redirect(url_for('index'))
 
 
@@ -258,20 +317,57 @@ def like_user(user_id):
 def dislike_user(user_id):
     """Dislike a user.
     
-    Adds the disliked user to the current user's list of seen users.
+    Marks the disliked user as seen by the current user.
     """
-    current_user = model.User.get_by_id(session['user_id'])
-    target_user = model.User.get_by_id(user_id)
+    current_user = g.user
+    target_user = identity_map.get_user(_user_id_arg(user_id))
 
-    current_user_users_seen = current_user.users_seen
-    current_user.users_seen = None
-    model.db.session.commit()
+    if target_user is None:
+        abort(404)
+    if target_user.id == current_user.id:
+        abort(400)
 
-    current_user_users_seen.append(target_user.id)
-    current_user.users_seen = current_user_users_seen
-    model.db.session.commit()
+    swipes.record_swipe(current_user.id, target_user.id, liked=False)
+    index_sync.swiped(current_user.id, [target_user.id])
     return redirect(url_for('index'))
 
+@app.route('/api/swipes', methods=['POST'])
+@login_required
+def swipe_batch():
+    """Apply a batch of swipes and return new matches plus the next candidates.
+
+    Expects JSON like ``{"swipes": [{"target": 12, "like": true}, ...], "next": 10}``. All swipes
+    are recorded in one transaction. Swipes on unknown users or on oneself are returned under ``rejected``.
+    ``next`` (default `SWIPE_BATCH_NEXT`) is how many upcoming candidate profiles to return, and
+    ``fields`` optionally limits their columns like `/api/profiles` does.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        decisions = [(int(swipe['target']), swipe['like']) for swipe in payload.get('swipes', [])]
+        if not all(isinstance(like, bool) for _, like in decisions):
+            raise ValueError('like must be true or false')
+        limit = min(int(payload.get('next', SWIPE_BATCH_NEXT)), candidate_deck.size)
+        fields = serializers.parse_fields(serializers.ProfileDTO, payload.get('fields'))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid swipe batch: {e}'}), 400
+    if len(decisions) > MAX_SWIPE_BATCH:
+        return jsonify({'error': f'At most {MAX_SWIPE_BATCH} swipes per request'}), 400
+
+    targets = {target_id for target_id, _ in decisions}
+    known = {user.id for user in identity_map.prefetch_users(targets)} - {g.user.id}
+    matches = swipes.record_swipes(g.user.id, [(target_id, like) for target_id, like in decisions
+                                               if target_id in known])
+    index_sync.swiped(g.user.id, sorted(known), liked_ids=sorted(
+        {target_id for target_id, like in decisions if like and target_id in known}))
+
+    candidates = serializers.load_profiles(candidate_deck.upcoming(g.user.id, limit), fields) if limit > 0 else []
+    return jsonify({
+        'matches': serializers.load_profiles(matches, ('firstname', 'lastname', 'photo')),
+        'candidates': candidates,
+        'rejected': sorted(targets - known),
+    })
+
+
 @app.route('/settings')
 @login_required
 def settings():
@@ -282,15 +378,19 @@ def settings():
     interests = 'Sports, Music, Travel'
     description = 'I am very rich.'
     profileUrl = 'eg-profile-photo.jpg'
-    return render_template('match.html', profile_user_id=12, name=name, age=age, gender=gender, interests=interests, description=description, profile_photo=profileUrl)
+    card = render_template('_card.html', name=name, age=age, gender=gender, interests=interests, description=description, profile_photo=profileUrl)
+    return render_template('match.html', card=Markup(card), profile_user_id=12)
 
 
 @app.route('/profile/<user_id>', methods=['GET'])
 @login_required
 def profile(user_id):
     """Render the user's profile page."""
-    profile = model.UserProfile.get_by_user_id(user_id)
-    isCurrentUser = str(user_id) == str(session['user_id'])
+    user_id = _user_id_arg(user_id)
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        abort(404)
+    isCurrentUser = user_id == session['user_id']
     return render_template('profile.html', profile=profile, isCurrentUser=isCurrentUser)
 
 
@@ -299,10 +399,13 @@ def profile(user_id):
 def photo_upload(user_id):
     """Upload a user's profile photo.
 
-    Saves the uploaded file, resizes and crops it, updates the user's profile with the photo URL,
-    and commits the changes to the database.
+    Streams the upload to disk under its content hash and queues the resizing job.
+    The user's profile points at the new photo once its size variants are ready.
 
     """
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        abort(413)
+
     if 'file' not in request.files:
         abort(400, 'No file uploaded')
 
@@ -313,37 +416,81 @@ def photo_upload(user_id):
     if not allowed_file_size(file):
         abort(400, 'File size exceeds the limit')
 
-    filename = str(uuid.uuid4())
-    extension = os.path.splitext(file.filename)[1]
-    save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename + extension)
-    file.seek(0)
-    file.save(save_path)
-
-    image = Image.open(save_path)
-    width, height = image.size
-    #crop to 500*500
-    left = (width - 500) // 2
-    top = (height - 500) // 2
-    right = left + 500
-    bottom = top + 500
-
-    cropped_image = image.crop((left, top, right, bottom))
-    cropped_filename = filename + '_cropped' + extension
-    cropped_save_path = os.path.join(app.config['UPLOAD_FOLDER'], cropped_filename)
-    cropped_image.save(cropped_save_path)
-
-    photo_url = f'{cropped_filename}'
-    profile = model.UserProfile.get_by_user_id(user_id)
-    profile.photo = photo_url
+    digest, save_path = photos.save_upload(file, app.config['UPLOAD_FOLDER'])
+    photo_pipeline.submit(g.user.id, digest, save_path)
 
-    model.db.session.add(profile)
-    model.db.session.commit()
+    flash('Your photo is being processed and will appear shortly.')
     return redirect(url_for('profile', user_id=user_id))
 
 def allowed_file_size(file):
     """Check if the uploaded file size is within the limit."""
     max_size = 20 * 1024 * 1024  # 20MB
-    return len(file.read()) <= max_size
+    size = photos.upload_size(file)
+    return size is not None and size <= max_size
+
+
+# Content-addressed photos never change, so browsers and proxies may keep them for a year.
+PHOTO_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Legacy photos are named by hand and may be replaced in place.
+PHOTO_LEGACY_MAX_AGE = 60 * 60
+
+
+@app.template_global()
+def photo_url(photo, variant=photos.DEFAULT_VARIANT):
+    """Build the URL of a profile photo in the size a template needs.
+
+    Processed uploads get an immutable, content-addressed URL for the requested variant
+    (thumb for avatars, card for the swipe card, full for the profile page), in WebP when
+    the browser accepts it and it was generated.
+    """
+    if not photo:
+        return url_for('static', filename='unkown_user.png')
+    if photo.startswith('../static/'):
+        return url_for('static', filename=photo[len('../static/'):])
+
+    digest = photos.parse_variant_filename(photo)
+    if digest is None:
+        return url_for('serve_photo', filename=photo)
+
+    return url_for('serve_photo', filename=photos.variant_filename(digest, variant, f'.{photo_format()}'))
+
+
+def photo_format():
+    """The photo format for this request: 'webp' when enabled and the browser accepts it, else 'jpg'."""
+    if app.config['PHOTO_WEBP'] and 'image/webp' in request.accept_mimetypes:
+        return 'webp'
+    return 'jpg'
+
+
+@app.route('/photos/<path:filename>', methods=['GET'])
+def serve_photo(filename):
+    """Serve a profile photo with long-lived caching and conditional requests.
+
+    If ``PHOTO_X_ACCEL_PREFIX`` is set, the file itself is left to the front proxy through
+    ``X-Accel-Redirect`` and only the headers are produced here.
+    """
+    digest = photos.parse_variant_filename(filename)
+    if digest is not None:
+        etag, max_age = filename, PHOTO_IMMUTABLE_MAX_AGE
+    else:
+        etag, max_age = True, PHOTO_LEGACY_MAX_AGE
+
+    accel_prefix = app.config.get('PHOTO_X_ACCEL_PREFIX')
+    if accel_prefix and digest is not None:
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+        response.headers['Content-Type'] = 'image/webp' if filename.endswith('.webp') else 'image/jpeg'
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+    else:
+        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename,
+                                       etag=etag, conditional=True, max_age=max_age)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if digest is not None:
+        response.cache_control.immutable = True
+    return response
 
 
 @app.route('/profile/<user_id>', methods=['POST'])
@@ -358,43 +505,95 @@ def profile_update(user_id):
     birthday = request.form['birthday']
     date_obj = datetime.strptime(birthday, "%Y-%m-%d")
 
-    profile = model.UserProfile.get_by_user_id(user_id)
+    # Read the row being updated from the primary, and keep the user there while replicas catch up.
+    replicas.stick_to_primary()
+    profile = identity_map.get_profile(_user_id_arg(user_id))
+    if profile is None:
+        abort(404)
     profile.firstname = request.form['firstname']
     profile.lastname = request.form['lastname']
     profile.gender = request.form['gender']
     profile.description = request.form['description']
     profile.birthday = date_obj
+    if request.form.get('latitude') and request.form.get('longitude'):
+        profile.latitude = float(request.form['latitude'])
+        profile.longitude = float(request.form['longitude'])
 
     model.db.session.add(profile)
+    inbox.refresh_peer(profile)
+    search_engine.index_profile(profile)
     model.db.session.commit()
+    index_sync.profile_changed(profile)
+    profile_cache.invalidate(profile.user_id)
 
     return redirect(url_for('profile', user_id=user_id))
 
-rooms = {}
+
+def _interest_list(value):
+    """Interests from a JSON body, which must be a list of strings. Raises ValueError otherwise."""
+    if not isinstance(value, list) or not all(isinstance(interest, str) for interest in value):
+        raise ValueError('Interests must be a list of strings')
+    return value
+
+
+def _user_id_arg(value):
+    """A user ID from the URL, aborting with 400 if it is not an integer."""
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
 
 @app.route("/room/<target>")
+@login_required
 def room(target):
-    room_number = '-'.join(sorted([str(target), str(session.get('user_id'))]))
+    target = _user_id_arg(target)
+    room_number = model.conversation_id(target, g.user.id)
     session['room'] = room_number
     session["name"] = g.user.username
     if room_number is None:
         return redirect(url_for("index"))
-    if room_number not in rooms:
-        rooms[room_number] = {"members": 0, "messages": []}
-    return render_template("room.html", code=room_number, messages=rooms[room_number]["messages"])
+    rooms.open(room_number)
+    inbox.mark_read(g.user.id, target)
+    model.db.session.commit()
+    return render_template("room.html", code=room_number, messages=chat_history.history(room_number))
+
+
+@app.route("/api/conversations/<target>/messages")
+@login_required
+def conversation_messages(target):
+    """Return a page of the conversation with `target`, for scrolling back past the buffered history.
+
+    Pass the `next_cursor` of the previous page, or the `send_time` of the oldest message on
+    screen, as `cursor`.
+    """
+    conversation = model.conversation_id(_user_id_arg(target), g.user.id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            model.Message.parse_cursor(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    limit = min(max(request.args.get('limit', chat_store.HISTORY_SIZE, type=int), 1), MAX_MESSAGE_PAGE)
+    messages, next_cursor = chat_history.older(conversation, cursor, limit)
+    return jsonify({'messages': messages, 'next_cursor': next_cursor})
+
+def remember_remote_message(message, origin):
+    """Keep room buffers in this worker in step with messages sent through other workers."""
+    if origin != message_broker.origin:
+        chat_history.remember(message['room'], message['content'])
+
+message_broker.subscribe('chat', remember_remote_message)
 
 @socketio.on("message")
 def message(data):
     room = session.get("room")
-    if room not in rooms:
-        return 
-    
-    content = {
-        "name": session.get("name"),
-        "message": data["data"]
-    }
+    if not room or not rooms.exists(room):
+        return
+
+    content = chat_history.append(room, session.get("user_id"), session.get("name"), data["data"])
+    message_broker.publish('chat', {'room': room, 'content': content})
     send(content, to=room)
-    rooms[room]["messages"].append(content)
     print(f"{session.get('name')} said: {data['data']}")
 
 @socketio.on("connect")
@@ -403,13 +602,13 @@ def connect(auth):
     name = session.get("name")
     if not room or not name:
         return
-    if room not in rooms:
+    if not rooms.exists(room):
         leave_room(room)
         return
-    
+
     join_room(room)
     send({"name": name, "message": "has entered the room"}, to=room)
-    rooms[room]["members"] += 1
+    rooms.join(room)
     print(f"{name} joined room {room}")
 
 @socketio.on("disconnect")
@@ -418,10 +617,10 @@ def disconnect():
     name = session.get("name")
     leave_room(room)
 
-    if room in rooms:
-        rooms[room]["members"] -= 1
-        if rooms[room]["members"] <= 0:
-            del rooms[room]
+    if room and rooms.exists(room):
+        if rooms.leave(room) <= 0:
+            rooms.close(room)
+            chat_history.close_room(room)
     
     send({"name": name, "message": "has left the room"}, to=room)
     print(f"{name} has left the room {room}")
@@ -434,71 +633,164 @@ def chat():
         return redirect(url_for("room"))
 
 
-    user_id = session.get('user_id')
-    user = model.User.get_by_id(user_id)
-    matches = user.matches
-    user_profiles = model.UserProfile.get_with_user_ids(matches)
-    # messages_sent = model.Message.get_message_as_sender(user_id)
-    # messages_received = model.Message.get_message_receiver(user_id)
-
-    # message_by_friend_id = {}
-    # for message in messages_sent:
-    #     if message.receiver_id not in message_by_friend_id:
-    #         message_by_friend_id[message.receiver_id] = []
-    #     message_by_friend_id[message.receiver_id].append(message.toJSON())
-    
-    # for message in messages_received:
-    #     if message.sender_id not in message_by_friend_id:
-    #         message_by_friend_id[message.sender_id] = []
-    #     message_by_friend_id[message.sender_id].append(message.toJSON())
-
-    return render_template('chat.html', friends=user_profiles)
-
-# @socketio.on('message')
-# def handle_message(data):
-#     sender = data['sender']
-#     receiver = data['receiver']
-#     room_num = '-'.join(sorted([str(sender), str(receiver)]))
-
-#     message = data['message']
-#     timestamp = data['timestamp']
-#     model.db.session.add(model.Message.create(
-#         int(data['sender']),
-#         session.get('user_id'),
-#         message,
-#         timestamp
-#     ))
-#     model.db.session.commit()
-#     sender_profile = model.UserProfile.get_by_user_id(data['sender'])
-
-#     send({
-#         'message': message,
-#         'timestamp': timestamp,
-#         'name': f'{sender_profile.firstname} {sender_profile.lastname}'
-#     }, to=room_num)
-
-    #socketio.emit('reply', )
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            inbox.parse_cursor(cursor)
+        except ValueError:
+            abort(400)
+    entries, next_cursor = inbox.page(g.user.id, cursor=cursor)
+    return render_template('chat.html', friends=entries, next_cursor=next_cursor)
 
 # Restful APIs
 @app.route('/api/profile/userid/<id>', methods=['GET'])
 def get_user_profile(id):
     """Retrieve a user's profile based on the user ID."""
-    profile = model.UserProfile.get_by_user_id(id)
-    return jsonify(profile)
+    profile = profile_cache.get(_user_id_arg(id))
+    if profile is None:
+        abort(404)
+    return serializers.conditional_json(profile.to_dict())
 
 
 @app.route('/api/user/<id>', methods=['GET'])
 def get_user(id):
     """Retrieve a user's information based on the user ID."""
-    user = model.User.get_by_id(id)
-    del user.password
-    return jsonify(user)
+    user = model.User.get_by_id(_user_id_arg(id))
+    if user is None:
+        abort(404)
+    return serializers.conditional_json(serializers.UserDTO.from_model(user).to_dict())
+
+
+@app.route('/api/profiles', methods=['GET'])
+def get_profiles():
+    """Retrieve many profiles in one call.
+
+    Query parameters:
+        ids: Comma-separated user IDs, at most `serializers.MAX_BATCH`.
+        fields: Optional comma-separated profile columns to return; `user_id` is always included.
+    """
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in request.args.get('ids', '').split(',') if user_id))
+        fields = serializers.parse_fields(serializers.ProfileDTO, request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if len(user_ids) > serializers.MAX_BATCH:
+        return jsonify({'error': f'At most {serializers.MAX_BATCH} ids per request'}), 400
+    return serializers.conditional_json({'profiles': serializers.load_profiles(user_ids, fields)})
+
+
+@app.route('/api/preferences', methods=['GET', 'POST'])
+@login_required
+def preferences():
+    """Get or set the logged-in user's candidate preferences.
+
+    POST takes JSON with any of `min_age`, `max_age`, `gender` and `interests`; a null or
+    missing value clears that preference. The user's deck is rebuilt with the new filters.
+    """
+    if request.method == 'GET':
+        return jsonify(filter_engine.criteria_for(g.user.id).to_dict())
+
+    replicas.stick_to_primary()
+    payload = request.get_json(silent=True) or {}
+    try:
+        values = {key: None if payload.get(key) is None else int(payload[key])
+                  for key in ('min_age', 'max_age', 'gender')}
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Ages and gender must be integers'}), 400
+    try:
+        interests = [] if payload.get('interests') is None else _interest_list(payload['interests'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    preference = model.Preference.get_by_user_id(g.user.id) or model.Preference(user_id=g.user.id)
+    for key, value in values.items():
+        setattr(preference, key, value)
+    preference.interests = interests
+    model.db.session.add(preference)
+    model.db.session.commit()
+    index_sync.preferences_changed(g.user.id)
+    return jsonify(filters.Criteria.from_preference(preference).to_dict())
+
+
+@app.route('/api/search', methods=['GET'])
+@login_required
+def search_profiles():
+    """Full-text search over profile descriptions and interests.
+
+    Query parameters:
+        q: The search text.
+        page: 1-based page number.
+        per_page: Results per page, at most `search.MAX_PAGE_SIZE`.
+    """
+    import search
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', search.PAGE_SIZE)), 1), search.MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    results, total = search_engine.search(request.args.get('q', ''), page, per_page)
+    profiles = {profile['user_id']: profile for profile in serializers.load_profiles(
+        [user_id for user_id, _ in results], ('firstname', 'lastname', 'photo', 'description', 'interests'))}
+    return jsonify({
+        'results': [dict(profiles[user_id], score=round(score, 4)) for user_id, score in results
+                    if user_id in profiles],
+        'total': total,
+        'page': page,
+        'next_page': page + 1 if page * per_page < total else None,
+    })
+
+
+@app.route('/api/likes', methods=['GET'])
+@login_required
+def get_likes():
+    """Like counts for the logged-in user and who liked them without being liked back yet."""
+    if not like_graph.loaded:
+        import likegraph
+
+        likegraph.load_like_graph(like_graph)
+    liked_you = like_graph.liked_you(g.user.id)
+    return jsonify({
+        'sent': like_graph.sent_count(g.user.id),
+        'received': like_graph.received_count(g.user.id),
+        'mutual': len(like_graph.mutual(g.user.id)),
+        'liked_you': serializers.load_profiles(liked_you[:serializers.MAX_BATCH], ('firstname', 'lastname', 'photo')),
+    })
+
+
+@app.route('/api/candidates/nearby', methods=['GET'])
+@login_required
+def get_nearby_candidates():
+    """List the profiles within `radius_km` of the current user, nearest first.
+
+    The radius is capped at `MAX_NEARBY_RADIUS_KM` and the limit at `MAX_NEARBY_LIMIT`.
+    """
+    radius_km = request.args.get('radius_km', 10, type=float)
+    if radius_km is None or not radius_km > 0:
+        abort(400, 'radius_km must be a positive number')
+    radius_km = min(radius_km, MAX_NEARBY_RADIUS_KM)
+    limit = min(request.args.get('limit', 50, type=int), MAX_NEARBY_LIMIT)
+    if not geo_index.loaded:
+        geo.load_geo_grid(geo_index)
+    origin = geo_index.location(g.user.id)
+    if origin is None:
+        abort(400, 'Set a location on your profile first')
+
+    nearby = geo_index.within(origin[0], origin[1], radius_km, limit=limit, exclude={g.user.id})
+    return jsonify([{'user_id': user_id, 'distance_km': round(distance, 2)} for user_id, distance in nearby])
 
 
 @app.route('/api/profile/<id>', methods=['POST'])
 def update_user_profile(id):
     """Update a user's profile."""
-    profile = model.UserProfile.get_by_user_id(id)
+    if 'interests' in request.json:
+        try:
+            _interest_list(request.json['interests'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    replicas.stick_to_primary()
+    profile = model.UserProfile.get_by_user_id(_user_id_arg(id))
+    if profile is None:
+        abort(404)
     # Update the profile attributes based on the request data
     if 'firstname' in request.json:
         profile.firstname = request.json['firstname']
@@ -512,54 +804,121 @@ def update_user_profile(id):
         birthday = request.json['birthday']
         date_obj = datetime.strptime(birthday, "%Y-%m-%d")
         profile.birthday = date_obj
-
+    if 'interests' in request.json:
+        profile.interests = request.json['interests']
+    if 'latitude' in request.json and 'longitude' in request.json:
+        profile.latitude = request.json['latitude']
+        profile.longitude = request.json['longitude']
+
+    inbox.refresh_peer(profile)
+    search_engine.index_profile(profile)
     model.db.session.commit()
+    index_sync.profile_changed(profile)
+    profile_cache.invalidate(profile.user_id)
 
-    return jsonify(profile)
+    return jsonify(serializers.ProfileDTO.from_model(profile).to_dict())
 
-def setup_testuser(test_user):
-    model.db.session.add(model.User.create(test_user['username'], test_user['password']))
-    model.db.session.commit()
-    user = model.User.get_by_username(test_user['username'])
-
-    model.db.session.add(model.UserProfile.create(user.id))
-    model.db.session.commit()
-
-    profile = model.UserProfile.get_by_user_id(user.id)
-    profile.photo = test_user['photo']
-    profile.firstname = test_user['firstname']
-    profile.lastname = test_user['lastname']
-    profile.birthday = datetime(test_user['birth_year'], test_user['birth_mon'], test_user['birth_day'])
-    profile.description = test_user['description']
-    profile.interests = []
-    profile.gender = test_user['gender']
-    user.profile = profile.id
-    user.matches = []
-    user.likes_sent = []
-    user.likes_received = []
-    user.messages_sent = []
-    user.messages_received = []
-    user.users_seen = []
+def index_new_users(user_ids):
+    """Add freshly loaded users to the in-memory indexes of every worker."""
+    for profile in model.UserProfile.get_with_user_ids(user_ids):
+        search_engine.index_profile(profile)
     model.db.session.commit()
+    # Committing expired the profiles; read them back in one query.
+    for profile in model.UserProfile.get_with_user_ids(user_ids):
+        index_sync.profile_changed(profile, new=True)
 
 @app.route('/test_users', methods=['GET'])
 def setup_test_users():
-    data = {}
+    import bulk_load
+
+    data = []
     try:
         with app.open_resource("static/data.json") as file:
             data = json.load(file)
     except FileNotFoundError:
         pass
-    for test_user in data:
-        setup_testuser(test_user)
+    index_new_users(bulk_load.load_users(data))
     session.clear()
     return redirect(url_for('login'))
 
 
+def warm_indexes():
+    """Load the in-memory indexes now instead of on the first request that needs each of them.
+
+    Under gevent a lazy load would stall every connection of the worker while it runs.
+    """
+    import likegraph
+    import ranking
+
+    if not interest_store.loaded:
+        ranking.load_feature_store(interest_store)
+    if not geo_index.loaded:
+        geo.load_geo_grid(geo_index)
+    if not filter_engine.interest_index.loaded:
+        filters.load_interest_index(filter_engine.interest_index)
+    if not like_graph.loaded:
+        likegraph.load_like_graph(like_graph)
+    search_engine.warm()
+
+
+def connect_cli():
+    """Connect CLI commands to the database unless the app is already connected."""
+    if 'sqlalchemy' not in app.extensions:
+        model.connect_to_db(app, os.environ.get('MATCHMEET_DATABASE_URL', 'postgresql:///matchmeet'))
+
+
+@app.cli.command('bulk-load')
+@click.option('--file', 'path', type=click.Path(exists=True), help='JSON array or NDJSON file of users.')
+@click.option('--synthetic', type=int, default=0, help='Number of synthetic users to generate.')
+@click.option('--activity/--no-activity', default=False, help='Also generate likes, matches and messages.')
+@click.option('--likes-per-user', type=int, default=20)
+@click.option('--match-rate', type=float, default=0.2)
+@click.option('--messages-per-match', type=int, default=5)
+@click.option('--batch-size', type=int, help='Rows per INSERT or COPY batch.')
+@click.option('--seed', type=int, default=0)
+def bulk_load_command(path, synthetic, activity, likes_per_user, match_rate, messages_per_match, batch_size, seed):
+    """Load users from a file or generate a synthetic population."""
+    import bulk_load
+
+    batch_size = batch_size or bulk_load.BATCH_SIZE
+    if path:
+        records = bulk_load.read_records(path)
+    elif synthetic:
+        records = bulk_load.synthetic_records(synthetic, seed)
+    else:
+        raise click.UsageError('Pass --file or --synthetic.')
+    connect_cli()
+    bulk_load.run(records, activity, likes_per_user, match_rate, messages_per_match, seed, batch_size)
+    search_engine.backfill()
+    model.db.session.commit()
+
+
+@app.cli.command('recommend')
+@click.option('--full', is_flag=True, help='Rescore every user, not only those with new likes.')
+@click.option('--workers', type=int, default=1, help='Scoring processes.')
+@click.option('--top-n', type=int, help='Recommendations kept per user.')
+def recommend_command(full, workers, top_n):
+    """Recompute collaborative-filtering recommendations from the likes graph."""
+    import recommend
+
+    connect_cli()
+    top_n = top_n or recommend.TOP_N
+    report = recommend.run(full, workers, top_n)
+    print(json.dumps(report))
+
+
+@app.cli.command('rebuild-inbox')
+def rebuild_inbox():
+    """Create chat inbox entries for matches made before the inbox existed."""
+    connect_cli()
+    count = inbox.rebuild()
+    model.db.session.commit()
+    print(f'Created inbox entries for {count} matches.')
 
 
 if __name__ == '__main__':
     """Connect to the database."""
+    # Fails with `migrations.SchemaOutOfDate` until `python migrations.py upgrade` has run.
     model.connect_to_db(app)
     socketio.run(app, host='127.0.0.1', debug=True)
 
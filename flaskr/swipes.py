@@ -0,0 +1,114 @@
+"""Swipe service: records likes and dislikes and detects matches."""
+
+from datetime import datetime
+
+from sqlalchemy import exists, func, literal, select, union_all
+
+import inbox
+import model
+
+
+def _lock_pairs(user_id, target_ids):
+    """Serialize likes between `user_id` and each of `target_ids` until the transaction ends.
+
+    Without this, two users liking each other at the same moment under READ COMMITTED each
+    miss the other's uncommitted like and no match is made. Pairs are locked in ascending
+    `(lower ID, higher ID)` order so concurrent batches cannot deadlock. SQLite already
+    runs one write transaction at a time.
+    """
+    pairs = sorted((min(user_id, target_id), max(user_id, target_id)) for target_id in target_ids)
+    session = model.db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for pair in pairs:
+            session.execute(select(func.pg_advisory_xact_lock(*pair)))
+    elif dialect != 'sqlite':
+        ids = sorted({user_id, *target_ids})
+        session.execute(select(model.User.id).where(model.User.id.in_(ids)).order_by(model.User.id).with_for_update())
+
+
+def _match_if_mutual(user_id, target_id, now):
+    """Insert both sides of a match if `target_id` already likes `user_id`.
+
+    Returns the number of match rows written, so a non-zero result means a new match.
+    """
+    like, match = model.Like.__table__, model.Match.__table__
+    mutual = exists().where(like.c.user_id == target_id, like.c.target_id == user_id)
+    rows = union_all(
+        select(literal(user_id), literal(target_id), literal(now)).where(mutual),
+        select(literal(target_id), literal(user_id), literal(now)).where(mutual),
+    )
+    statement = model.insert_ignore(match).from_select(['user_id', 'match_id', 'match_time'], rows)
+    return model.db.session.execute(statement).rowcount
+
+
+def record_swipe(user_id, target_id, liked):
+    """Record a like or dislike from `user_id` on `target_id` in a single transaction.
+
+    The target is always marked as seen, restarting its resurface clock if it was seen
+    before (see `seenset`). For a like, the like edge is written and a match is
+    created if the target already liked the user back. Liking yourself is ignored.
+
+    Returns:
+        True if the swipe created a new match, False otherwise.
+    """
+    if user_id == target_id:
+        return False
+    now = datetime.utcnow()
+    session = model.db.session
+    try:
+        session.execute(model.upsert(model.Seen.__table__, ['seen_time']).values(
+            user_id=user_id, seen_user_id=target_id, seen_time=now))
+        matched = False
+        if liked:
+            _lock_pairs(user_id, [target_id])
+            session.execute(model.insert_ignore(model.Like.__table__).values(
+                user_id=user_id, target_id=target_id, like_time=now))
+            matched = _match_if_mutual(user_id, target_id, now) > 0
+            if matched:
+                inbox.add_match(user_id, target_id)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return matched
+
+
+def record_swipes(user_id, decisions):
+    """Record a batch of swipes from `user_id` in a single transaction.
+
+    Args:
+        decisions: `(target_id, liked)` pairs. A later decision on the same target wins.
+
+    Returns:
+        The sorted IDs of the users the batch created new matches with.
+    """
+    decisions = {int(target_id): bool(liked) for target_id, liked in decisions if int(target_id) != user_id}
+    if not decisions:
+        return []
+    now = datetime.utcnow()
+    liked = [target_id for target_id, like in decisions.items() if like]
+    session = model.db.session
+    try:
+        session.execute(model.upsert(model.Seen.__table__, ['seen_time']), [
+            {'user_id': user_id, 'seen_user_id': target_id, 'seen_time': now} for target_id in decisions])
+        matched = []
+        if liked:
+            _lock_pairs(user_id, liked)
+            session.execute(model.insert_ignore(model.Like.__table__), [
+                {'user_id': user_id, 'target_id': target_id, 'like_time': now} for target_id in liked])
+            like, match = model.Like, model.Match
+            mutual = session.query(like.user_id).filter(like.target_id == user_id, like.user_id.in_(liked))
+            already = session.query(match.match_id).filter(match.user_id == user_id, match.match_id.in_(liked))
+            matched = sorted({row.user_id for row in mutual} - {row.match_id for row in already})
+        if matched:
+            session.execute(model.insert_ignore(model.Match.__table__), [
+                {'user_id': owner, 'match_id': peer, 'match_time': now}
+                for target_id in matched for owner, peer in ((user_id, target_id), (target_id, user_id))])
+            for target_id in matched:
+                inbox.add_match(user_id, target_id)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return matched
@@ -0,0 +1,65 @@
+"""Production entry point: the Flask and Socket.IO server on gevent.
+
+One process serves thousands of idle Socket.IO connections as greenlets
+instead of a thread each. gevent patches the standard library before
+anything else is imported, and psycogreen makes psycopg2 wait for Postgres
+cooperatively, so a slow query only parks its own greenlet. The connection
+pool is the usual SQLAlchemy ``QueuePool``; once patched, requests beyond
+``MATCHMEET_DB_POOL_SIZE`` plus ``MATCHMEET_DB_MAX_OVERFLOW`` queue for a
+connection without blocking the others (see `replicas`).
+
+CPU-heavy work must stay off the event loop: photos are already resized in
+a process pool, and the in-memory indexes are loaded before the first
+connection instead of lazily inside a request. SQLite has no cooperative
+driver, so gevent mode wants Postgres.
+
+``MATCHMEET_ASYNC_MODE=threading`` runs the same entry point on the threaded
+development server instead, for comparison.
+
+Workers do not touch the schema on boot: run ``python migrations.py upgrade``
+once per deploy, or set ``MATCHMEET_SCHEMA=check`` or ``migrate`` (see
+`model.connect_to_db`).
+
+Usage:
+    python wsgi.py --host 0.0.0.0 --port 5000
+    gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 wsgi:app
+"""
+
+import os
+
+ASYNC_MODE = os.environ.setdefault('MATCHMEET_ASYNC_MODE', 'gevent')
+os.environ.setdefault('MATCHMEET_SCHEMA', 'skip')
+
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+import argparse
+
+import model
+import server
+
+app = server.app
+socketio = server.socketio
+
+model.connect_to_db(app, os.environ.get('MATCHMEET_DATABASE_URL', 'postgresql:///matchmeet'))
+if os.environ.get('MATCHMEET_WARM_INDEXES', '1') == '1':
+    with app.app_context():
+        server.warm_indexes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    socketio.run(app, host=args.host, port=args.port, log_output=False, allow_unsafe_werkzeug=True)
+
+
+if __name__ == '__main__':
+    main()